@@ -0,0 +1,246 @@
+"""
+无界面 HTTP API (FastAPI)，与 Streamlit 页面共用 modules.service 核心层
+
+    uvicorn api:app --host 0.0.0.0 --port 8000 --workers 4
+
+接口：
+    GET    /health               服务配置状态 (含启动剖面)
+    GET    /collections          知识库列表
+    POST   /ingest               上传文件入库 (multipart, 字段名 files；可选 collection、tags；
+                                 background=true 时立即返回任务 ID，否则等待入库完成)
+    GET    /jobs                 最近的入库任务 (?active=true 只看排队中 / 进行中)
+    GET    /jobs/{job_id}        入库任务状态与吞吐量
+    GET    /files                已入库文件 (?collection=)，含标签与入库时间
+    GET    /dedup                近重复去重的节省统计 (?collection=)：跳过的片段 / 字符 / token / 向量字节
+    PUT    /files/{name}/tags    设置文件标签
+    DELETE /files/{name}         删除文件 (?collection=)
+    POST   /query                只检索，返回上下文与片段引用 (可按知识库 / 文件 / 标签 / 日期限定范围)
+    POST   /answer               检索 + 流式回答 (SSE)，可选写入对话历史
+    GET    /history              对话列表 (limit / offset 分页)
+    GET    /history/{chat_id}    对话内容
+    DELETE /history/{chat_id}    删除对话
+    GET    /metrics              Prometheus 文本格式指标
+"""
+import json
+import time
+import uuid
+from contextlib import asynccontextmanager
+from typing import List, Optional
+
+_import_start = time.perf_counter()
+
+from fastapi import FastAPI, File, Form, HTTPException, UploadFile
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from pydantic import BaseModel
+
+from modules import history, metrics, startup
+from modules.database import check_collection
+from modules.service import RAGService, day_range
+
+# 启动剖面：入口模块的导入耗时 (chromadb / openai 等重依赖已延迟到首次使用时导入)
+startup.record("import", time.perf_counter() - _import_start)
+
+service = RAGService()
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # 每个 worker 进程启动后在后台预热，不阻塞接受请求；有未完成的入库任务时启动后台 worker 续跑
+    service.warm_up()
+    await run_in_threadpool(service.resume_jobs)
+    yield
+
+
+app = FastAPI(title="DeepSeek Pro 知识库 API", lifespan=lifespan)
+
+
+class QueryRequest(BaseModel):
+    query: str
+    top_k_recall: int = 30
+    top_k_rerank: int = 5
+    token_budget: int = 3000
+    use_web: bool = False
+    collection: Optional[str] = None
+    files: Optional[List[str]] = None
+    tags: Optional[List[str]] = None
+    date_from: Optional[str] = None  # YYYY-MM-DD，按入库日期筛选
+    date_to: Optional[str] = None
+
+
+class AnswerRequest(QueryRequest):
+    temperature: float = 0.3
+    chat_id: Optional[str] = None
+
+
+class TagsRequest(BaseModel):
+    tags: List[str]
+
+
+def _collection(name):
+    """校验知识库名称，不合法时返回 400"""
+    try:
+        return check_collection(name)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+def _scope(req):
+    """请求中的检索范围 -> service.retrieve 的参数；日期不合法时返回 400"""
+    try:
+        since, until = day_range(req.date_from, req.date_to)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"collection": _collection(req.collection), "files": req.files, "tags": req.tags,
+            "since": since, "until": until}
+
+
+def _stage_summary(stages):
+    """检索阶段状态 (去掉结果正文与异常对象，便于序列化)"""
+    return {name: {"status": s["status"], "elapsed": round(s["elapsed"], 3)} for name, s in stages.items()}
+
+
+def _sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+@app.get("/health")
+async def health():
+    return await run_in_threadpool(service.status)
+
+
+@app.get("/collections")
+async def list_collections():
+    return {"collections": await run_in_threadpool(service.list_collections)}
+
+
+@app.post("/ingest")
+async def ingest(files: List[UploadFile] = File(...), collection: Optional[str] = Form(None),
+                 tags: Optional[str] = Form(None), background: bool = Form(False)):
+    """tags 为逗号分隔的标签，作用于本次上传的全部文件"""
+    payload = [(f.filename, await f.read()) for f in files]
+    try:
+        if background:
+            return {"job_id": await run_in_threadpool(service.submit_ingest, payload, collection, tags)}
+        results = await run_in_threadpool(service.ingest, payload, None, collection, tags)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"results": [{"file": name, **stats} for name, stats in results]}
+
+
+@app.get("/jobs")
+async def list_jobs(limit: int = 20, active: bool = False):
+    return {"jobs": await run_in_threadpool(service.list_jobs, limit, active)}
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = await run_in_threadpool(service.job, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="任务不存在")
+    return job
+
+
+@app.get("/files")
+async def list_files(collection: Optional[str] = None):
+    collection = _collection(collection)
+    return {"collection": collection, "files": await run_in_threadpool(service.file_records, collection)}
+
+
+@app.get("/dedup")
+async def dedup_report(collection: Optional[str] = None):
+    """近重复去重的节省统计 (跳过的片段数、字符数、Embedding token 数、向量字节数)"""
+    collection = _collection(collection)
+    return {"collection": collection, **await run_in_threadpool(service.dedup_report, collection)}
+
+
+@app.put("/files/{name}/tags")
+async def set_tags(name: str, req: TagsRequest, collection: Optional[str] = None):
+    await run_in_threadpool(service.set_tags, name, req.tags, _collection(collection))
+    return {"file": name, "tags": req.tags}
+
+
+@app.delete("/files/{name}")
+async def delete_file(name: str, collection: Optional[str] = None):
+    """与后台入库任务共用写库租约；等待超时 (长时间入库进行中) 时返回 409"""
+    try:
+        await run_in_threadpool(service.delete_file, name, _collection(collection))
+    except TimeoutError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return {"deleted": name}
+
+
+def _query(req, scope):
+    with metrics.start_trace("query", api="query") as trace:
+        retrieved = service.retrieve(req.query, top_k_recall=req.top_k_recall, top_k_rerank=req.top_k_rerank,
+                                     token_budget=req.token_budget, use_web=req.use_web, **scope)
+    return {
+        "request_id": trace.request_id,
+        "local": retrieved["local"],
+        "local_refs": retrieved["local_refs"],
+        "web": retrieved["web"],
+        "stages": _stage_summary(retrieved["stages"]),
+    }
+
+
+@app.post("/query")
+async def query(req: QueryRequest):
+    return await run_in_threadpool(_query, req, _scope(req))
+
+
+def _answer_events(req, scope):
+    """SSE 事件流：context (引用与阶段状态) -> token* -> done；带 chat_id 时结合该对话的历史回答追问"""
+    with metrics.start_trace("query", api="answer") as trace:
+        previous = history.load_chat(req.chat_id) if req.chat_id is not None else []
+        search_query, memory = service.prepare_query(req.query, previous, chat_id=req.chat_id)
+        retrieved = service.retrieve(search_query, top_k_recall=req.top_k_recall, top_k_rerank=req.top_k_rerank,
+                                     token_budget=req.token_budget, use_web=req.use_web, **scope)
+        yield _sse("context", {"request_id": trace.request_id, "search_query": search_query,
+                               "local_refs": retrieved["local_refs"],
+                               "stages": _stage_summary(retrieved["stages"])})
+        pieces = []
+        try:
+            for piece in service.stream_answer(req.query, retrieved, temperature=req.temperature, memory=memory):
+                pieces.append(piece)
+                yield _sse("token", {"text": piece})
+        except Exception as e:
+            yield _sse("error", {"message": str(e)})
+            return
+
+        chat_id = req.chat_id
+        if chat_id is not None:
+            messages = previous + [{"role": "user", "content": req.query}]
+            service.record_answer(chat_id, messages, "".join(pieces), retrieved["local_refs"])
+    yield _sse("done", {"request_id": trace.request_id, "chat_id": chat_id, "total_ms": trace.total_ms})
+
+
+@app.post("/answer")
+async def answer(req: AnswerRequest):
+    scope = _scope(req)
+    if req.chat_id == "new":
+        req.chat_id = str(uuid.uuid4())
+    # 每个事件可能在不同的线程里产出，需固定在同一个 Context 中推进，追踪才能正确配对
+    return StreamingResponse(metrics.iterate_in_context(_answer_events(req, scope)),
+                             media_type="text/event-stream")
+
+
+@app.get("/history")
+async def list_history(limit: int = 50, offset: int = 0):
+    chats = await run_in_threadpool(history.get_history_list, limit, offset)
+    return {"total": await run_in_threadpool(history.count_history), "chats": chats}
+
+
+@app.get("/history/{chat_id}")
+async def get_chat(chat_id: str):
+    return {"chat_id": chat_id, "messages": await run_in_threadpool(history.load_chat, chat_id)}
+
+
+@app.delete("/history/{chat_id}")
+async def delete_chat(chat_id: str):
+    await run_in_threadpool(history.delete_chat, chat_id)
+    return {"deleted": chat_id}
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def prometheus_metrics():
+    return metrics.render_prometheus()
@@ -1,20 +1,114 @@
+import time
+
+_import_start = time.perf_counter()
+
 import streamlit as st
 import uuid
-from openai import OpenAI
 
-# 导入所有模块 (保持不变)
-from modules.embedder import load_embedder
-from modules.processor import process_file
-from modules.web_search import search_web
-from modules.history import save_chat, load_chat, get_history_list, delete_chat
-from modules.database import add_to_db, reset_db, get_collection, get_all_files, delete_file_from_db
-from modules.retriever import search_vectors
-from modules.reranker import load_reranker
+# 页面只负责展示，入库 / 检索 / 生成都交给无界面的核心服务层 (与 api.py、cli.py 共用)
+from modules.database import check_collection
+from modules.answer_cache import replay
+from modules.service import RAGService, day_range
+from modules.history import load_chat, get_history_list, count_history, delete_chat
+from modules.retriever import resolve_refs
+from modules.metrics import start_metrics_server, start_trace
+from modules import startup
+
+# 启动剖面：入口模块的导入耗时 (chromadb / openai 等重依赖已延迟到首次使用时导入)
+startup.record("import", time.perf_counter() - _import_start)
 
 # --- 页面配置 ---
 st.set_page_config(page_title="DeepSeek Pro 知识库", layout="wide", page_icon="🧠")
 
 
+@st.cache_resource
+def load_service():
+    # 服务创建后立即在后台预热向量库索引与各外部服务连接，首个查询不再等待
+    service = RAGService()
+    service.warm_up()
+    # 上次退出前未完成的入库任务立即续跑
+    service.resume_jobs()
+    return service
+
+
+@st.cache_resource
+def load_metrics_server(port):
+    """可选的 Prometheus /metrics 端点 (secrets 中配置 METRICS_PORT 时启动)"""
+    return start_metrics_server(port)
+
+
+def render_debug(trace, profile):
+    """调试面板：上一次查询各阶段耗时 + 启动剖面"""
+    with st.sidebar.expander("🐞 调试：上次查询耗时", expanded=False):
+        st.caption(f"request_id: {trace['request_id']} | 总耗时 {trace['total_ms']:.0f} ms")
+        for s in trace["stages"]:
+            count = f" ×{s['count']}" if s["count"] > 1 else ""
+            st.text(f"{s['stage']:<14}{s['ms']:>10.1f} ms{count}")
+        if profile:
+            st.caption("启动剖面")
+            for name, ms in profile.items():
+                st.text(f"{name:<20}{ms:>10.1f} ms")
+
+
+def render_refs(refs, key):
+    """引用折叠区：打开开关时才按引用取回原文"""
+    if st.toggle(f"📖 查看引用片段 ({len(refs)})", key=key):
+        st.info(resolve_refs(refs))
+
+
+@st.fragment(run_every=2)
+def render_jobs(service):
+    """后台入库任务进度：每 2 秒轮询一次；本会话提交的任务完成时刷新整个页面 (文件列表)"""
+    active = service.list_jobs(limit=5, active_only=True)
+    for job in active:
+        running = [f for f in job["files"] if f["status"] == "running"]
+        frac = job["done_files"]
+        if running and running[0]["estimate"]:
+            frac += min(running[0]["added"] / running[0]["estimate"], 1.0)
+        current = f" | {running[0]['name']}" if running else ""
+        st.progress(frac / max(job["total_files"], 1),
+                    text=f"⏳ {job['done_files']}/{job['total_files']} 文件 | {job['added']} 片段 | "
+                         f"{job['chunks_per_sec']:.0f} 片段/秒{current}")
+
+    active_ids = {job["id"] for job in active}
+    finished = [job_id for job_id in st.session_state.watching_jobs if job_id not in active_ids]
+    if finished:
+        for job_id in finished:
+            st.session_state.watching_jobs.discard(job_id)
+            job = service.job(job_id)
+            if job is not None:
+                st.session_state.job_notices.append(job)
+        st.rerun(scope="app")
+
+
+def render_job_notice(job):
+    """本会话提交的入库任务完成后的结果汇总"""
+    if job["error"]:
+        st.error(f"入库任务失败: {job['error']}")
+        return
+    results = [f["result"] for f in job["files"] if f["result"]]
+    total = sum(r["added"] for r in results)
+    duplicates = sum(r.get("duplicates", 0) for r in results)
+    skipped = sum(1 for r in results if r["status"] == "unchanged")
+    for f in job["files"]:
+        if f["result"] and f["result"]["error"]:
+            st.warning(f"{f['name']}: {f['result']['error']}")
+    if total > 0: st.success(f"存入 {total} 片段")
+    if duplicates: st.info(f"{duplicates} 个片段与已有内容近似重复，只记录出处，未重复向量化")
+    if skipped: st.info(f"{skipped} 个文件内容未变化，已跳过")
+
+
+def request_regenerate(service, query, answer_id):
+    """
+    “重新生成”：撤回本轮的缓存回答 (同时从对话记录中删除)，下一次运行时跳过答案缓存重新提问
+    被拒绝的缓存回答一并删除，之后相似的问题不再回放它
+    """
+    st.session_state.messages = st.session_state.messages[:-2]
+    service.truncate_chat(st.session_state.current_chat_id, len(st.session_state.messages))
+    service.discard_cached_answer(answer_id)
+    st.session_state.regenerate = query
+
+
 def main():
     st.title("🤖 DeepSeek Pro 知识库 (v4.1)")
     st.caption("全功能版: 引用持久化 | 参数详解 | 深度思考")
@@ -22,6 +116,14 @@ def main():
     # --- Session State 初始化 ---
     if "messages" not in st.session_state: st.session_state.messages = []
     if "current_chat_id" not in st.session_state: st.session_state.current_chat_id = str(uuid.uuid4())
+    if "history_limit" not in st.session_state: st.session_state.history_limit = 30
+    if "collection" not in st.session_state: st.session_state.collection = None
+    if "watching_jobs" not in st.session_state: st.session_state.watching_jobs = set()
+    if "job_notices" not in st.session_state: st.session_state.job_notices = []
+
+    service = load_service()
+    if service.get("METRICS_PORT"):
+        load_metrics_server(service.get("METRICS_PORT"))
 
     # --- 侧边栏 ---
     with st.sidebar:
@@ -31,55 +133,107 @@ def main():
         with tab1:
             # 1. 模型状态仪表盘
             st.subheader("1. 系统状态")
-            ds_key = st.secrets.get("DEEPSEEK_API_KEY")
-            ds_url = st.secrets.get("DEEPSEEK_BASE_URL", "https://api.deepseek.com")
-            emb_key = st.secrets.get("EMBEDDING_API_KEY")
-            emb_base = st.secrets.get("EMBEDDING_BASE_URL")
-            emb_model = st.secrets.get("EMBEDDING_MODEL")
-            rerank_key = st.secrets.get("RERANK_API_KEY")
-            rerank_base = st.secrets.get("RERANK_BASE_URL")
-            rerank_model = st.secrets.get("RERANK_MODEL")
-            tavily_key = st.secrets.get("TAVILY_API_KEY")
+            status = service.status()
 
             c1, c2, c3 = st.columns(3)
-            c1.markdown("🟢 **LLM**" if ds_key else "🔴 **LLM**")
-            c2.markdown("🟢 **RAG**" if emb_key else "🔴 **RAG**")
-            c3.markdown("🟢 **Web**" if tavily_key else "⚪ **Web**")
+            c1.markdown("🟢 **LLM**" if status["llm"] else "🔴 **LLM**")
+            c2.markdown("🟢 **RAG**" if status["rag"] else "🔴 **RAG**")
+            c3.markdown("🟢 **Web**" if status["web"] else "⚪ **Web**")
+
+            cache_stats = status["embedding_cache"]
+            st.caption(
+                f"向量缓存: {cache_stats['size']} 条 | 命中 {cache_stats['hits']} / "
+                f"未命中 {cache_stats['misses']} ({cache_stats['hit_rate']:.0%})"
+            )
+            query_stats = status["query_cache"]
+            st.caption("查询缓存命中率: " + " | ".join(
+                f"{level} {stats['hit_rate']:.0%}" for level, stats in query_stats.items()
+            ))
+            if status["answer_cache"]:
+                answer_stats = status["answer_cache"]
+                st.caption(f"答案缓存: {answer_stats['size']} 条 | 命中率 {answer_stats['hit_rate']:.0%}")
+            tripped = [name for name, state in status["circuits"].items() if state != "closed"]
+            if tripped:
+                st.caption(f"⚡ 熔断中 (冷却期内自动降级): {', '.join(tripped)}")
 
             st.divider()
 
+            # 知识库选择：按团队 / 项目划分，上传、文件管理、检索都只作用于当前知识库
+            collections = service.list_collections()
+            if st.session_state.collection and st.session_state.collection not in collections:
+                collections.append(st.session_state.collection)
+            current = st.session_state.collection or collections[0]
+            collection = st.selectbox("📚 知识库", collections, index=collections.index(current))
+            st.session_state.collection = collection
+            with st.expander("➕ 新建知识库"):
+                new_name = st.text_input("名称", placeholder="如 legal、team-a (字母 / 数字 / . _ -)")
+                if st.button("创建") and new_name:
+                    try:
+                        # 集合在第一次上传时才真正创建
+                        st.session_state.collection = check_collection(new_name.strip())
+                        st.rerun()
+                    except ValueError as e:
+                        st.warning(str(e))
+
             # 2. 知识库上传
             st.subheader("2. 导入文档")
             files = st.file_uploader("上传 PDF/Word", accept_multiple_files=True)
+            upload_tags = st.text_input("标签 (可选，逗号分隔)", placeholder="如 合同, 2024")
             if st.button("🚀 存入知识库", type="primary") and files:
-                if not emb_key: st.stop()
-                embedder = load_embedder(emb_key, emb_base, emb_model)
-                total = 0
-                prog = st.progress(0)
-                for i, f in enumerate(files):
-                    fc, fv, _ = process_file(embedder, f.name, f.getvalue())
-                    if fc: total += add_to_db(fc, fv)
-                    prog.progress((i + 1) / len(files))
-                if total > 0: st.success(f"存入 {total} 片段")
-                st.rerun()
+                if not status["rag"]: st.stop()
+                # 交给后台任务队列：页面不阻塞，刷新页面也不会中断入库；检索照常使用已写入的内容
+                job_id = service.submit_ingest([(f.name, f.getvalue()) for f in files],
+                                               collection=collection, tags=upload_tags)
+                st.session_state.watching_jobs.add(job_id)
+                st.success("已加入后台入库队列，入库期间可以正常提问")
+            render_jobs(service)
+            while st.session_state.job_notices:
+                render_job_notice(st.session_state.job_notices.pop(0))
 
             # 3. 文件管理列表
             st.subheader("3. 文件管理")
-            existing_files = get_all_files()
+            records = service.file_records(collection)
+            existing_files = [r["name"] for r in records]
             if existing_files:
                 with st.expander(f"已存储 {len(existing_files)} 个文件", expanded=False):
                     for f in existing_files:
                         c1, c2 = st.columns([0.85, 0.15])
                         c1.text(f[:20] + "..." if len(f) > 20 else f)
                         if c2.button("🗑️", key=f"del_{f}"):
-                            delete_file_from_db(f)
-                            st.rerun()
-                if st.button("💣 清空所有数据"):
-                    reset_db()
-                    st.rerun()
+                            try:
+                                service.delete_file(f, collection=collection)
+                                st.rerun()
+                            except TimeoutError as e:
+                                st.warning(str(e))
+                saved = service.dedup_report(collection)
+                if saved["duplicate_chunks"]:
+                    st.caption(f"♻️ 近重复去重: {saved['files_with_duplicates']} 个文件中的 "
+                               f"{saved['duplicate_chunks']} 个片段只记录出处，"
+                               f"节省约 {saved['tokens_saved']} token / {saved['vector_bytes_saved'] / 1024:.0f} KB 向量")
+                if st.button("💣 清空当前知识库"):
+                    try:
+                        service.reset(collection)
+                        st.rerun()
+                    except TimeoutError as e:
+                        st.warning(str(e))
             else:
                 st.caption("知识库为空")
 
+            # 检索范围：在向量检索之前按文件筛选，候选更少、重排更快
+            all_tags = sorted({t for r in records for t in r["tags"]})
+            with st.expander("🎯 检索范围", expanded=False):
+                scope_files = st.multiselect("只检索这些文件", existing_files)
+                scope_tags = st.multiselect("只检索带这些标签的文件", all_tags) if all_tags else []
+                date_from = date_to = None
+                if st.toggle("按上传日期筛选"):
+                    c1, c2 = st.columns(2)
+                    date_from = c1.date_input("起", value=None)
+                    date_to = c2.date_input("止", value=None)
+                since, until = day_range(date_from, date_to)
+            if scope_files or scope_tags or since or until:
+                in_scope = service.scope_files(collection, scope_files, scope_tags, since, until)
+                st.caption(f"🎯 检索范围: {len(in_scope)} / {len(existing_files)} 个文件")
+
             st.divider()
 
             # 4. 🟢 优化：高级参数设置 (带详细说明)
@@ -89,6 +243,7 @@ def main():
                 * **创造性**: 越低越严谨(适合科研)，越高越发散(适合创意)。
                 * **粗排 (Recall)**: 从数据库里先捞出多少条“可能相关”的内容。
                 * **精排 (Rerank)**: 让 AI 老师仔细打分，最终给大模型看前几名。
+                * **上下文预算**: 相邻片段合并、重复片段去掉后，最多给大模型看多少内容。
                 """)
 
                 temperature = st.slider(
@@ -96,14 +251,24 @@ def main():
                     help="建议：科研查询设为 0.1，日常对话设为 0.7"
                 )
                 top_k_recall = st.slider(
-                    "粗排数量 (Recall)", 10, 100, 50,
-                    help="增加此值可减少漏找，但会增加 Rerank 时间"
+                    "粗排数量 (Recall)", 10, 100, 30,
+                    help="向量 + 关键词双路召回后融合的数量。增加此值可减少漏找，但会增加 Rerank 时间"
                 )
                 top_k_rerank = st.slider(
                     "精排数量 (Rerank)", 1, 10, 5,
                     help="最终喂给 DeepSeek 的片段数。建议 5 左右，太多会干扰模型"
                 )
+                token_budget = st.slider(
+                    "上下文预算 (Tokens)", 500, 8000, 3000, 250,
+                    help="本地片段合并去重后最多占用的 token 数。越小回答越快、越省钱"
+                )
                 use_web = st.toggle("联网增强", value=False)
+                answer_threshold = service.answer_cache_threshold
+                use_answer_cache = st.toggle(
+                    "答案缓存", value=answer_threshold is not None,
+                    help="相似问题检索到相同上下文时，直接回放之前的回答 (不再调用 DeepSeek)。"
+                         "引用的文件被删除或重新上传后自动失效"
+                )
 
             if st.button("➕ 新建对话"):
                 st.session_state.messages = []
@@ -112,7 +277,7 @@ def main():
 
         # === Tab 2: 历史 ===
         with tab2:
-            for chat in get_history_list():
+            for chat in get_history_list(limit=st.session_state.history_limit):
                 c1, c2 = st.columns([0.85, 0.15])
                 label = f"**{chat['title']}**\n\n_{chat['timestamp'][5:-3]}_"
                 if c1.button(label, key=f"h_{chat['id']}", use_container_width=True):
@@ -122,91 +287,130 @@ def main():
                 if c2.button("❌", key=f"d_{chat['id']}"):
                     delete_chat(chat['id'])
                     st.rerun()
+            if count_history() > st.session_state.history_limit:
+                if st.button("加载更多", use_container_width=True):
+                    st.session_state.history_limit += 30
+                    st.rerun()
 
     # --- 🟢 优化：聊天主界面 (支持历史引用渲染) ---
-    for msg in st.session_state.messages:
+    for i, msg in enumerate(st.session_state.messages):
         with st.chat_message(msg["role"]):
             st.write(msg["content"])
-            # 关键修改：如果历史消息里包含 sources 字段，则渲染折叠框
-            if "sources" in msg and msg["sources"]:
+            # 新版消息只保存片段引用，展开时才从向量库取回原文
+            if msg.get("refs"):
+                render_refs(msg["refs"], key=f"refs_{st.session_state.current_chat_id}_{i}")
+            # 兼容旧版：历史消息里直接保存了 sources 原文
+            elif "sources" in msg and msg["sources"]:
                 with st.expander("📖 查看引用片段 (Source Context)"):
                     st.info(msg["sources"])
 
     query = st.chat_input("向知识库提问...")
+    # 点了“重新生成”：重新提问上一个问题，跳过答案缓存
+    regenerate = st.session_state.pop("regenerate", None)
+    if query:
+        regenerate = None
+    elif regenerate:
+        query = regenerate
 
     if query:
         st.session_state.messages.append({"role": "user", "content": query})
         with st.chat_message("user"):
             st.write(query)
 
-        local_context = ""
-        web_context = ""
-
-        # 可视化思考过程
-        with st.status("🚀 AI 正在深度思考...", expanded=True) as status:
-
-            # Step 1: 本地检索
-            if get_collection().count() > 0:
-                st.write("📚 正在检索本地知识库...")
-                embedder = load_embedder(emb_key, emb_base, emb_model)
-                reranker = load_reranker(rerank_key, rerank_base, rerank_model)
-
-                local_context = search_vectors(
-                    embedder, query, reranker,
+        # 整个查询记为一次追踪：检索 / 重排 / 联网 / 生成各阶段分别计时
+        with start_trace("query") as trace:
+            # 可视化思考过程：本地检索与联网搜索并发执行，每完成一个阶段就更新状态
+            with st.status("🚀 AI 正在深度思考...", expanded=True) as progress:
+                # 多轮对话：历史压缩成记忆 (最近几轮 + 摘要)，追问改写成独立问题后再检索
+                search_query, memory = service.prepare_query(
+                    query, st.session_state.messages[:-1], chat_id=st.session_state.current_chat_id
+                )
+                if search_query != query:
+                    st.write(f"💬 结合上下文，检索问题: {search_query}")
+
+                has_local = status["rag"] and service.has_documents(collection)
+                if has_local:
+                    st.write("📚 正在检索本地知识库...")
+                if use_web and status["web"]:
+                    st.write("🌍 正在扫描互联网最新信息...")
+
+                def on_stage(name, state, elapsed):
+                    if name == "local":
+                        if state == "ok":
+                            st.write(f"✅ 本地检索完成，已重排序 ({elapsed:.1f}s)")
+                        elif state == "timeout":
+                            st.write(f"⏱️ 本地检索超时 ({elapsed:.1f}s)，已跳过")
+                        else:
+                            st.write("⚠️ 本地检索失败，已跳过")
+                    else:
+                        if state == "ok":
+                            st.write(f"✅ 互联网数据获取成功 ({elapsed:.1f}s)")
+                        elif state == "timeout":
+                            st.write(f"⏱️ 联网搜索超时 ({elapsed:.1f}s)，已跳过")
+                        else:
+                            st.write("⚠️ 联网搜索失败，已跳过")
+
+                retrieved = service.retrieve(
+                    search_query,
                     top_k_recall=top_k_recall,
-                    top_k_rerank=top_k_rerank
+                    top_k_rerank=top_k_rerank,
+                    token_budget=token_budget,
+                    use_web=use_web,
+                    on_stage=on_stage,
+                    collection=collection,
+                    files=scope_files,
+                    tags=scope_tags,
+                    since=since,
+                    until=until
                 )
-                if local_context:
-                    st.write(f"✅ 找到 {top_k_rerank} 个相关片段 (已重排序)")
-                else:
+                local_context = retrieved["local"]
+                if has_local and not local_context:
                     st.write("⚠️ 本地未找到足够相关内容")
 
-            # Step 2: 联网搜索
-            if use_web and tavily_key:
-                st.write("🌍 正在扫描互联网最新信息...")
-                web_context = search_web(query, tavily_key)
-                st.write("✅ 互联网数据获取成功")
-
-            status.update(label="🧠 思考完成，正在生成回答", state="complete", expanded=False)
-
-        # 组装 Prompt
-        prompt = ""
-        if local_context: prompt += f"【本地知识】:\n{local_context}\n\n"
-        if web_context: prompt += f"【网络信息】:\n{web_context}\n\n"
-
-        system_prompt = f"请基于以下背景回答问题。必须标注来源 [来源: xxx]。\n\n{prompt}"
-
-        # 生成回答
-        client = OpenAI(api_key=ds_key, base_url=ds_url)
-        with st.chat_message("assistant"):
-            try:
-                stream = client.chat.completions.create(
-                    model="deepseek-chat",
-                    messages=[
-                        {"role": "system", "content": system_prompt},
-                        {"role": "user", "content": query}
-                    ],
-                    temperature=temperature,
-                    stream=True
-                )
-                response = st.write_stream(stream)
-
-                # 🟢 优化：保存时将 sources 也存入 history
-                message_data = {
-                    "role": "assistant",
-                    "content": response,
-                    "sources": local_context  # 将引用内容持久化保存
-                }
-                st.session_state.messages.append(message_data)
-                save_chat(st.session_state.current_chat_id, st.session_state.messages)
-
-                # 当前轮次的引用展示 (为了即时反馈)
-                if local_context:
-                    with st.expander("📖 查看引用片段 (Source Context)"):
-                        st.info(local_context)
-
-            except Exception as e:
-                st.error(f"Error: {e}")
+                progress.update(label="🧠 思考完成，正在生成回答", state="complete", expanded=False)
+
+            # 生成回答 (开启答案缓存时先查缓存，命中则回放之前的回答)
+            cached = None
+            if use_answer_cache and not regenerate:
+                cached = service.cached_answer(search_query, retrieved, temperature=temperature,
+                                               threshold=answer_threshold)
+            with st.chat_message("assistant"):
+                try:
+                    if cached:
+                        response = st.write_stream(replay(cached["answer"]))
+                        refs = cached["refs"]
+                    else:
+                        response = st.write_stream(service.stream_answer(query, retrieved, temperature=temperature,
+                                                                         memory=memory))
+                        refs = retrieved["local_refs"]
+                        # 重新生成的回答不写回缓存：被拒绝的那条已删除，下一次相似提问时再正常缓存
+                        if use_answer_cache and not regenerate:
+                            service.cache_answer(search_query, retrieved, temperature, response,
+                                                 collection=collection)
+
+                    # 🟢 优化：history 中只保存片段引用 (ID / 来源 / 页码 / 分数)，不保存原文
+                    st.session_state.messages = service.record_answer(
+                        st.session_state.current_chat_id, st.session_state.messages, response, refs
+                    )
+
+                    if cached:
+                        c1, c2 = st.columns([0.8, 0.2])
+                        c1.caption(f"⚡ 缓存回答 (相似问题: {cached['query']}，相似度 {cached['similarity']:.2f})")
+                        c2.button("🔄 重新生成", on_click=request_regenerate,
+                                   args=(service, query, cached["id"]))
+
+                    # 当前轮次的引用展示 (为了即时反馈)
+                    if local_context:
+                        with st.expander("📖 查看引用片段 (Source Context)"):
+                            st.info(local_context)
+
+                except Exception as e:
+                    st.error(f"Error: {e}")
+
+        st.session_state.last_trace = trace.to_dict()
+
+    if st.session_state.get("last_trace"):
+        render_debug(st.session_state.last_trace, startup.profile())
 
 
 if __name__ == "__main__":
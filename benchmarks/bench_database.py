@@ -0,0 +1,76 @@
+"""
+数据库访问微基准：对比「每次调用新建 PersistentClient」与「进程级常驻句柄」
+在 query_db 和 count() 上的单次调用延迟
+
+用法: python -m benchmarks.bench_database --chunks 5000 --calls 200
+"""
+import argparse
+import shutil
+import statistics
+import tempfile
+import time
+
+import chromadb
+import numpy as np
+
+from modules import database
+
+
+def fresh_collection():
+    """旧实现：每次调用都新建客户端并打开集合"""
+    client = chromadb.PersistentClient(path=database.DB_PATH)
+    return client.get_or_create_collection(
+        name=database.COLLECTION_NAME,
+        metadata={"hnsw:space": "cosine"}
+    )
+
+
+def timed(fn, calls):
+    """返回每次调用耗时 (毫秒) 的列表"""
+    samples = []
+    for _ in range(calls):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+
+def summarize(name, samples):
+    samples = sorted(samples)
+    p50 = statistics.median(samples)
+    p95 = samples[int(len(samples) * 0.95) - 1]
+    print(f"{name:<28} p50 {p50:8.3f} ms   p95 {p95:8.3f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--chunks", type=int, default=5000)
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--calls", type=int, default=200)
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix="bench_chroma_")
+    database.DB_PATH = tmp
+    try:
+        rng = np.random.default_rng(0)
+        vectors = rng.standard_normal((args.chunks, args.dim)).astype(np.float32)
+        chunks = [{"content": f"chunk {i}", "source": f"doc{i % 50}.pdf", "page": i % 30}
+                  for i in range(args.chunks)]
+        for i in range(0, args.chunks, 1000):
+            database.add_to_db(chunks[i: i + 1000], vectors[i: i + 1000])
+        query = vectors[0]
+
+        def fresh_query():
+            fresh_collection().query(query_embeddings=[query.tolist()], n_results=10)
+
+        print(f"chunks={args.chunks} dim={args.dim} calls={args.calls}")
+        summarize("count()   新建客户端", timed(lambda: fresh_collection().count(), args.calls))
+        summarize("count()   常驻句柄", timed(lambda: database.get_store().count(), args.calls))
+        summarize("query_db  新建客户端", timed(fresh_query, args.calls))
+        summarize("query_db  常驻句柄", timed(lambda: database.query_db(query, top_k=10), args.calls))
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""
+向量库后端对比：Chroma (HNSW) vs NumPy memmap (float16 / int8 精确检索)
+
+    python -m benchmarks.bench_vector_store --chunks 50000 --dim 384 --queries 200
+
+在带簇结构的合成向量上比较写入吞吐、单条 / 批量检索延迟、recall@k (以 float32 暴力检索为准)、
+磁盘占用，以及 memmap 删除后的压缩耗时
+"""
+import argparse
+import os
+import shutil
+import statistics
+import tempfile
+import time
+
+import chromadb
+import numpy as np
+
+from modules.memmap_store import MemmapStore
+from modules.vector_store import ChromaStore
+
+
+def synthetic_vectors(rng, n, dim, clusters=64):
+    """簇中心 + 噪声，近似真实 embedding 的分布"""
+    centers = rng.standard_normal((clusters, dim)).astype(np.float32)
+    labels = rng.integers(0, clusters, n)
+    vectors = centers[labels] + 0.6 * rng.standard_normal((n, dim)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def exact_top_k(vectors, queries, k):
+    scores = queries @ vectors.T
+    return [set(np.argsort(-row)[:k]) for row in scores]
+
+
+def dir_size_mb(path):
+    total = 0
+    for root, _, names in os.walk(path):
+        total += sum(os.path.getsize(os.path.join(root, n)) for n in names)
+    return total / 1024 / 1024
+
+
+def ms_stats(samples):
+    ordered = sorted(samples)
+    return statistics.median(ordered), ordered[max(0, int(len(ordered) * 0.95) - 1)]
+
+
+def bench_store(name, store, path, vectors, queries, truth, k):
+    ids = [str(i) for i in range(len(vectors))]
+    start = time.perf_counter()
+    for i in range(0, len(vectors), 1000):
+        batch = range(i, min(i + 1000, len(vectors)))
+        store.upsert([ids[j] for j in batch], vectors[batch.start: batch.stop],
+                     [{"source": f"doc{j % 100}.pdf", "page": str(j % 30)} for j in batch],
+                     [f"chunk {j}" for j in batch])
+    insert_s = time.perf_counter() - start
+
+    latencies, hits = [], 0
+    for q, expected in zip(queries, truth):
+        t0 = time.perf_counter()
+        result = store.query(q[None, :], n_results=k)[0]
+        latencies.append((time.perf_counter() - t0) * 1000)
+        hits += len({int(r["id"]) for r in result} & expected)
+
+    t0 = time.perf_counter()
+    store.query(queries, n_results=k)
+    batch_ms = (time.perf_counter() - t0) * 1000
+
+    p50, p95 = ms_stats(latencies)
+    print(f"{name:<8} 写入 {len(vectors) / insert_s:9.0f} 条/s | 单条检索 p50 {p50:7.2f} ms p95 {p95:7.2f} ms | "
+          f"批量 {len(queries)} 条 {batch_ms:8.1f} ms | recall@{k} {hits / (len(queries) * k):.4f} | "
+          f"磁盘 {dir_size_mb(path):7.1f} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="向量库后端对比")
+    parser.add_argument("--chunks", type=int, default=50000)
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    vectors = synthetic_vectors(rng, args.chunks, args.dim)
+    queries = vectors[rng.choice(args.chunks, args.queries, replace=False)] + \
+        0.1 * rng.standard_normal((args.queries, args.dim)).astype(np.float32)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    truth = exact_top_k(vectors, queries, args.top_k)
+    print(f"chunks={args.chunks} dim={args.dim} queries={args.queries} top_k={args.top_k}")
+
+    dirs = []
+    try:
+        path = tempfile.mkdtemp(prefix="bench_chroma_")
+        dirs.append(path)
+        chroma = ChromaStore(chromadb.PersistentClient(path=path), "bench_store")
+        bench_store("chroma", chroma, path, vectors, queries, truth, args.top_k)
+
+        for dtype in ("float16", "int8"):
+            path = tempfile.mkdtemp(prefix="bench_memmap_")
+            dirs.append(path)
+            memmap = MemmapStore(path, dtype=dtype, auto_compact=False)
+            bench_store(dtype, memmap, path, vectors, queries, truth, args.top_k)
+
+            # 删除 40% 的文件后压缩
+            t0 = time.perf_counter()
+            memmap.delete(where={"source": {"$in": [f"doc{j}.pdf" for j in range(40)]}})
+            delete_ms = (time.perf_counter() - t0) * 1000
+            t0 = time.perf_counter()
+            reclaimed = memmap.compact()
+            compact_ms = (time.perf_counter() - t0) * 1000
+            print(f"{'':<8} 删除 {reclaimed} 行 {delete_ms:.1f} ms | 压缩 {compact_ms:.1f} ms | "
+                  f"压缩后 {memmap.stats()['segments']} 段 {dir_size_mb(path):.1f} MB")
+    finally:
+        for path in dirs:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
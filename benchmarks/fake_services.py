@@ -0,0 +1,176 @@
+"""
+离线基准测试用的本地服务替身 (无需任何真实 API Key)
+- POST /v1/embeddings        OpenAI 兼容向量接口，按文本哈希生成确定性向量
+- POST /v1/chat/completions  OpenAI 兼容对话接口，支持 SSE 流式输出
+- POST /rerank               SiliconFlow 风格重排接口，按词重叠打分
+- POST /search               Tavily 风格搜索接口
+- GET  /v1/models, HEAD 任意路径: 预热 (建立连接) 用的轻量请求
+每个接口的延迟可单独配置
+"""
+import hashlib
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+
+def fake_vector(text, dim):
+    """按文本哈希生成归一化向量：相同文本总是得到相同向量"""
+    seed = int(hashlib.md5(text.encode("utf-8")).hexdigest()[:8], 16)
+    vec = np.random.default_rng(seed).standard_normal(dim)
+    return (vec / np.linalg.norm(vec)).tolist()
+
+
+class FakeConfig:
+    def __init__(self, dim=256, embed_latency=0.02, rerank_latency=0.05, search_latency=0.3,
+                 ttft=0.3, token_latency=0.01, answer_tokens=60):
+        self.dim = dim
+        self.embed_latency = embed_latency
+        self.rerank_latency = rerank_latency
+        self.search_latency = search_latency
+        self.ttft = ttft
+        self.token_latency = token_latency
+        self.answer_tokens = answer_tokens
+        self.calls = {"embeddings": 0, "chat": 0, "rerank": 0, "search": 0}
+        self.lock = threading.Lock()
+
+    def count(self, name):
+        with self.lock:
+            self.calls[name] += 1
+
+
+def _make_handler(config):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # 头部与正文分两次写出，keep-alive 连接上需关闭 Nagle，否则与客户端的延迟确认叠加出 40ms 停顿
+        disable_nagle_algorithm = True
+
+        def log_message(self, *args):
+            pass
+
+        def _json(self, payload, status=200):
+            body = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path.endswith("/models"):
+                self._json({"object": "list", "data": [{"id": "fake", "object": "model", "owned_by": "fake"}]})
+            else:
+                self._json({"error": "not found"}, status=404)
+
+        def do_HEAD(self):
+            self.send_response(200)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            body = json.loads(self.rfile.read(length) or b"{}")
+
+            if self.path.endswith("/embeddings"):
+                config.count("embeddings")
+                time.sleep(config.embed_latency)
+                inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+                self._json({
+                    "object": "list",
+                    "model": body.get("model", "fake-embedding"),
+                    "data": [{"object": "embedding", "index": i, "embedding": fake_vector(t, config.dim)}
+                             for i, t in enumerate(inputs)],
+                    "usage": {"prompt_tokens": 0, "total_tokens": 0},
+                })
+            elif self.path.endswith("/chat/completions"):
+                config.count("chat")
+                self._chat(body)
+            elif self.path.endswith("/rerank"):
+                config.count("rerank")
+                time.sleep(config.rerank_latency)
+                query_terms = set(body["query"].lower().split())
+                scored = []
+                for i, doc in enumerate(body["documents"]):
+                    terms = set(doc.lower().split())
+                    scored.append({"index": i, "relevance_score": len(query_terms & terms) / (len(query_terms) or 1)})
+                scored.sort(key=lambda x: x["relevance_score"], reverse=True)
+                self._json({"results": scored[: body.get("top_n", 5)]})
+            elif self.path.endswith("/search"):
+                config.count("search")
+                time.sleep(config.search_latency)
+                query = body.get("query", "")
+                self._json({
+                    "query": query,
+                    "results": [
+                        {"title": f"结果 {i}", "url": f"https://example.com/{i}",
+                         "content": f"关于 {query} 的网络摘要 {i}", "score": 1.0 - i * 0.1}
+                        for i in range(body.get("max_results", 3))
+                    ],
+                })
+            else:
+                self._json({"error": "not found"}, status=404)
+
+        def _chat(self, body):
+            created = int(time.time())
+            if not body.get("stream"):
+                time.sleep(config.ttft + config.token_latency * config.answer_tokens)
+                self._json({
+                    "id": "chatcmpl-fake", "object": "chat.completion", "created": created,
+                    "model": body.get("model"),
+                    "choices": [{"index": 0, "finish_reason": "stop",
+                                 "message": {"role": "assistant", "content": "答" * config.answer_tokens}}],
+                })
+                return
+
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            time.sleep(config.ttft)
+            for i in range(config.answer_tokens):
+                chunk = {
+                    "id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": created,
+                    "model": body.get("model"),
+                    "choices": [{"index": 0, "delta": {"content": "答"}, "finish_reason": None}],
+                }
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+                self.wfile.flush()
+                time.sleep(config.token_latency)
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+            self.close_connection = True
+
+    return Handler
+
+
+class FakeServices:
+    """在后台线程中启动全部替身服务"""
+
+    def __init__(self, config=None, host="127.0.0.1", port=0):
+        self.config = config or FakeConfig()
+        self.server = ThreadingHTTPServer((host, port), _make_handler(self.config))
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def openai_url(self):
+        return f"{self.base_url}/v1"
+
+    @property
+    def rerank_url(self):
+        return f"{self.base_url}/rerank"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
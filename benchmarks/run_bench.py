@@ -0,0 +1,301 @@
+"""
+离线性能基准：启动本地服务替身，在合成语料上跑完整的入库 / 检索 / 生成 / 历史记录流程
+
+    python -m benchmarks.run_bench --chunks 1000 --queries 50
+    python -m benchmarks.run_bench --chunks 100000 --queries 200 --compare latest
+
+输出入库吞吐、各检索阶段延迟分位数、峰值内存，结果保存在 benchmarks/results/，
+可用 --compare 与之前的结果对比 (不同提交之间的回归检测)
+"""
+import argparse
+import glob
+import json
+import os
+import random
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+_WORDS = ["alpha", "beta", "gamma", "delta", "sigma", "omega", "kernel", "vector", "index", "query",
+          "latency", "throughput", "cache", "shard", "replica", "token", "model", "rerank", "recall",
+          "XJ-9000", "RFC-2616", "知识库", "向量", "检索", "重排序", "模型", "文档", "缓存", "延迟", "吞吐"]
+
+
+def synthetic_text(rng, n_chars):
+    words = []
+    size = 0
+    while size < n_chars:
+        w = rng.choice(_WORDS) + (str(rng.randrange(1000)) if rng.random() < 0.1 else "")
+        words.append(w)
+        size += len(w) + 1
+    return " ".join(words)
+
+
+def percentiles(samples):
+    """毫秒级分位数"""
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+
+    def pick(q):
+        return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+    return {
+        "count": len(ordered),
+        "mean": statistics.fmean(ordered),
+        "p50": pick(0.50),
+        "p95": pick(0.95),
+        "p99": pick(0.99),
+        "max": ordered[-1],
+    }
+
+
+def timed(samples, fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    samples.append((time.perf_counter() - start) * 1000)
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)), text=True, stderr=subprocess.DEVNULL
+        ).strip()
+    except Exception:
+        return "unknown"
+
+
+def peak_rss_mb():
+    # Linux 上 ru_maxrss 单位为 KB，macOS 上为字节
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024 / 1024 if sys.platform == "darwin" else rss / 1024
+
+
+def bench_ingest(args, services, rng):
+    from modules.database import add_to_db
+    from modules.embedder import APIEmbedder
+    from modules.ingest import ingest_file
+    from modules.processor import TEXT_CHUNK_SIZE, TEXT_OVERLAP, process_file
+
+    embedder = APIEmbedder("fake-key", services.openai_url, "fake-embedding")
+    step = TEXT_CHUNK_SIZE - TEXT_OVERLAP
+    docs = max(1, args.chunks // args.chunks_per_doc)
+    doc_chars = args.chunks_per_doc * step
+
+    total_chunks = 0
+    per_doc = []
+    start = time.perf_counter()
+    for i in range(docs):
+        data = synthetic_text(rng, doc_chars).encode("utf-8")
+        name = f"doc_{i:06d}.txt"
+        t0 = time.perf_counter()
+        if args.stream:
+            total_chunks += ingest_file(embedder, name, data)["added"]
+        else:
+            chunks, vectors, error = process_file(embedder, name, data)
+            if error:
+                raise RuntimeError(error)
+            total_chunks += add_to_db(chunks, vectors)
+        per_doc.append((time.perf_counter() - t0) * 1000)
+        if (i + 1) % max(1, docs // 10) == 0:
+            print(f"  入库 {i + 1}/{docs} 文档, {total_chunks} 片段")
+    elapsed = time.perf_counter() - start
+
+    return {
+        "documents": docs,
+        "chunks": total_chunks,
+        "seconds": elapsed,
+        "chunks_per_second": total_chunks / elapsed if elapsed else 0.0,
+        "per_document_ms": percentiles(per_doc),
+    }
+
+
+def bench_query(args, services, rng):
+    from openai import OpenAI
+
+    from modules import query_cache
+    from modules.database import query_db, search_lexical
+    from modules.embedder import APIEmbedder
+    from modules.reranker import APIReranker
+    from modules.retriever import search_vectors
+    from modules.web_search import search_web
+
+    embedder = APIEmbedder("fake-key", services.openai_url, "fake-embedding")
+    reranker = APIReranker("fake-key", services.rerank_url, "fake-rerank")
+    llm = OpenAI(api_key="fake-key", base_url=services.openai_url)
+
+    stages = {name: [] for name in
+              ("embed", "query_db", "lexical", "rerank", "web_search", "search_vectors", "llm_ttft", "llm_total")}
+    for _ in range(args.queries):
+        query = " ".join(rng.choice(_WORDS) for _ in range(rng.randint(2, 5)))
+        # 随机查询可能重复，清空查询缓存，各阶段测的都是未命中时的耗时
+        query_cache.clear()
+
+        q_vec = timed(stages["embed"], embedder.encode, [query])[0]
+        candidates = timed(stages["query_db"], query_db, q_vec, top_k=args.top_k_recall)
+        timed(stages["lexical"], search_lexical, query, top_k=args.top_k_recall)
+        timed(stages["rerank"], reranker.rerank, query, candidates, top_k=args.top_k_rerank)
+        timed(stages["web_search"], search_web, query, "fake-key", base_url=services.base_url)
+        context = timed(stages["search_vectors"], search_vectors, embedder, query, reranker,
+                        top_k_recall=args.top_k_recall, top_k_rerank=args.top_k_rerank)
+
+        start = time.perf_counter()
+        stream = llm.chat.completions.create(
+            model="deepseek-chat",
+            messages=[{"role": "system", "content": context}, {"role": "user", "content": query}],
+            stream=True,
+        )
+        first = None
+        for chunk in stream:
+            if first is None and chunk.choices and chunk.choices[0].delta.content:
+                first = time.perf_counter()
+        end = time.perf_counter()
+        stages["llm_ttft"].append(((first or end) - start) * 1000)
+        stages["llm_total"].append((end - start) * 1000)
+
+    return {name: percentiles(samples) for name, samples in stages.items()}
+
+
+def bench_history(args, rng):
+    from modules.history import get_history_list, load_chat, save_chat
+
+    save, listing, load = [], [], []
+    chat_ids = []
+    for i in range(args.chats):
+        chat_id = str(uuid.uuid4())
+        chat_ids.append(chat_id)
+        messages = []
+        for turn in range(args.turns):
+            messages.append({"role": "user", "content": synthetic_text(rng, 40)})
+            messages.append({"role": "assistant", "content": synthetic_text(rng, 400),
+                             "refs": [{"id": uuid.uuid4().hex, "source": "doc.txt", "page": "N/A", "score": 0.5}]})
+            timed(save, save_chat, chat_id, messages)
+    for _ in range(50):
+        timed(listing, get_history_list)
+        timed(load, load_chat, rng.choice(chat_ids))
+    return {"save_chat": percentiles(save), "get_history_list": percentiles(listing),
+            "load_chat": percentiles(load)}
+
+
+def load_result(path):
+    if path == "latest":
+        files = sorted(glob.glob(os.path.join(RESULTS_DIR, "*.json")))
+        if not files:
+            return None
+        path = files[-1]
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def compare(current, previous):
+    """打印与之前结果的对比 (p50 / p95 / 吞吐的变化百分比)"""
+    print(f"\n对比基线: {previous.get('commit')} @ {previous.get('timestamp')}")
+
+    def delta(new, old):
+        if not old:
+            return "   n/a"
+        return f"{(new - old) / old * 100:+6.1f}%"
+
+    old_rate = previous.get("ingest", {}).get("chunks_per_second", 0)
+    new_rate = current["ingest"]["chunks_per_second"]
+    print(f"入库吞吐        {new_rate:10.1f} 片段/s  {delta(new_rate, old_rate)}")
+    for section in ("query", "history"):
+        for name, stats in current[section].items():
+            old = previous.get(section, {}).get(name) or {}
+            if not stats:
+                continue
+            print(f"{name:<16} p50 {stats['p50']:9.2f} ms {delta(stats['p50'], old.get('p50'))}   "
+                  f"p95 {stats['p95']:9.2f} ms {delta(stats['p95'], old.get('p95'))}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="离线性能基准 (本地服务替身 + 合成语料)")
+    parser.add_argument("--chunks", type=int, default=1000, help="合成语料片段数 (1k ~ 1M)")
+    parser.add_argument("--chunks-per-doc", type=int, default=50)
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--chats", type=int, default=200)
+    parser.add_argument("--turns", type=int, default=5)
+    parser.add_argument("--top-k-recall", type=int, default=30)
+    parser.add_argument("--top-k-rerank", type=int, default=5)
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--embed-latency-ms", type=float, default=20)
+    parser.add_argument("--rerank-latency-ms", type=float, default=50)
+    parser.add_argument("--search-latency-ms", type=float, default=300)
+    parser.add_argument("--ttft-ms", type=float, default=300)
+    parser.add_argument("--stream", action="store_true", help="使用 ingest_file 流式管线入库")
+    parser.add_argument("--trace-memory", action="store_true", help="用 tracemalloc 统计 Python 堆峰值 (较慢)")
+    parser.add_argument("--compare", help="对比的历史结果文件，或 latest")
+    parser.add_argument("--no-save", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from benchmarks.fake_services import FakeConfig, FakeServices
+
+    previous = load_result(args.compare) if args.compare else None
+
+    config = FakeConfig(dim=args.dim, embed_latency=args.embed_latency_ms / 1000,
+                        rerank_latency=args.rerank_latency_ms / 1000,
+                        search_latency=args.search_latency_ms / 1000, ttft=args.ttft_ms / 1000)
+    services = FakeServices(config).start()
+
+    # 所有存储都使用相对路径，切到临时目录运行，不污染真实数据
+    workdir = tempfile.mkdtemp(prefix="rag_bench_")
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    rng = random.Random(args.seed)
+    if args.trace_memory:
+        tracemalloc.start()
+    try:
+        print(f"[1/3] 入库 {args.chunks} 片段 ...")
+        ingest = bench_ingest(args, services, rng)
+        print(f"[2/3] 检索 / 生成 {args.queries} 次查询 ...")
+        query = bench_query(args, services, rng)
+        print(f"[3/3] 历史记录 {args.chats} 个对话 ...")
+        history = bench_history(args, rng)
+        heap_peak = tracemalloc.get_traced_memory()[1] / 1024 / 1024 if args.trace_memory else None
+    finally:
+        os.chdir(cwd)
+        services.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    result = {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "params": vars(args),
+        "ingest": ingest,
+        "query": query,
+        "history": history,
+        "memory": {"peak_rss_mb": peak_rss_mb(), "python_heap_peak_mb": heap_peak},
+        "service_calls": dict(config.calls),
+    }
+
+    print(f"\n入库: {ingest['chunks']} 片段 / {ingest['seconds']:.1f}s = {ingest['chunks_per_second']:.1f} 片段/s")
+    for section in ("query", "history"):
+        for name, stats in result[section].items():
+            print(f"{name:<16} p50 {stats['p50']:9.2f} ms   p95 {stats['p95']:9.2f} ms   p99 {stats['p99']:9.2f} ms")
+    print(f"峰值 RSS: {result['memory']['peak_rss_mb']:.1f} MB")
+
+    if not args.no_save:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        path = os.path.join(RESULTS_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}_{result['commit']}.json")
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"结果已保存: {path}")
+
+    if previous:
+        compare(result, previous)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+"""
+冷启动剖面与预算检查 (CI 用)：每一项都在全新的子进程中测量，不受模块缓存 / 连接池复用的影响
+
+    python -m benchmarks.startup_profile
+    python -m benchmarks.startup_profile --budget benchmarks/startup_budget.json   # 超出预算时退出码为 1
+
+测量项 (毫秒，多次测量取中位数)：
+    import      import modules.service (chromadb / openai 等重依赖应延迟到首次使用时导入)
+    cold_query  不预热时进程内第一个查询的检索耗时
+    warm_up     预热 (向量库索引 / 关键词索引 / 客户端与连接池) 的总耗时
+    warm_query  预热完成后第一个查询的检索耗时
+外部服务使用本地替身 (benchmarks/fake_services.py)，知识库为临时目录中的合成语料
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+METRICS = ("import", "cold_query", "warm_up", "warm_query")
+
+
+def child_seed(args):
+    """子进程：在当前目录生成合成语料并入库"""
+    from benchmarks.run_bench import synthetic_text
+    from modules.processor import TEXT_CHUNK_SIZE, TEXT_OVERLAP
+    from modules.service import RAGService
+
+    rng = random.Random(args.seed)
+    docs = max(1, args.chunks // 50)
+    files = [(f"doc_{i:04d}.txt", synthetic_text(rng, 50 * (TEXT_CHUNK_SIZE - TEXT_OVERLAP)).encode("utf-8"))
+             for i in range(docs)]
+    results = RAGService().ingest(files)
+    return {"chunks": sum(stats["added"] for _, stats in results)}
+
+
+def child_query(args, warm):
+    """子进程：测量导入耗时与第一个查询的检索耗时 (warm 时先同步预热)"""
+    start = time.perf_counter()
+    from modules.service import RAGService
+    result = {"import": (time.perf_counter() - start) * 1000}
+
+    service = RAGService()
+    if warm:
+        start = time.perf_counter()
+        result["steps"] = service.warm_up(background=False)
+        result["warm_up"] = (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    retrieved = service.retrieve(args.query, top_k_recall=30, top_k_rerank=5)
+    result["warm_query" if warm else "cold_query"] = (time.perf_counter() - start) * 1000
+    if not retrieved["local_refs"]:
+        raise RuntimeError("检索结果为空，语料未入库？")
+    return result
+
+
+def run_child(mode, env, workdir, args, query=None):
+    cmd = [sys.executable, "-m", "benchmarks.startup_profile", "--child", mode,
+           "--chunks", str(args.chunks), "--seed", str(args.seed)]
+    if query:
+        cmd += ["--query", query]
+    out = subprocess.run(cmd, env=env, cwd=workdir, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                         text=True, timeout=600)
+    lines = out.stdout.strip().splitlines()
+    if out.returncode != 0 or not lines:
+        raise RuntimeError(f"子进程 {mode} 失败 (退出码 {out.returncode})")
+    return json.loads(lines[-1])
+
+
+def check_budget(result, budget):
+    """返回超出预算的项 [(项目, 实测, 预算), ...]"""
+    return [(name, result[name], limit) for name, limit in budget.items()
+            if name in result and result[name] > limit]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="冷启动剖面 (导入 / 预热 / 首个查询耗时) 与预算检查")
+    parser.add_argument("--chunks", type=int, default=2000, help="合成语料片段数")
+    parser.add_argument("--repeat", type=int, default=3, help="每项测量次数，取中位数")
+    parser.add_argument("--backend", default="chroma", choices=("chroma", "memmap"))
+    parser.add_argument("--budget", help="预算 JSON 文件 {项目: 毫秒}，超出时退出码为 1")
+    parser.add_argument("--output", help="结果另存为 JSON")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--child", choices=("seed", "cold", "warm"), help=argparse.SUPPRESS)
+    parser.add_argument("--query", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        if args.child == "seed":
+            result = child_seed(args)
+        else:
+            result = child_query(args, warm=args.child == "warm")
+        print(json.dumps(result))
+        return 0
+
+    sys.path.insert(0, ROOT)
+    from benchmarks.fake_services import FakeServices
+    from benchmarks.run_bench import _WORDS
+
+    services = FakeServices().start()
+    env = dict(
+        os.environ, PYTHONPATH=ROOT, PARSE_WORKERS="1", VECTOR_BACKEND=args.backend,
+        EMBEDDING_API_KEY="fake-key", EMBEDDING_BASE_URL=services.openai_url, EMBEDDING_MODEL="fake-embedding",
+        RERANK_API_KEY="fake-key", RERANK_BASE_URL=services.rerank_url, RERANK_MODEL="fake-rerank",
+        DEEPSEEK_API_KEY="fake-key", DEEPSEEK_BASE_URL=services.openai_url,
+    )
+    # 所有存储都使用相对路径，在临时目录中运行，不污染真实数据
+    workdir = tempfile.mkdtemp(prefix="rag_startup_")
+    rng = random.Random(args.seed)
+    samples = {name: [] for name in METRICS}
+    steps = {}
+    try:
+        print(f"入库 {args.chunks} 片段 ({args.backend}) ...")
+        seeded = run_child("seed", env, workdir, args)
+        for i in range(args.repeat):
+            # 每次换一个问题，避免命中磁盘上的查询向量缓存
+            for mode in ("cold", "warm"):
+                query = " ".join(rng.choice(_WORDS) for _ in range(4)) + f" {mode}{i}"
+                result = run_child(mode, env, workdir, args, query=query)
+                for name in METRICS:
+                    if name in result:
+                        samples[name].append(result[name])
+                for name, ms in result.get("steps", {}).items():
+                    steps.setdefault(name, []).append(ms)
+    finally:
+        services.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    result = {name: statistics.median(values) for name, values in samples.items() if values}
+    report = {
+        "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "params": {"chunks": seeded["chunks"], "repeat": args.repeat, "backend": args.backend},
+        "profile": result,
+        "warm_up_steps": {name: statistics.median(values) for name, values in steps.items()},
+    }
+    for name, ms in result.items():
+        print(f"{name:<14}{ms:>10.1f} ms")
+    for name, ms in report["warm_up_steps"].items():
+        print(f"  {name:<22}{ms:>10.1f} ms")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    if args.budget:
+        with open(args.budget, encoding="utf-8") as f:
+            budget = json.load(f)
+        over = check_budget(result, budget)
+        for name, ms, limit in over:
+            print(f"❌ {name} 超出预算: {ms:.1f} ms > {limit} ms")
+        if over:
+            return 1
+        print("✅ 启动耗时均在预算内")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
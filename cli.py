@@ -0,0 +1,224 @@
+"""
+命令行入口 (无需浏览器，可用于 cron 定时入库)
+
+    python cli.py ingest docs/ paper.pdf --recursive --collection legal --tags 合同,2024
+    python cli.py query "什么是 RRF 融合?" --web
+    python cli.py query "违约金怎么算?" --collection legal --file 合同A.pdf --since 2024-01-01
+    python cli.py batch questions.txt -o results.jsonl
+    python cli.py files --collection legal
+    python cli.py jobs --active
+    python cli.py dedup --collection legal
+    python cli.py serve --port 8000 --workers 4
+
+配置与 Streamlit 共用 .streamlit/secrets.toml，也可用同名环境变量覆盖
+"""
+import argparse
+import os
+import sys
+
+SUPPORTED_EXTS = (".pdf", ".docx", ".txt")
+
+
+def collect_files(paths, recursive=False):
+    """展开目录，返回支持格式的文件路径列表"""
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            if recursive:
+                for root, _, names in os.walk(path):
+                    found.extend(os.path.join(root, n) for n in sorted(names))
+            else:
+                found.extend(os.path.join(path, n) for n in sorted(os.listdir(path)))
+        else:
+            found.append(path)
+    return [p for p in found if os.path.isfile(p) and p.lower().endswith(SUPPORTED_EXTS)]
+
+
+def cmd_ingest(service, args):
+    paths = collect_files(args.paths, recursive=args.recursive)
+    if not paths:
+        print("没有找到可入库的文件 (支持 PDF / DOCX / TXT)")
+        return 1
+
+    files = []
+    for path in paths:
+        with open(path, "rb") as f:
+            files.append((os.path.basename(path), f.read()))
+
+    def on_progress(i, done, estimate):
+        print(f"\r[{i + 1}/{len(files)}] {files[i][0]}: {done}/{estimate} 片段", end="", flush=True)
+
+    results = service.ingest(files, on_progress=on_progress, collection=args.collection, tags=args.tags)
+    print()
+    failed = 0
+    for name, stats in results:
+        if stats["error"]:
+            failed += 1
+            print(f"✗ {name}: {stats['error']}")
+        else:
+            print(f"✓ {name}: {stats['status']}, 新增 {stats['added']} 片段, "
+                  f"近重复 {stats.get('duplicates', 0)} 片段, "
+                  f"替换 {stats['replaced_pages']} 页, 删除 {stats['removed_pages']} 页")
+    return 1 if failed else 0
+
+
+def scope_args(args):
+    """命令行的检索范围参数 -> service.retrieve / batch_retrieve 的参数"""
+    from modules.service import day_range
+    since, until = day_range(args.since, args.until)
+    return {"collection": args.collection, "files": args.file, "tags": args.tag, "since": since, "until": until}
+
+
+def cmd_query(service, args):
+    retrieved = service.retrieve(args.query, top_k_recall=args.top_k_recall, top_k_rerank=args.top_k_rerank,
+                                 token_budget=args.token_budget, use_web=args.web, **scope_args(args))
+    if args.context_only:
+        print(retrieved["local"])
+        if retrieved["web"]:
+            print(retrieved["web"])
+        return 0
+    for piece in service.stream_answer(args.query, retrieved, temperature=args.temperature):
+        print(piece, end="", flush=True)
+    print()
+    for ref in retrieved["local_refs"]:
+        also = "".join(f", {r['source']} 页码: {r['page']}" for r in ref.get("also", ()))
+        print(f"  [来源: {ref['source']} 页码: {ref['page']}{also}]")
+    return 0
+
+
+def cmd_batch(service, args):
+    def on_progress(done, total):
+        print(f"\r{done}/{total} 条查询", end="", flush=True)
+
+    stats = service.batch_retrieve(args.queries, args.output, top_k_recall=args.top_k_recall,
+                                   top_k_rerank=args.top_k_rerank, token_budget=args.token_budget,
+                                   batch_size=args.batch_size, rerank_concurrency=args.rerank_concurrency,
+                                   on_progress=on_progress, **scope_args(args))
+    print(f"\n完成: 共 {stats['total']} 条，本次写入 {stats['written']} 条，跳过已完成 {stats['skipped']} 条")
+    return 0
+
+
+def cmd_files(service, args):
+    if args.collections:
+        for name in service.list_collections():
+            print(name)
+        return 0
+    for rec in service.file_records(args.collection):
+        tags = f"\t[{', '.join(rec['tags'])}]" if rec["tags"] else ""
+        print(f"{rec['name']}{tags}")
+    return 0
+
+
+def cmd_jobs(service, args):
+    for job in service.list_jobs(limit=args.limit, active_only=args.active):
+        print(f"{job['id']}\t{job['status']}\t{job['collection']}\t{job['done_files']}/{job['total_files']} 文件\t"
+              f"{job['added']} 片段\t{job['chunks_per_sec']:.1f} 片段/秒" + (f"\t{job['error']}" if job["error"] else ""))
+    return 0
+
+
+def cmd_dedup(service, args):
+    report = service.dedup_report(args.collection)
+    print(f"相似度阈值: {report['threshold']}" + (" (已关闭)" if report["threshold"] <= 0 else ""))
+    print(f"规范片段: {report['canonical_chunks']}\t近重复片段: {report['duplicate_chunks']} "
+          f"(涉及 {report['files_with_duplicates']} 个文件)")
+    print(f"节省: {report['chars_saved']} 字符\t{report['tokens_saved']} Embedding token\t"
+          f"{report['vector_bytes_saved'] / 1024:.1f} KB 向量")
+    return 0
+
+
+def cmd_delete(service, args):
+    for name in args.names:
+        try:
+            service.delete_file(name, collection=args.collection)
+        except TimeoutError as e:
+            print(f"删除 {name} 失败: {e}")
+            return 1
+        print(f"已删除 {name}")
+    return 0
+
+
+def cmd_serve(service, args):
+    import uvicorn
+    uvicorn.run("api:app", host=args.host, port=args.port, workers=args.workers)
+    return 0
+
+
+def add_collection_arg(parser):
+    parser.add_argument("-c", "--collection", help="知识库名称，默认 knowledge_base")
+
+
+def add_scope_args(parser):
+    """检索范围：知识库 + 检索前的文件筛选 (可组合)"""
+    add_collection_arg(parser)
+    parser.add_argument("--file", action="append", help="只在该文件中检索，可重复")
+    parser.add_argument("--tag", action="append", help="只检索带该标签的文件，可重复 (命中任一即可)")
+    parser.add_argument("--since", help="入库日期起 (YYYY-MM-DD)")
+    parser.add_argument("--until", help="入库日期止 (YYYY-MM-DD，含当天)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="DeepSeek Pro 知识库命令行")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("ingest", help="批量入库文件或目录")
+    p.add_argument("paths", nargs="+")
+    p.add_argument("-r", "--recursive", action="store_true", help="递归扫描子目录")
+    add_collection_arg(p)
+    p.add_argument("--tags", help="文件标签，逗号分隔")
+    p.set_defaults(func=cmd_ingest)
+
+    p = sub.add_parser("query", help="检索并生成回答")
+    p.add_argument("query")
+    p.add_argument("--top-k-recall", type=int, default=30)
+    p.add_argument("--top-k-rerank", type=int, default=5)
+    p.add_argument("--token-budget", type=int, default=3000)
+    p.add_argument("--temperature", type=float, default=0.3)
+    p.add_argument("--web", action="store_true", help="联网增强")
+    p.add_argument("--context-only", action="store_true", help="只输出检索到的上下文，不调用大模型")
+    add_scope_args(p)
+    p.set_defaults(func=cmd_query)
+
+    p = sub.add_parser("batch", help="批量检索 (查询文件: 每行一条问题，或 .jsonl)，可断点续跑")
+    p.add_argument("queries")
+    p.add_argument("-o", "--output", required=True, help="结果 JSONL，已存在时跳过其中已完成的查询")
+    p.add_argument("--top-k-recall", type=int, default=30)
+    p.add_argument("--top-k-rerank", type=int, default=5)
+    p.add_argument("--token-budget", type=int, default=3000)
+    p.add_argument("--batch-size", type=int, default=256)
+    p.add_argument("--rerank-concurrency", type=int, default=4)
+    add_scope_args(p)
+    p.set_defaults(func=cmd_batch)
+
+    p = sub.add_parser("files", help="列出已入库文件")
+    add_collection_arg(p)
+    p.add_argument("--collections", action="store_true", help="列出全部知识库")
+    p.set_defaults(func=cmd_files)
+
+    p = sub.add_parser("jobs", help="查看后台入库任务")
+    p.add_argument("--limit", type=int, default=20)
+    p.add_argument("--active", action="store_true", help="只看排队中 / 进行中的任务")
+    p.set_defaults(func=cmd_jobs)
+
+    p = sub.add_parser("dedup", help="查看近重复去重节省的存储 / Embedding 开销")
+    add_collection_arg(p)
+    p.set_defaults(func=cmd_dedup)
+
+    p = sub.add_parser("delete", help="删除已入库文件")
+    p.add_argument("names", nargs="+")
+    add_collection_arg(p)
+    p.set_defaults(func=cmd_delete)
+
+    p = sub.add_parser("serve", help="启动 HTTP API")
+    p.add_argument("--host", default="0.0.0.0")
+    p.add_argument("--port", type=int, default=8000)
+    p.add_argument("--workers", type=int, default=1)
+    p.set_defaults(func=cmd_serve)
+
+    args = parser.parse_args(argv)
+
+    from modules.service import RAGService
+    return args.func(RAGService(), args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
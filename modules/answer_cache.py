@@ -0,0 +1,218 @@
+"""
+语义答案缓存 (可选，配置 ANSWER_CACHE_THRESHOLD 启用)
+FAQ 类问题反复出现时，跳过大模型生成，直接回放之前的回答：
+- 命中条件：检索到的上下文指纹相同、temperature 相同，且问题向量的余弦相似度 ≥ 阈值
+- 每条回答记录引用的文件；文件被删除或重新入库时，引用它的回答全部失效
+  (失效由 database 写库时触发；缓存存放在 SQLite 中，其他进程的写入同样生效)
+- 超过 max_entries 时按最近访问时间 (LRU) 淘汰
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from functools import lru_cache
+
+import numpy as np
+
+from modules import metrics
+
+# 答案缓存存储路径
+CACHE_PATH = "./answer_cache.db"
+# 未配置阈值时 (页面上临时打开缓存) 使用的相似度阈值
+DEFAULT_THRESHOLD = 0.95
+# 回放时每段的字符数
+REPLAY_CHUNK = 16
+
+
+def context_fingerprint(local_context, web_context=""):
+    """检索上下文的指纹：上下文相同才复用回答"""
+    raw = f"{local_context or ''}\x00{web_context or ''}".encode("utf-8")
+    return hashlib.sha256(raw).hexdigest()
+
+
+def cited_sources(refs, collection):
+    """引用列表 -> 引用的 (知识库, 文件名) 集合 (含近重复片段的其他出处)"""
+    return {(ref.get("collection", collection), source) for ref in refs
+            for source in [ref["source"]] + [r["source"] for r in ref.get("also", ())]}
+
+
+def replay(answer, chunk_size=REPLAY_CHUNK):
+    """把缓存的回答按段产出，与大模型流式输出走同一个渲染路径 (st.write_stream)"""
+    for i in range(0, len(answer), chunk_size):
+        yield answer[i: i + chunk_size]
+
+
+class AnswerCache:
+    def __init__(self, path=CACHE_PATH, max_entries=5000):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS answers (
+                id INTEGER PRIMARY KEY,
+                fingerprint TEXT NOT NULL,
+                temperature REAL NOT NULL,
+                query TEXT NOT NULL,
+                vector BLOB NOT NULL,
+                answer TEXT NOT NULL,
+                refs TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_access REAL NOT NULL
+            )
+        """)
+        # 每条回答引用的文件，用于按文件失效
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS answer_sources (
+                answer_id INTEGER NOT NULL,
+                collection TEXT NOT NULL,
+                source TEXT NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_answers_key ON answers(fingerprint, temperature)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_answers_access ON answers(last_access)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_sources_file ON answer_sources(collection, source)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_sources_answer ON answer_sources(answer_id)")
+        self._conn.commit()
+
+    def lookup(self, fingerprint, temperature, q_vec, threshold=DEFAULT_THRESHOLD):
+        """
+        在同一上下文指纹与 temperature 的回答中找最相似的问题
+        相似度 ≥ threshold 时返回 {"id", "answer", "refs", "query", "similarity"}，否则返回 None
+        """
+        q_vec = np.asarray(q_vec, dtype=np.float32)
+        q_vec = q_vec / (np.linalg.norm(q_vec) or 1.0)
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, query, vector, answer, refs FROM answers WHERE fingerprint = ? AND temperature = ?",
+                (fingerprint, round(float(temperature), 2))
+            ).fetchall()
+            best, best_sim = None, threshold
+            for row in rows:
+                vec = np.frombuffer(row[2], dtype=np.float32)
+                if vec.shape != q_vec.shape:
+                    continue
+                sim = float(np.dot(q_vec, vec))
+                if sim >= best_sim:
+                    best, best_sim = row, sim
+            if best is not None:
+                self._conn.execute("UPDATE answers SET last_access = ? WHERE id = ?", (time.time(), best[0]))
+                self._conn.commit()
+                self.hits += 1
+            else:
+                self.misses += 1
+        metrics.incr("answer_cache_hits_total" if best is not None else "answer_cache_misses_total")
+        if best is None:
+            return None
+        return {"id": best[0], "query": best[1], "answer": best[3], "refs": json.loads(best[4]),
+                "similarity": best_sim}
+
+    def put(self, fingerprint, temperature, query, q_vec, answer, refs, sources):
+        """写入一条回答；sources 为引用的 (知识库, 文件名) 集合"""
+        q_vec = np.asarray(q_vec, dtype=np.float32)
+        q_vec = q_vec / (np.linalg.norm(q_vec) or 1.0)
+        now = time.time()
+        with self._lock:
+            cur = self._conn.execute(
+                "INSERT INTO answers (fingerprint, temperature, query, vector, answer, refs, created_at, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (fingerprint, round(float(temperature), 2), query, q_vec.tobytes(), answer,
+                 json.dumps(refs, ensure_ascii=False), now, now)
+            )
+            self._conn.executemany(
+                "INSERT INTO answer_sources (answer_id, collection, source) VALUES (?, ?, ?)",
+                [(cur.lastrowid, collection, source) for collection, source in sorted(sources)]
+            )
+            self._evict()
+            self._conn.commit()
+
+    def discard(self, answer_id):
+        """删除一条回答 (用户点了“重新生成”，不再回放它)"""
+        with self._lock:
+            self._delete([answer_id])
+            self._conn.commit()
+
+    def invalidate(self, collection, sources=None):
+        """删除引用了这些文件的回答；sources 为 None 时删除引用该知识库任一文件的回答，返回删除条数"""
+        with self._lock:
+            if sources is None:
+                ids = self._conn.execute(
+                    "SELECT DISTINCT answer_id FROM answer_sources WHERE collection = ?", (collection,)
+                ).fetchall()
+            else:
+                ids = []
+                sources = list(sources)
+                for i in range(0, len(sources), 500):
+                    batch = sources[i: i + 500]
+                    marks = ",".join("?" * len(batch))
+                    ids += self._conn.execute(
+                        f"SELECT DISTINCT answer_id FROM answer_sources WHERE collection = ? AND source IN ({marks})",
+                        [collection] + batch
+                    ).fetchall()
+            self._delete([row[0] for row in ids])
+            self._conn.commit()
+        return len(ids)
+
+    def _delete(self, ids):
+        """按 ID 删除回答及其引用记录 (调用方需持有锁)"""
+        for i in range(0, len(ids), 500):
+            batch = ids[i: i + 500]
+            marks = ",".join("?" * len(batch))
+            self._conn.execute(f"DELETE FROM answers WHERE id IN ({marks})", batch)
+            self._conn.execute(f"DELETE FROM answer_sources WHERE answer_id IN ({marks})", batch)
+
+    def _evict(self):
+        """超过容量时删除最久未访问的回答 (调用方需持有锁)"""
+        count = self._conn.execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+        overflow = count - self.max_entries
+        if overflow > 0:
+            ids = self._conn.execute(
+                "SELECT id FROM answers ORDER BY last_access ASC LIMIT ?", (overflow,)
+            ).fetchall()
+            self._delete([row[0] for row in ids])
+
+    def stats(self):
+        with self._lock:
+            size = self._conn.execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "size": size,
+            "max_entries": self.max_entries,
+        }
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM answers")
+            self._conn.execute("DELETE FROM answer_sources")
+            self._conn.commit()
+
+
+@lru_cache(maxsize=None)
+def load_answer_cache(path=CACHE_PATH):
+    return AnswerCache(path)
+
+
+def invalidate(collection, sources=None):
+    """文件删除 / 重新入库时调用；从未启用过答案缓存 (库文件不存在) 时什么都不做"""
+    if not os.path.exists(CACHE_PATH):
+        return 0
+    try:
+        return load_answer_cache().invalidate(collection, sources)
+    except Exception as e:
+        print(f"答案缓存失效失败: {e}")
+        return 0
+
+
+def stats():
+    """命中统计；从未启用过答案缓存时返回 None"""
+    if not os.path.exists(CACHE_PATH):
+        return None
+    return load_answer_cache().stats()
@@ -0,0 +1,123 @@
+"""
+批量检索：评测 / 夜间报表一次跑成千上万条问题，流程与 search_vectors 相同，但
+1. 查询按大批次向量化 (缓存、批内去重、并发请求都复用 APIEmbedder.encode)
+2. 一批查询向量只调用一次向量库 query
+3. 精排按有限并发发送 HTTP 请求
+4. 结果逐批追加到 JSONL 输出文件；输出文件本身就是断点，重跑时跳过已完成的查询
+"""
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from modules import metrics
+from modules.database import query_db_many, search_lexical
+from modules.retriever import format_context, make_refs, rerank_and_pack, rrf_fuse
+
+# 每批查询条数、精排并发数
+BATCH_SIZE = 256
+RERANK_CONCURRENCY = 4
+
+
+def read_queries(path):
+    """
+    读取查询文件，返回 [{"id", "query"}, ...]
+    - .jsonl：每行一个对象，含 query 字段，可选 id 字段
+    - 其他：每行一条问题，id 为行号
+    """
+    queries = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            if path.endswith(".jsonl"):
+                record = json.loads(line)
+                queries.append({"id": str(record.get("id", line_no)), "query": record["query"]})
+            else:
+                queries.append({"id": str(line_no), "query": line})
+    return queries
+
+
+def load_checkpoint(out_path):
+    """
+    读取已完成的查询 ID；中途被杀掉时最后一行可能只写了一半，截掉这部分再续写
+    """
+    done = set()
+    if not os.path.exists(out_path):
+        return done
+    valid_bytes = 0
+    with open(out_path, "rb") as f:
+        for line in f:
+            try:
+                done.add(str(json.loads(line)["id"]))
+            except (ValueError, KeyError):
+                break
+            valid_bytes += len(line)
+    if valid_bytes < os.path.getsize(out_path):
+        with open(out_path, "r+b") as f:
+            f.truncate(valid_bytes)
+    return done
+
+
+def _recall_batch(embedder, texts, top_k_recall, initial_k, collection=None, sources=None):
+    """一批查询的双路召回：向量一次批量检索，关键词逐条查 (本地 SQLite)"""
+    with metrics.stage("batch_embed"):
+        vectors = embedder.encode(texts)
+    if len(vectors) != len(texts):
+        raise RuntimeError("查询向量化失败")
+    with metrics.stage("batch_query_db"):
+        dense_lists = query_db_many(vectors, top_k=top_k_recall, collection=collection, sources=sources)
+
+    candidates = []
+    with metrics.stage("batch_lexical"):
+        for text, dense in zip(texts, dense_lists):
+            try:
+                sparse = search_lexical(text, top_k_recall, collection=collection, sources=sources)
+            except Exception as e:
+                print(f"关键词检索失败: {e}")
+                sparse = []
+            candidates.append(rrf_fuse([dense, sparse], top_k=initial_k))
+    return candidates
+
+
+def run_batch(embedder, queries, out_path, reranker=None, top_k_recall=50, top_k_rerank=5,
+              token_budget=None, batch_size=BATCH_SIZE, rerank_concurrency=RERANK_CONCURRENCY,
+              on_progress=None, collection=None, sources=None):
+    """
+    批量检索 queries ([{"id", "query"}, ...])，结果追加写入 out_path (JSONL)
+    collection / sources 限定检索的知识库与文件范围
+    每行：{"id", "query", "context", "refs"}，与单条检索的 Prompt 上下文 / 引用格式一致
+    on_progress(已完成条数, 总条数) 在每批写入后回调
+    返回 {"total", "skipped", "written"}
+    """
+    done = load_checkpoint(out_path)
+    pending = [q for q in queries if q["id"] not in done]
+    stats = {"total": len(queries), "skipped": len(queries) - len(pending), "written": 0}
+    initial_k = top_k_recall if reranker else top_k_rerank
+
+    with ThreadPoolExecutor(max_workers=rerank_concurrency) as pool, \
+            open(out_path, "a", encoding="utf-8") as out:
+        for start in range(0, len(pending), batch_size):
+            batch = pending[start: start + batch_size]
+            with metrics.start_trace("batch", queries=len(batch)):
+                candidates = _recall_batch(embedder, [q["query"] for q in batch], top_k_recall, initial_k,
+                                           collection, sources)
+                with metrics.stage("batch_rerank"):
+                    # 每个任务单独绑定当前追踪 (同一个 Context 不能在多个线程中同时进入)，重排阶段计入本批追踪
+                    futures = [pool.submit(metrics.bind_context(rerank_and_pack), q["query"], items, reranker,
+                                           top_k_rerank, token_budget)
+                               for q, items in zip(batch, candidates)]
+                    finals = [f.result() for f in futures]
+
+            for q, items in zip(batch, finals):
+                record = {"id": q["id"], "query": q["query"],
+                          "context": format_context(items), "refs": make_refs(items)}
+                out.write(json.dumps(record, ensure_ascii=False) + "\n")
+            # 每批落盘后才算完成，进程中断最多重跑一批
+            out.flush()
+            os.fsync(out.fileno())
+
+            stats["written"] += len(batch)
+            if on_progress:
+                on_progress(stats["skipped"] + stats["written"], stats["total"])
+    return stats
@@ -0,0 +1,48 @@
+"""
+运行配置：Streamlit、HTTP API、命令行共用
+优先读取同名环境变量，其次读取 .streamlit/secrets.toml (与 Streamlit 使用同一份密钥文件)
+"""
+import os
+
+try:
+    import tomllib
+except ImportError:  # Python < 3.11
+    import tomli as tomllib
+
+SECRETS_PATH = os.path.join(".streamlit", "secrets.toml")
+
+DEFAULTS = {
+    "DEEPSEEK_API_KEY": None,
+    "DEEPSEEK_BASE_URL": "https://api.deepseek.com",
+    "EMBEDDING_API_KEY": None,
+    "EMBEDDING_BASE_URL": None,
+    "EMBEDDING_MODEL": None,
+    "RERANK_API_KEY": None,
+    "RERANK_BASE_URL": None,
+    "RERANK_MODEL": None,
+    "RERANK_HEDGE_MS": None,
+    "TAVILY_API_KEY": None,
+    "ANSWER_CACHE_THRESHOLD": None,
+    "DEDUP_THRESHOLD": None,
+    "MEMORY_TURNS": 3,
+    "MEMORY_TOKENS": 1500,
+    "PARSE_WORKERS": None,
+    "METRICS_PORT": None,
+    "VECTOR_BACKEND": "chroma",
+    "VECTOR_DTYPE": "float16",
+}
+
+
+def load_settings(path=SECRETS_PATH):
+    """返回 {配置名: 值}，环境变量覆盖密钥文件"""
+    settings = dict(DEFAULTS)
+    if os.path.exists(path):
+        try:
+            with open(path, "rb") as f:
+                settings.update(tomllib.load(f))
+        except Exception as e:
+            print(f"读取配置文件失败 {path}: {e}")
+    for key in DEFAULTS:
+        if os.environ.get(key):
+            settings[key] = os.environ[key]
+    return settings
@@ -1,91 +1,386 @@
 import os
-import chromadb
+import re
+import threading
+import time
 import uuid
 
+import numpy as np
+
+from modules import answer_cache, dedup, history, lexical, manifest
+from modules.config import load_settings
+from modules.memmap_store import MEMMAP_PATH, MemmapStore
+from modules.vector_store import ChromaStore
+
 # 数据库存储路径
 DB_PATH = "./chroma_db"
+# 默认知识库；其他知识库 (按团队 / 项目划分) 各自一个独立的集合，检索时只搜所选的那个
+COLLECTION_NAME = manifest.DEFAULT_COLLECTION
+
+# 知识库名称：3-63 位字母 / 数字 / . _ -，首尾为字母或数字 (与 Chroma 集合名规则一致)
+_NAME_RE = re.compile(r"^[A-Za-z0-9][A-Za-z0-9._-]{1,61}[A-Za-z0-9]$")
+
+# 进程级共享的客户端与向量库句柄 (所有会话 / 请求共用)
+_client = None
+_stores = {}
+_lock = threading.RLock()
+
+
+def get_client():
+    """获取进程内唯一的 Chroma 客户端 (首次调用时创建)"""
+    global _client
+    if _client is None:
+        with _lock:
+            if _client is None:
+                # chromadb 导入较慢 (约 1 秒)，只在首次用到 Chroma 时导入
+                import chromadb
+                _client = chromadb.PersistentClient(path=DB_PATH)
+    return _client
+
+
+def check_collection(name):
+    """校验知识库名称，返回名称本身；为空时返回默认知识库"""
+    name = name or COLLECTION_NAME
+    if not _NAME_RE.match(name) or ".." in name:
+        raise ValueError(f"知识库名称不合法: {name} (3-63 位字母、数字或 . _ -)")
+    return name
+
+
+def _create_store(collection):
+    """按配置 VECTOR_BACKEND 选择向量库后端：chroma (默认) / memmap"""
+    settings = load_settings()
+    backend = (settings.get("VECTOR_BACKEND") or "chroma").lower()
+    if backend == "memmap":
+        return MemmapStore(os.path.join(MEMMAP_PATH, collection), dtype=settings.get("VECTOR_DTYPE") or "float16")
+    if backend != "chroma":
+        print(f"未知的 VECTOR_BACKEND: {backend}，使用 chroma")
+    return ChromaStore(get_client(), collection)
+
+
+def get_store(collection=None):
+    """获取某个知识库的向量库后端 (句柄常驻内存)"""
+    collection = collection or COLLECTION_NAME
+    store = _stores.get(collection)
+    if store is None:
+        with _lock:
+            if collection not in _stores:
+                _stores[collection] = _create_store(check_collection(collection))
+            store = _stores[collection]
+    return store
+
+
+def list_collections():
+    """已有的知识库名称 (默认知识库总在其中)"""
+    return manifest.list_collections()
 
 
-def get_collection():
-    """初始化并获取 Chroma 集合"""
-    client = chromadb.PersistentClient(path=DB_PATH)
-    collection = client.get_or_create_collection(
-        name="knowledge_base",
-        metadata={"hnsw:space": "cosine"}
-    )
-    return collection
+def resolve_scope(collection=None, files=None, tags=None, since=None, until=None):
+    """
+    把检索范围 (指定文件 / 标签 / 入库时间段) 解析为文件名列表
+    没有任何条件时返回 None (不限制)；有条件但没有文件满足时返回空列表
+    """
+    if not (files or tags or since is not None or until is not None):
+        return None
+    return manifest.find_files(collection or COLLECTION_NAME, names=files, tags=tags, since=since, until=until)
 
 
-def add_to_db(chunks, vectors):
-    """存入数据"""
-    collection = get_collection()
-    if not chunks: return 0
+def collection_version(collection=None):
+    """知识库内容版本号 (每次写库加一)，作为查询缓存键的一部分"""
+    return manifest.collection_version(collection or COLLECTION_NAME)
 
-    ids = [str(uuid.uuid4()) for _ in chunks]
-    documents = [chunk["content"] for chunk in chunks]
-    metadatas = [{"source": c["source"], "page": str(c.get("page", "N/A"))} for c in chunks]
 
-    collection.add(
-        ids=ids,
-        embeddings=vectors.tolist(),
-        metadatas=metadatas,
-        documents=documents
-    )
+def scope_where(sources):
+    """文件范围 -> 向量库的 where 条件"""
+    if sources is None:
+        return None
+    return {"source": {"$in": list(sources)}}
+
+
+def _chunk_metadata(chunk, now, file_hash=None, model_name=None, tags=None):
+    meta = {"source": chunk["source"], "page": str(chunk.get("page", "N/A")), "ingested_at": now}
+    # 清单重建 / 增量同步所需的信息也写进片段 metadata，保证可以从集合反推
+    if file_hash: meta["file_hash"] = file_hash
+    if model_name: meta["model"] = model_name
+    if "offset" in chunk: meta["offset"] = chunk["offset"]
+    if chunk.get("page_hash"): meta["page_hash"] = chunk["page_hash"]
+    if tags: meta["tags"] = ",".join(tags)
+    return meta
+
+
+def add_to_db(chunks, vectors, file_hash=None, model_name=None, update_manifest=True, collection=None,
+              tags=None, signatures=None, duplicates=None):
+    """
+    存入数据 (确定性 ID 时为覆盖写入)，并同步更新文件清单
+    依次写向量库、关键词索引、去重索引，清单最后更新；各自独立提交，不是一个事务：
+    中途失败时清单只会落后于向量库 (不会记下未写入的片段)，用 check_manifest 检查 / 修正
+    流式分批写入时传 update_manifest=False，由调用方在整个文件写完后再更新清单
+    近重复去重 (见 dedup.py)：signatures 为 chunks 的 MinHash 签名，登记到去重索引；
+    duplicates 为 [(近重复片段, 规范片段 ID), ...]，不写入向量库，只记录回引
+    返回写入向量库的片段数
+    """
+    collection = collection or COLLECTION_NAME
+    store = get_store(collection)
+    tags = manifest.split_tags(tags)
+    duplicates = duplicates or []
+    if not chunks and not duplicates: return 0
+
+    now = time.time()
+    ids = [c.get("id") or str(uuid.uuid4()) for c in chunks]
+    if chunks:
+        documents = [chunk["content"] for chunk in chunks]
+        metadatas = [_chunk_metadata(c, now, file_hash, model_name, tags) for c in chunks]
+        store.upsert(ids, vectors, metadatas, documents)
+        lexical.add(ids, chunks, collection=collection)
+        if signatures is not None:
+            dedup.add_signatures(ids, [c["source"] for c in chunks], signatures, collection=collection)
+    dedup.add_refs(duplicates, [_chunk_metadata(c, now, file_hash, model_name, tags) for c, _ in duplicates],
+                   collection=collection)
+    manifest.bump_version(collection)
+    # 文件内容有变化 (重新入库)，引用它的缓存回答失效
+    sources = {c["source"] for c in chunks} | {c["source"] for c, _ in duplicates}
+    answer_cache.invalidate(collection, sources)
+    if update_manifest:
+        refresh_manifest(sources, file_hash=file_hash, model_name=model_name, collection=collection, tags=tags)
     return len(ids)
 
 
-def query_db(query_vector, top_k=10):
-    """查询数据"""
-    collection = get_collection()
-    results = collection.query(
-        query_embeddings=[query_vector.tolist()],
-        n_results=top_k,
-        include=["documents", "metadatas", "distances"]
-    )
-
-    processed_results = []
-    if not results["documents"]: return []
-
-    for i in range(len(results["documents"][0])):
-        distance = results["distances"][0][i]
-        similarity = 1 - distance
-        doc = results["documents"][0][i]
-        meta = results["metadatas"][0][i]
-
-        processed_results.append({
-            "content": doc,
-            "source": meta["source"],
-            "page": meta["page"],
-            "score": similarity
-        })
-    return processed_results
-
-
-def reset_db():
-    """清空整个库"""
-    client = chromadb.PersistentClient(path=DB_PATH)
-    try:
-        client.delete_collection("knowledge_base")
-    except:
-        pass
+def refresh_manifest(sources, file_hash=None, model_name=None, collection=None, tags=None):
+    """
+    按文件重新汇总清单记录 (只读取这些文件自己的片段，而不是全库)
+    tags 为空时保留清单中已有的标签
+    """
+    collection = collection or COLLECTION_NAME
+    store = get_store(collection)
+    records = {}
+    for source in sources:
+        data = store.get(where={"source": source}, include=["metadatas"])
+        # 去重后只保存了回引的片段同样计入该文件
+        rec = manifest.summarize_metadatas((data.get("metadatas") or []) +
+                                           dedup.ref_metadatas(source, collection=collection))
+        # 增量更新后未变化的页仍带着旧的文件指纹，以本次入库的为准
+        if file_hash and rec["chunk_count"]: rec["content_hash"] = file_hash
+        if model_name and rec["chunk_count"]: rec["embedding_model"] = model_name
+        rec["tags"] = manifest.split_tags(tags) or None
+        records[source] = rec
+    manifest.upsert_files(records, collection=collection)
+
+
+def get_page_hashes(source, collection=None):
+    """获取某个文件已入库各页的指纹 {页码: page_hash}"""
+    collection = collection or COLLECTION_NAME
+    data = get_store(collection).get(where={"source": source}, include=["metadatas"])
+    hashes = {}
+    for m in (data.get("metadatas") or []) + dedup.ref_metadatas(source, collection=collection):
+        hashes[m["page"]] = m.get("page_hash")
+    return hashes
+
+
+def get_chunks_by_ids(ids, collection=None):
+    """按 ID 读取片段原文 {id: {"source", "page", "content"}}，不存在的 ID 不返回"""
+    if not ids: return {}
+    data = get_store(collection).get(ids=list(ids), include=["documents", "metadatas"])
+    return {
+        cid: {"source": meta["source"], "page": meta["page"], "content": doc}
+        for cid, doc, meta in zip(data["ids"], data["documents"], data["metadatas"])
+    }
+
+
+def _snapshot_referenced(ids, collection=None):
+    """删除前把被聊天记录引用的片段原文存为快照，历史引用在删除后仍可查看"""
+    referenced = history.referenced_ids(ids)
+    if referenced:
+        history.snapshot_chunks(get_chunks_by_ids(referenced, collection))
+
 
+def _hand_over_canonicals(ids, collection):
+    """
+    规范片段即将随所在文件 / 页删除：仍被其他文件引用的，以接替回引的 ID 和 metadata 重新写入 (复用原向量)
+    调用前先删除被删文件 / 页自己的回引
+    """
+    successions = dedup.heirs(ids, collection=collection)
+    if not successions: return
+    store = get_store(collection)
+    data = store.get(ids=list(successions), include=["documents", "embeddings"])
+    found = {cid: (doc, vec) for cid, doc, vec in zip(data["ids"], data["documents"], data["embeddings"])}
+    successions = {old: heir for old, heir in successions.items() if old in found}
+    if not successions: return
+    heirs = list(successions.values())
+    documents = [found[old][0] for old in successions]
+    new_ids = [heir["id"] for heir in heirs]
+    store.upsert(new_ids, np.asarray([found[old][1] for old in successions], dtype=np.float32),
+                 [heir["metadata"] for heir in heirs], documents)
+    lexical.add(new_ids, [{"source": heir["source"], "page": heir["page"], "offset": heir["offset"], "content": doc}
+                          for heir, doc in zip(heirs, documents)], collection=collection)
+    dedup.promote(successions, collection=collection)
+    answer_cache.invalidate(collection, {heir["source"] for heir in heirs})
 
-# 🟢 新增：获取所有文件名
-def get_all_files():
-    collection = get_collection()
-    # 获取 metadata，数据量大时需优化，目前适用
-    data = collection.get(include=["metadatas"])
-    if not data or not data["metadatas"]:
+
+def _delete_where(where, source, pages, collection):
+    """删除某个文件 (pages 为 None 时整个文件) 的片段与回引；其他文件仍引用的规范片段先转交"""
+    store = get_store(collection)
+    dedup.delete_refs(source, pages, collection=collection)
+    ids = store.get(where=where, include=[])["ids"]
+    _hand_over_canonicals(ids, collection)
+    _snapshot_referenced(ids, collection)
+    store.delete(where=where)
+    lexical.delete_source(source, pages, collection=collection)
+    dedup.remove(ids, collection=collection)
+    manifest.bump_version(collection)
+    answer_cache.invalidate(collection, [source])
+
+
+def delete_pages(source, pages, collection=None):
+    """删除某个文件指定页的全部片段"""
+    collection = collection or COLLECTION_NAME
+    pages = [str(p) for p in pages]
+    if not pages: return
+    _delete_where({"$and": [{"source": source}, {"page": {"$in": pages}}]}, source, pages, collection)
+
+
+def _with_back_refs(chunks, collection):
+    """命中的规范片段附带其近重复片段的出现位置 also: [{"source", "page"}, ...] (引用中列出全部来源)"""
+    refs = dedup.back_refs([c["id"] for c in chunks], collection=collection)
+    for c in chunks:
+        also = [r for r in refs.get(c["id"], ()) if (r["source"], r["page"]) != (c["source"], c["page"])]
+        if also:
+            c["also"] = also
+    return chunks
+
+
+def _merge_hits(hits, extra, top_k):
+    """合并两路命中 (按 ID 去重，分数降序取前 top_k)"""
+    merged = {hit["id"]: hit for hit in extra}
+    merged.update({hit["id"]: hit for hit in hits})
+    return sorted(merged.values(), key=lambda hit: hit["score"], reverse=True)[:top_k]
+
+
+def _to_chunks(hits, collection):
+    """把向量库返回的命中整理为片段列表"""
+    return [
+        {
+            "id": hit["id"],
+            "content": hit["document"],
+            "source": hit["metadata"]["source"],
+            "page": hit["metadata"]["page"],
+            "offset": hit["metadata"].get("offset"),
+            "score": hit["score"],
+            "collection": collection
+        }
+        for hit in hits
+    ]
+
+
+def query_db(query_vector, top_k=10, collection=None, sources=None):
+    """查询数据；sources 不为 None 时只在这些文件中检索 (过滤条件在向量检索之前生效)"""
+    if sources is not None and not sources:
+        return []
+    collection = collection or COLLECTION_NAME
+    store = get_store(collection)
+    hits = store.query([query_vector], n_results=top_k, where=scope_where(sources))[0]
+    # 范围内文件的近重复片段保存在范围外的规范片段上，单独在这些规范片段中再检索一次
+    extra = dedup.canonical_ids(sources, collection=collection) if sources is not None else []
+    if extra:
+        hits = _merge_hits(hits, store.query([query_vector], n_results=min(top_k, len(extra)), ids=extra)[0], top_k)
+    return _with_back_refs(_to_chunks(hits, collection), collection)
+
+
+def query_db_many(query_vectors, top_k=10, collection=None, sources=None):
+    """多条查询向量一次检索，返回与输入顺序一致的结果列表"""
+    if len(query_vectors) == 0:
         return []
-    files = set([m["source"] for m in data["metadatas"]])
-    return sorted(list(files))
+    if sources is not None and not sources:
+        return [[] for _ in range(len(query_vectors))]
+    collection = collection or COLLECTION_NAME
+    store = get_store(collection)
+    results = store.query(query_vectors, n_results=top_k, where=scope_where(sources))
+    extra = dedup.canonical_ids(sources, collection=collection) if sources is not None else []
+    if extra:
+        extra_results = store.query(query_vectors, n_results=min(top_k, len(extra)), ids=extra)
+        results = [_merge_hits(hits, more, top_k) for hits, more in zip(results, extra_results)]
+    return [_with_back_refs(_to_chunks(hits, collection), collection) for hits in results]
+
+
+def reset_db(collection=None):
+    """清空整个知识库"""
+    collection = collection or COLLECTION_NAME
+    with _lock:
+        try:
+            _snapshot_referenced(get_store(collection).get(include=[])["ids"], collection)
+        except Exception as e:
+            print(f"保存引用快照失败: {e}")
+        get_store(collection).reset()
+    manifest.clear(collection)
+    lexical.clear(collection)
+    dedup.clear(collection)
+    manifest.bump_version(collection)
+    answer_cache.invalidate(collection)
+
+
+# 🟢 新增：获取所有文件名 (读取文件清单，O(文件数))
+def get_all_files(collection=None):
+    return [f["name"] for f in get_file_records(collection)]
+
+
+def get_file_records(collection=None):
+    """某个知识库的全部清单记录 (含标签、入库时间)"""
+    collection = collection or COLLECTION_NAME
+    files = manifest.list_files(collection)
+    # 旧版本的库没有清单：首次访问时从集合重建一次
+    if not files and get_store(collection).count() > 0:
+        manifest.rebuild(get_store(collection), collection=collection,
+                         extra=dedup.ref_metadatas(collection=collection))
+        files = manifest.list_files(collection)
+    return files
+
+
+def check_manifest(collection=None, repair=False):
+    """
+    对照向量库 (含去重回引) 检查文件清单，返回片段数不一致、清单缺失或多余的文件名
+    repair=True 时按向量库修正这些记录：保留清单原有的文件指纹与标签 (清单中没有的文件指纹留空)，
+    写了一半的文件不会因此被当成已入库完成，下次上传仍会逐页比对指纹补齐
+    """
+    collection = collection or COLLECTION_NAME
+    grouped = manifest.group_metadatas(get_store(collection), extra=dedup.ref_metadatas(collection=collection))
+    records = {rec["name"]: rec for rec in manifest.list_files(collection)}
+    stale = sorted(name for name in set(grouped) | set(records)
+                   if name not in grouped or name not in records
+                   or records[name]["chunk_count"] != len(grouped[name]))
+    if repair and stale:
+        fixed = {}
+        for name in stale:
+            rec = manifest.summarize_metadatas(grouped.get(name, []))
+            if name in records:
+                rec["content_hash"], rec["tags"] = records[name]["content_hash"], None
+            else:
+                rec["content_hash"] = None
+            fixed[name] = rec
+        manifest.upsert_files(fixed, collection=collection)
+        manifest.bump_version(collection)
+    return stale
+
+
+def rebuild_manifest(collection=None):
+    """从集合全量重建文件清单 (修复清单与集合不一致的情况)"""
+    collection = collection or COLLECTION_NAME
+    return manifest.rebuild(get_store(collection), collection=collection,
+                            extra=dedup.ref_metadatas(collection=collection))
+
+
+def search_lexical(query, top_k=50, collection=None, sources=None):
+    """BM25 关键词检索；旧版本的库没有关键词索引时先从集合重建"""
+    collection = collection or COLLECTION_NAME
+    if lexical.count(collection) == 0 and get_store(collection).count() > 0:
+        lexical.rebuild(get_store(collection), collection=collection)
+    extra = dedup.canonical_ids(sources, collection=collection) if sources is not None else None
+    return _with_back_refs(lexical.search(query, top_k=top_k, collection=collection, sources=sources, ids=extra),
+                           collection)
 
 
 # 🟢 新增：删除指定文件
-def delete_file_from_db(filename):
-    collection = get_collection()
+def delete_file_from_db(filename, collection=None):
+    collection = collection or COLLECTION_NAME
     try:
-        collection.delete(where={"source": filename})
+        _delete_where({"source": filename}, filename, None, collection)
+        manifest.remove_file(filename, collection)
         return True
     except Exception as e:
         print(f"删除失败: {e}")
@@ -0,0 +1,389 @@
+"""
+语料级近重复片段检测 (入库时)：MinHash 签名 + LSH 分桶，索引持久化在 SQLite，按 collection 列区分知识库
+- 每段近重复文本只保存一份规范片段 (canonical)：只有它向量化、写入向量库 / 关键词索引
+- 其余近重复片段不调用 Embedding API，只在 refs 表记一条回引 (文件 / 页码 / 偏移 / metadata -> 规范片段 ID)，
+  文件清单、页指纹比对照常使用这些回引，增量入库与删除的语义不变
+- 检索命中规范片段时附带全部回引位置 (also)，引用中列出所有出现过这段文本的文件 / 页
+- 删除规范片段所在的文件 / 页时，片段转给仍引用它的其他文件 (复用原向量，不重新向量化)
+- 节省统计：跳过的片段数、未保存的文本字符数、未发送给 Embedding API 的 token 数
+
+只有 MIN_CHARS 以上的片段参与去重；相似度用签名估算的字符 5-gram Jaccard，阈值见 DEDUP_THRESHOLD 配置
+默认关闭：近重复片段只保留规范片段的原文，只差一个数字 / 日期的条款也会被合并成一份，需按语料确认后再开启
+
+修复 / 重建签名索引 (只索引已入库的片段，不合并已有的重复)：python -m modules.dedup rebuild [--collection 名称]
+"""
+import argparse
+import hashlib
+import json
+import sqlite3
+import threading
+import zlib
+
+import numpy as np
+
+from modules.config import load_settings
+from modules.packer import estimate_tokens
+
+# 去重索引存储路径
+DEDUP_PATH = "./dedup.db"
+# 未指定知识库时使用的默认集合
+DEFAULT_COLLECTION = "knowledge_base"
+# 默认相似度阈值：0 表示关闭去重 (配置 DEDUP_THRESHOLD > 0 时开启，建议 0.95 以上)
+DEFAULT_THRESHOLD = 0.0
+
+# MinHash 置换数 = BANDS × ROWS；16 × 8 时 Jaccard ≥ 0.9 的片段几乎必然落入同一个桶，
+# 0.5 以下的很少成为候选，候选再按签名估算的相似度过滤
+BANDS, ROWS = 16, 8
+NUM_PERM = BANDS * ROWS
+SHINGLE = 5
+# 太短的片段 (如页尾残段) 5-gram 太少，估算不可靠，不参与去重
+MIN_CHARS = 50
+
+_PRIME = (1 << 31) - 1
+_rng = np.random.RandomState(20240601)
+_A = _rng.randint(1, _PRIME, NUM_PERM).astype(np.uint64)
+_B = _rng.randint(0, _PRIME, NUM_PERM).astype(np.uint64)
+
+_conn = None
+_conn_path = None
+_lock = threading.RLock()
+
+
+def _get_conn():
+    """进程内共享的 SQLite 连接 (路径变化时重新打开)"""
+    global _conn, _conn_path
+    with _lock:
+        if _conn is None or _conn_path != DEDUP_PATH:
+            _conn = sqlite3.connect(DEDUP_PATH, check_same_thread=False)
+            _conn_path = DEDUP_PATH
+            _conn.execute("PRAGMA journal_mode=WAL")
+            _conn.executescript("""
+                CREATE TABLE IF NOT EXISTS signatures (
+                    collection TEXT NOT NULL,
+                    id TEXT NOT NULL,
+                    source TEXT NOT NULL,
+                    signature BLOB NOT NULL,
+                    PRIMARY KEY (collection, id)
+                );
+                CREATE TABLE IF NOT EXISTS buckets (
+                    collection TEXT NOT NULL,
+                    key INTEGER NOT NULL,
+                    id TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_buckets_key ON buckets(collection, key);
+                CREATE INDEX IF NOT EXISTS idx_buckets_id ON buckets(collection, id);
+                CREATE TABLE IF NOT EXISTS refs (
+                    collection TEXT NOT NULL,
+                    id TEXT NOT NULL,
+                    canonical TEXT NOT NULL,
+                    source TEXT NOT NULL,
+                    page TEXT NOT NULL,
+                    "offset" INTEGER,
+                    metadata TEXT NOT NULL,
+                    chars INTEGER NOT NULL,
+                    tokens INTEGER NOT NULL,
+                    PRIMARY KEY (collection, id)
+                );
+                CREATE INDEX IF NOT EXISTS idx_refs_canonical ON refs(collection, canonical);
+                CREATE INDEX IF NOT EXISTS idx_refs_source ON refs(collection, source, page);
+            """)
+            _conn.commit()
+        return _conn
+
+
+def configured_threshold():
+    """配置的相似度阈值；0 表示关闭去重"""
+    value = load_settings().get("DEDUP_THRESHOLD")
+    return DEFAULT_THRESHOLD if value is None else float(value)
+
+
+# --- MinHash / LSH ---
+def signature(text):
+    """字符 5-gram 的 MinHash 签名 (uint32 × NUM_PERM)；片段太短时返回 None"""
+    text = " ".join(text.lower().split())
+    if len(text) < MIN_CHARS:
+        return None
+    shingles = {text[i: i + SHINGLE] for i in range(len(text) - SHINGLE + 1)}
+    hashes = np.fromiter((zlib.crc32(s.encode("utf-8")) for s in shingles), dtype=np.uint64, count=len(shingles))
+    # 线性哈希 (a·x + b) mod p 模拟随机置换，a, b < 2^31、x < 2^32，uint64 内不溢出
+    permuted = (hashes[:, None] * _A + _B) % _PRIME
+    return permuted.min(axis=0).astype(np.uint32)
+
+
+def similarity(a, b):
+    """签名估算的 Jaccard 相似度"""
+    return float(np.mean(a == b))
+
+
+def band_keys(sig):
+    """每个 band 一个桶键 (有符号 64 位整数，SQLite 可直接存)"""
+    rows = sig.reshape(BANDS, ROWS)
+    return [
+        int.from_bytes(hashlib.blake2b(bytes([band]) + rows[band].tobytes(), digest_size=8).digest(),
+                       "big", signed=True)
+        for band in range(BANDS)
+    ]
+
+
+def _candidates(conn, collection, keys):
+    marks = ",".join("?" * len(keys))
+    return conn.execute(
+        "SELECT DISTINCT s.id, s.source, s.signature FROM buckets b "
+        "JOIN signatures s ON s.collection = b.collection AND s.id = b.id "
+        f"WHERE b.collection = ? AND b.key IN ({marks})", [collection] + keys
+    ).fetchall()
+
+
+class Session:
+    """
+    一次文件入库内的去重判定：规范片段先在内存中登记 (同一文件内、相邻批次间的重复也能识别)，
+    写库后由 add_signatures 落盘
+    入库前已存在的、属于本文件的规范片段不作为候选：它们所在的页可能随后被替换 / 删除
+    """
+
+    def __init__(self, collection, source, threshold):
+        self.collection = collection
+        self.source = source
+        self.threshold = threshold
+        self._pending = {}
+
+    def _best_match(self, sig, keys):
+        best, best_sim = None, self.threshold
+        conn = _get_conn()
+        with _lock:
+            rows = _candidates(conn, self.collection, keys)
+        found = [(cid, np.frombuffer(blob, dtype=np.uint32)) for cid, source, blob in rows
+                 if source != self.source]
+        for key in keys:
+            found += self._pending.get(key, [])
+        for cid, other in found:
+            sim = similarity(sig, other)
+            if sim >= best_sim:
+                best, best_sim = cid, sim
+        return best
+
+    def classify(self, chunks):
+        """
+        把一批片段分为规范片段与近重复片段
+        返回 (规范片段列表, 对应签名列表 (太短的为 None), [(近重复片段, 规范片段 ID), ...])
+        """
+        unique, signatures, duplicates = [], [], []
+        for chunk in chunks:
+            sig = signature(chunk["content"])
+            if sig is None:
+                unique.append(chunk)
+                signatures.append(None)
+                continue
+            keys = band_keys(sig)
+            canonical = self._best_match(sig, keys)
+            if canonical is not None and canonical != chunk["id"]:
+                duplicates.append((chunk, canonical))
+                continue
+            unique.append(chunk)
+            signatures.append(sig)
+            for key in keys:
+                self._pending.setdefault(key, []).append((chunk["id"], sig))
+        return unique, signatures, duplicates
+
+
+# --- 写入 / 删除 ---
+def add_signatures(ids, sources, signatures, collection=DEFAULT_COLLECTION):
+    """登记已写入向量库的规范片段 (签名为 None 的跳过)；同一 ID 重复写入时覆盖"""
+    items = [(cid, src, sig) for cid, src, sig in zip(ids, sources, signatures) if sig is not None]
+    if not items: return
+    conn = _get_conn()
+    with _lock, conn:
+        _remove_ids(conn, collection, [cid for cid, _, _ in items])
+        for cid, source, sig in items:
+            conn.execute("INSERT INTO signatures (collection, id, source, signature) VALUES (?, ?, ?, ?)",
+                         (collection, cid, source, sig.tobytes()))
+            conn.executemany("INSERT INTO buckets (collection, key, id) VALUES (?, ?, ?)",
+                             [(collection, key, cid) for key in band_keys(sig)])
+
+
+def add_refs(duplicates, metadatas, collection=DEFAULT_COLLECTION):
+    """记录近重复片段的回引；duplicates: [(片段, 规范片段 ID), ...]，metadatas 为与向量库一致的片段 metadata"""
+    if not duplicates: return
+    conn = _get_conn()
+    with _lock, conn:
+        conn.executemany(
+            'INSERT OR REPLACE INTO refs (collection, id, canonical, source, page, "offset", metadata, chars, tokens) '
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [(collection, c["id"], canonical, c["source"], str(c.get("page", "N/A")), c.get("offset"),
+              json.dumps(meta, ensure_ascii=False), len(c["content"]), estimate_tokens(c["content"]))
+             for (c, canonical), meta in zip(duplicates, metadatas)]
+        )
+
+
+def _remove_ids(conn, collection, ids):
+    for i in range(0, len(ids), 500):
+        batch = ids[i: i + 500]
+        marks = ",".join("?" * len(batch))
+        conn.execute(f"DELETE FROM signatures WHERE collection = ? AND id IN ({marks})", [collection] + batch)
+        conn.execute(f"DELETE FROM buckets WHERE collection = ? AND id IN ({marks})", [collection] + batch)
+
+
+def remove(ids, collection=DEFAULT_COLLECTION):
+    """规范片段已从向量库删除：移出签名索引"""
+    if not ids: return
+    conn = _get_conn()
+    with _lock, conn:
+        _remove_ids(conn, collection, list(ids))
+
+
+def delete_refs(source, pages=None, collection=DEFAULT_COLLECTION):
+    """删除某个文件 (或其中指定页) 的回引"""
+    conn = _get_conn()
+    with _lock, conn:
+        if pages is None:
+            conn.execute("DELETE FROM refs WHERE collection = ? AND source = ?", (collection, source))
+            return
+        pages = [str(p) for p in pages]
+        if not pages: return
+        conn.execute(f"DELETE FROM refs WHERE collection = ? AND source = ? AND page IN ({','.join('?' * len(pages))})",
+                     [collection, source] + pages)
+
+
+def heirs(ids, collection=DEFAULT_COLLECTION):
+    """
+    即将删除的规范片段中仍被引用的，各选一个回引接替 (按文件名、页码、偏移取第一个)
+    返回 {规范片段 ID: {"id", "source", "page", "offset", "metadata"}}
+    """
+    ids = list(ids)
+    found = {}
+    conn = _get_conn()
+    with _lock:
+        for i in range(0, len(ids), 500):
+            batch = ids[i: i + 500]
+            rows = conn.execute(
+                f'SELECT canonical, id, source, page, "offset", metadata FROM refs '
+                f"WHERE collection = ? AND canonical IN ({','.join('?' * len(batch))}) "
+                f'ORDER BY source, page, "offset"', [collection] + batch
+            ).fetchall()
+            for canonical, cid, source, page, offset, meta in rows:
+                found.setdefault(canonical, {"id": cid, "source": source, "page": page, "offset": offset,
+                                             "metadata": json.loads(meta)})
+    return found
+
+
+def promote(successions, collection=DEFAULT_COLLECTION):
+    """
+    规范片段转给接替的回引 successions: {旧规范片段 ID: 接替的回引 (heirs 的返回项)}
+    (调用方已把片段以新 ID 写入向量库)：签名改挂到新 ID，接替者移出回引表，其余回引改指新 ID
+    """
+    if not successions: return
+    conn = _get_conn()
+    with _lock, conn:
+        for old, heir in successions.items():
+            conn.execute("UPDATE signatures SET id = ?, source = ? WHERE collection = ? AND id = ?",
+                         (heir["id"], heir["source"], collection, old))
+            conn.execute("UPDATE buckets SET id = ? WHERE collection = ? AND id = ?", (heir["id"], collection, old))
+            conn.execute("DELETE FROM refs WHERE collection = ? AND id = ?", (collection, heir["id"]))
+            conn.execute("UPDATE refs SET canonical = ? WHERE collection = ? AND canonical = ?",
+                         (heir["id"], collection, old))
+
+
+def clear(collection=DEFAULT_COLLECTION):
+    conn = _get_conn()
+    with _lock, conn:
+        for table in ("signatures", "buckets", "refs"):
+            conn.execute(f"DELETE FROM {table} WHERE collection = ?", (collection,))
+
+
+# --- 查询 ---
+def back_refs(ids, collection=DEFAULT_COLLECTION):
+    """规范片段的全部回引位置 {规范片段 ID: [{"source", "page"}, ...]} (同一文件同一页只列一次)"""
+    ids = list(dict.fromkeys(ids))
+    found = {}
+    conn = _get_conn()
+    with _lock:
+        for i in range(0, len(ids), 500):
+            batch = ids[i: i + 500]
+            rows = conn.execute(
+                f"SELECT DISTINCT canonical, source, page FROM refs "
+                f"WHERE collection = ? AND canonical IN ({','.join('?' * len(batch))}) ORDER BY source, page",
+                [collection] + batch
+            ).fetchall()
+            for canonical, source, page in rows:
+                found.setdefault(canonical, []).append({"source": source, "page": page})
+    return found
+
+
+def canonical_ids(sources, collection=DEFAULT_COLLECTION):
+    """这些文件中的近重复片段指向的规范片段 ID (检索范围限定到这些文件时也要检索它们)"""
+    sources = list(sources)
+    if not sources: return []
+    conn = _get_conn()
+    with _lock:
+        rows = conn.execute(
+            f"SELECT DISTINCT canonical FROM refs WHERE collection = ? "
+            f"AND source IN ({','.join('?' * len(sources))})", [collection] + sources
+        ).fetchall()
+    return [r[0] for r in rows]
+
+
+def ref_metadatas(source=None, collection=DEFAULT_COLLECTION):
+    """回引片段的 metadata (与向量库中的格式一致)，用于页指纹比对与文件清单汇总；source 为空时返回全部"""
+    sql, params = "SELECT metadata FROM refs WHERE collection = ?", [collection]
+    if source is not None:
+        sql, params = sql + " AND source = ?", params + [source]
+    conn = _get_conn()
+    with _lock:
+        return [json.loads(r[0]) for r in conn.execute(sql, params)]
+
+
+def report(collection=DEFAULT_COLLECTION):
+    """节省统计：规范片段数、跳过的近重复片段数及其文本字符数 / Embedding token 数"""
+    conn = _get_conn()
+    with _lock:
+        canonical = conn.execute("SELECT COUNT(*) FROM signatures WHERE collection = ?", (collection,)).fetchone()[0]
+        duplicates, chars, tokens, files = conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(chars), 0), COALESCE(SUM(tokens), 0), COUNT(DISTINCT source) "
+            "FROM refs WHERE collection = ?", (collection,)
+        ).fetchone()
+    return {
+        "canonical_chunks": canonical,
+        "duplicate_chunks": duplicates,
+        "files_with_duplicates": files,
+        "chars_saved": chars,
+        "tokens_saved": tokens,
+    }
+
+
+def rebuild(store, collection=DEFAULT_COLLECTION, page_size=2000):
+    """从向量库重建某个知识库的签名索引 (回引保留)；返回登记的片段数"""
+    conn = _get_conn()
+    with _lock, conn:
+        conn.execute("DELETE FROM signatures WHERE collection = ?", (collection,))
+        conn.execute("DELETE FROM buckets WHERE collection = ?", (collection,))
+    offset = 0
+    total = 0
+    while True:
+        data = store.get(include=["documents", "metadatas"], limit=page_size, offset=offset)
+        ids = data.get("ids") or []
+        if not ids:
+            break
+        sigs = [signature(doc) for doc in data["documents"]]
+        add_signatures(ids, [m["source"] for m in data["metadatas"]], sigs, collection=collection)
+        total += sum(1 for s in sigs if s is not None)
+        offset += len(ids)
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description="近重复片段索引维护工具")
+    parser.add_argument("command", choices=["rebuild", "report"])
+    parser.add_argument("--collection", default=DEFAULT_COLLECTION, help="知识库名称")
+    args = parser.parse_args()
+
+    if args.command == "rebuild":
+        from modules.database import get_store
+        count = rebuild(get_store(args.collection), collection=args.collection)
+        print(f"签名索引已重建: {count} 个片段")
+    else:
+        for key, value in report(args.collection).items():
+            print(f"{key}\t{value}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+import hashlib
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+from modules import metrics
+
+# 向量缓存存储路径
+CACHE_PATH = "./embedding_cache.db"
+
+
+def normalize_text(text):
+    """归一化文本：去掉换行、合并多余空白（与发送给 API 的文本保持一致）"""
+    return " ".join(text.replace("\n", " ").split())
+
+
+def make_key(model_name, text):
+    """按 (模型名, 归一化文本) 计算内容寻址的缓存键"""
+    raw = f"{model_name}\x00{normalize_text(text)}".encode("utf-8")
+    return hashlib.sha256(raw).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    基于 SQLite 的磁盘向量缓存
+    - 向量以 float16 / float32 二进制 blob 紧凑存储
+    - 超过 max_entries 时按最近访问时间 (LRU) 淘汰
+    - 记录命中 / 未命中次数
+    """
+
+    def __init__(self, path=CACHE_PATH, max_entries=200_000, dtype="float16"):
+        self.path = path
+        self.max_entries = max_entries
+        self.dtype = np.dtype(dtype)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # Streamlit 多会话共享同一实例，需允许跨线程使用
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS embeddings (
+                key TEXT PRIMARY KEY,
+                dim INTEGER NOT NULL,
+                vector BLOB NOT NULL,
+                last_access REAL NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_last_access ON embeddings(last_access)")
+        self._conn.commit()
+
+    def get_many(self, keys):
+        """批量查询，返回 {key: vector}，仅包含命中的条目"""
+        found = {}
+        if not keys:
+            return found
+
+        unique_keys = list(dict.fromkeys(keys))
+        with self._lock:
+            # SQLite 单条语句的参数个数有限制，分批查询
+            for i in range(0, len(unique_keys), 500):
+                batch = unique_keys[i: i + 500]
+                marks = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({marks})", batch
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype=self.dtype).astype(np.float32)
+
+            # 更新访问时间，用于 LRU 淘汰
+            if found:
+                now = time.time()
+                self._conn.executemany(
+                    "UPDATE embeddings SET last_access = ? WHERE key = ?",
+                    [(now, k) for k in found]
+                )
+                self._conn.commit()
+
+            hit_count = sum(1 for k in keys if k in found)
+            self.hits += hit_count
+            self.misses += len(keys) - hit_count
+        metrics.incr("embedding_cache_hits_total", hit_count)
+        metrics.incr("embedding_cache_misses_total", len(keys) - hit_count)
+        return found
+
+    def put_many(self, items):
+        """批量写入 [(key, vector), ...]"""
+        if not items:
+            return
+        now = time.time()
+        rows = []
+        for key, vec in items:
+            arr = np.asarray(vec, dtype=self.dtype)
+            rows.append((key, int(arr.shape[0]), arr.tobytes(), now))
+
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, dim, vector, last_access) VALUES (?, ?, ?, ?)",
+                rows
+            )
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        """超过容量时删除最久未访问的条目（调用方需持有锁）"""
+        count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        overflow = count - self.max_entries
+        if overflow > 0:
+            self._conn.execute(
+                "DELETE FROM embeddings WHERE key IN "
+                "(SELECT key FROM embeddings ORDER BY last_access ASC LIMIT ?)",
+                (overflow,)
+            )
+
+    def stats(self):
+        """返回命中统计"""
+        with self._lock:
+            size = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "size": size,
+            "max_entries": self.max_entries,
+        }
+
+    def clear(self):
+        """清空缓存"""
+        with self._lock:
+            self._conn.execute("DELETE FROM embeddings")
+            self._conn.commit()
@@ -1,46 +1,156 @@
-import streamlit as st
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+
 import numpy as np
-from openai import OpenAI
+
+from modules import remote
+from modules.embed_cache import EmbeddingCache, make_key, normalize_text
+
+
+@lru_cache(maxsize=None)
+def retryable_errors():
+    """可重试的错误：限流 (429)、服务端错误 (5xx)、网络 / 超时 (openai 导入较慢，首次创建客户端时才导入)"""
+    import openai
+    return (
+        openai.RateLimitError,
+        openai.InternalServerError,
+        openai.APIConnectionError,
+        openai.APITimeoutError,
+    )
+
+
+# 单个批次请求超时 (秒)
+EMBED_TIMEOUT = 30
+
+
+def make_batches(indices, texts, max_chars=8000, max_items=64):
+    """按字符预算切分批次：短文本多装，长文本少装，避免固定条数导致超出 token 上限"""
+    batches = []
+    current, current_chars = [], 0
+    for i in indices:
+        size = len(texts[i])
+        if current and (current_chars + size > max_chars or len(current) >= max_items):
+            batches.append(current)
+            current, current_chars = [], 0
+        current.append(i)
+        current_chars += size
+    if current:
+        batches.append(current)
+    return batches
 
 
 class APIEmbedder:
-    def __init__(self, api_key, base_url, model_name):
-        self.client = OpenAI(api_key=api_key, base_url=base_url)
+    def __init__(self, api_key, base_url, model_name, cache=None,
+                 max_workers=4, max_batch_chars=8000, max_batch_size=64,
+                 max_retries=5, base_delay=1.0):
+        from openai import OpenAI
+        # 重试由我们自己按批次控制，关闭 SDK 内置重试；SDK 默认超时长达 10 分钟，这里收紧
+        self.client = OpenAI(api_key=api_key, base_url=base_url, max_retries=0, timeout=EMBED_TIMEOUT)
         self.model_name = model_name
+        # 磁盘向量缓存：重复上传 / 重建库 / 重复查询时不再重复调用 API
+        self.cache = cache
+        # 并发与批次参数
+        self.max_workers = max_workers
+        self.max_batch_chars = max_batch_chars
+        self.max_batch_size = max_batch_size
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+
+    def _embed_batch(self, batch):
+        """发送单个批次，仅对该批次做指数退避重试；服务连续失败时熔断，冷却期内直接报错"""
+        def send():
+            response = self.client.embeddings.create(input=batch, model=self.model_name)
+            data = sorted(response.data, key=lambda item: item.index)
+            return np.asarray([item.embedding for item in data], dtype=np.float32)
+
+        return remote.call("embedding", send, retries=self.max_retries, base_delay=self.base_delay,
+                           retry_on=retryable_errors())
 
-    def encode(self, texts, batch_size=10):
+    def encode(self, texts, batch_size=None):
         """
-        分批调用 API，防止一次性发送过多导致报错
+        并发分批调用 API：按字符预算切批，多个批次同时在途，结果按原顺序写回
+        已缓存的文本直接读取，只把未命中的部分发送给 API
         """
         if not texts: return np.array([])
 
-        all_embeddings = []
-
         # 移除换行符 (API 最佳实践)
-        clean_texts = [t.replace("\n", " ") for t in texts]
+        clean_texts = [normalize_text(t) for t in texts]
+
+        cached = {}
+        keys = None
+        if self.cache is not None:
+            keys = [make_key(self.model_name, t) for t in clean_texts]
+            cached = self.cache.get_many(keys)
+
+        # 只对未命中的文本去重后调用 API
+        missing = []
+        if keys is None:
+            missing = list(range(len(clean_texts)))
+        else:
+            seen = set()
+            for i, k in enumerate(keys):
+                if k not in cached and k not in seen:
+                    seen.add(k)
+                    missing.append(i)
+
+        max_items = batch_size or self.max_batch_size
+        batches = make_batches(missing, clean_texts, self.max_batch_chars, max_items)
+
+        # 结果矩阵在拿到第一批结果 (得知维度) 后一次性分配
+        out = None
+        if cached:
+            dim = len(next(iter(cached.values())))
+            out = np.empty((len(clean_texts), dim), dtype=np.float32)
 
-        try:
-            # --- 核心修改：分批循环发送 ---
-            for i in range(0, len(clean_texts), batch_size):
-                batch = clean_texts[i: i + batch_size]
+        filled = np.zeros(len(clean_texts), dtype=bool)
+        failed = None
 
-                # 调用 API
-                response = self.client.embeddings.create(
-                    input=batch,
-                    model=self.model_name
-                )
+        if batches:
+            workers = max(1, min(self.max_workers, len(batches)))
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                futures = {
+                    pool.submit(self._embed_batch, [clean_texts[j] for j in idx]): idx
+                    for idx in batches
+                }
+                for future in as_completed(futures):
+                    idx = futures[future]
+                    try:
+                        vectors = future.result()
+                    except Exception as e:
+                        failed = failed or e
+                        continue
 
-                # 收集结果
-                batch_embeddings = [item.embedding for item in response.data]
-                all_embeddings.extend(batch_embeddings)
+                    if out is None:
+                        out = np.empty((len(clean_texts), vectors.shape[1]), dtype=np.float32)
+                    out[idx] = vectors
+                    filled[idx] = True
 
-            return np.array(all_embeddings)
+                    # 每批成功后立即写入缓存：即使其他批次失败，重试时也无需重新计算
+                    if self.cache is not None:
+                        self.cache.put_many([(keys[j], v) for j, v in zip(idx, vectors)])
 
-        except Exception as e:
-            st.error(f"Embedding API 调用失败: {e}")
+        if failed is not None:
+            print(f"Embedding API 调用失败: {failed}")
             return np.array([])
 
+        if keys is None:
+            return out
+
+        # 缓存命中的位置 & 批内重复文本：按缓存键回填
+        by_key = dict(cached)
+        for j in np.flatnonzero(filled):
+            by_key.setdefault(keys[j], out[j])
+        for i in np.flatnonzero(~filled):
+            out[i] = by_key[keys[i]]
+        return out
+
+
+# 进程内单例：同一进程的所有会话 / 请求共享
+@lru_cache(maxsize=None)
+def load_embedding_cache():
+    return EmbeddingCache()
+
 
-@st.cache_resource
+@lru_cache(maxsize=None)
 def load_embedder(api_key, base_url, model_name):
-    return APIEmbedder(api_key, base_url, model_name)
\ No newline at end of file
+    return APIEmbedder(api_key, base_url, model_name, cache=load_embedding_cache())
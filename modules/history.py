@@ -1,12 +1,17 @@
 # modules/history.py
 import os
 import json
-import uuid
+import sqlite3
+import threading
 from datetime import datetime
-import streamlit as st
 
 # 历史记录存储路径
 HISTORY_DIR = "history_data"
+HISTORY_DB = "history.db"
+
+_conn = None
+_conn_path = None
+_lock = threading.RLock()
 
 
 def init_history_dir():
@@ -15,70 +20,289 @@ def init_history_dir():
         os.makedirs(HISTORY_DIR)
 
 
-def save_chat(chat_id, messages):
-    """保存当前对话到 JSON 文件"""
-    if not messages:
-        return
+def _get_conn():
+    """进程内共享的 SQLite 连接；首次打开时建表并迁移旧版 JSON 记录"""
+    global _conn, _conn_path
+    path = os.path.join(HISTORY_DIR, HISTORY_DB)
+    with _lock:
+        if _conn is None or _conn_path != path:
+            init_history_dir()
+            _conn = sqlite3.connect(path, check_same_thread=False)
+            _conn_path = path
+            _conn.execute("PRAGMA journal_mode=WAL")
+            _conn.execute("""
+                CREATE TABLE IF NOT EXISTS chats (
+                    id TEXT PRIMARY KEY,
+                    title TEXT NOT NULL,
+                    created_at TEXT NOT NULL,
+                    updated_at TEXT NOT NULL,
+                    message_count INTEGER NOT NULL DEFAULT 0
+                )
+            """)
+            _conn.execute("CREATE INDEX IF NOT EXISTS idx_chats_updated ON chats(updated_at DESC)")
+            # 消息表只追加：每轮对话只写入新增的消息
+            _conn.execute("""
+                CREATE TABLE IF NOT EXISTS messages (
+                    chat_id TEXT NOT NULL,
+                    seq INTEGER NOT NULL,
+                    role TEXT NOT NULL,
+                    content TEXT NOT NULL,
+                    extra TEXT,
+                    PRIMARY KEY (chat_id, seq)
+                )
+            """)
+            # 助手消息引用了哪些片段；片段被删除前据此留存快照
+            _conn.execute("""
+                CREATE TABLE IF NOT EXISTS chunk_refs (
+                    chunk_id TEXT NOT NULL,
+                    chat_id TEXT NOT NULL,
+                    seq INTEGER NOT NULL,
+                    PRIMARY KEY (chunk_id, chat_id, seq)
+                )
+            """)
+            _conn.execute("CREATE INDEX IF NOT EXISTS idx_refs_chat ON chunk_refs(chat_id)")
+            _conn.execute("""
+                CREATE TABLE IF NOT EXISTS chunk_snapshots (
+                    chunk_id TEXT PRIMARY KEY,
+                    source TEXT,
+                    page TEXT,
+                    content TEXT NOT NULL
+                )
+            """)
+            # 对话记忆的滚动摘要：summary 概括了该对话的前 covered 条消息
+            _conn.execute("""
+                CREATE TABLE IF NOT EXISTS summaries (
+                    chat_id TEXT PRIMARY KEY,
+                    covered INTEGER NOT NULL,
+                    summary TEXT NOT NULL
+                )
+            """)
+            _conn.commit()
+            _migrate_json(_conn)
+        return _conn
+
 
-    init_history_dir()
+def _migrate_json(conn):
+    """把旧版每个对话一个 JSON 文件的记录导入数据库，导入后重命名为 .json.migrated"""
+    for f in os.listdir(HISTORY_DIR):
+        if not f.endswith(".json"):
+            continue
+        filepath = os.path.join(HISTORY_DIR, f)
+        try:
+            with open(filepath, "r", encoding="utf-8") as file:
+                data = json.load(file)
+            chat_id = data.get("id") or f[:-5]
+            timestamp = data.get("timestamp") or _now()
+            with conn:
+                conn.execute("DELETE FROM messages WHERE chat_id = ?", (chat_id,))
+                conn.execute("DELETE FROM chunk_refs WHERE chat_id = ?", (chat_id,))
+                _insert_messages(conn, chat_id, 0, data.get("messages", []))
+                conn.execute(
+                    "INSERT OR REPLACE INTO chats (id, title, created_at, updated_at, message_count) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (chat_id, data.get("title", "未知对话"), timestamp, timestamp,
+                     len(data.get("messages", [])))
+                )
+            os.replace(filepath, filepath + ".migrated")
+        except Exception as e:
+            print(f"历史记录迁移失败 {f}: {e}")
 
+
+def _now():
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
+def _make_title(messages):
     # 提取第一条用户消息作为标题，如果没消息则叫"新对话"
-    title = "新对话"
     for msg in messages:
         if msg["role"] == "user":
-            title = msg["content"][:20] + "..."  # 截取前20个字
-            break
+            return msg["content"][:20] + "..."  # 截取前20个字
+    return "新对话"
+
+
+def _insert_messages(conn, chat_id, start_seq, messages):
+    rows = []
+    for i, msg in enumerate(messages):
+        extra = {k: v for k, v in msg.items() if k not in ("role", "content")}
+        rows.append((chat_id, start_seq + i, msg["role"], msg["content"],
+                     json.dumps(extra, ensure_ascii=False) if extra else None))
+    conn.executemany(
+        "INSERT OR REPLACE INTO messages (chat_id, seq, role, content, extra) VALUES (?, ?, ?, ?, ?)",
+        rows
+    )
+    ref_rows = [
+        (ref["id"], chat_id, start_seq + i)
+        for i, msg in enumerate(messages) for ref in msg.get("refs") or []
+    ]
+    conn.executemany("INSERT OR IGNORE INTO chunk_refs (chunk_id, chat_id, seq) VALUES (?, ?, ?)", ref_rows)
+
+
+def save_chat(chat_id, messages):
+    """保存当前对话：只追加数据库中还没有的消息"""
+    if not messages:
+        return
+
+    conn = _get_conn()
+    now = _now()
+    with _lock, conn:
+        row = conn.execute("SELECT message_count FROM chats WHERE id = ?", (chat_id,)).fetchone()
+        stored = row[0] if row else 0
+
+        if stored > len(messages):
+            # 会话被截断 (如重新生成)，整段重写
+            conn.execute("DELETE FROM messages WHERE chat_id = ?", (chat_id,))
+            conn.execute("DELETE FROM chunk_refs WHERE chat_id = ?", (chat_id,))
+            # 被截掉的消息若已并入摘要，摘要作废
+            conn.execute("DELETE FROM summaries WHERE chat_id = ? AND covered > ?", (chat_id, len(messages)))
+            stored = 0
+        _insert_messages(conn, chat_id, stored, messages[stored:])
 
-    filepath = os.path.join(HISTORY_DIR, f"{chat_id}.json")
+        if row:
+            conn.execute(
+                "UPDATE chats SET updated_at = ?, message_count = ? WHERE id = ?",
+                (now, len(messages), chat_id)
+            )
+        else:
+            conn.execute(
+                "INSERT INTO chats (id, title, created_at, updated_at, message_count) VALUES (?, ?, ?, ?, ?)",
+                (chat_id, _make_title(messages), now, now, len(messages))
+            )
 
-    data = {
-        "id": chat_id,
-        "title": title,
-        "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-        "messages": messages
-    }
 
-    with open(filepath, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+def truncate_chat(chat_id, count):
+    """只保留对话的前 count 条消息 (如重新生成时撤回最后一轮)"""
+    conn = _get_conn()
+    with _lock, conn:
+        conn.execute("DELETE FROM messages WHERE chat_id = ? AND seq >= ?", (chat_id, count))
+        conn.execute("DELETE FROM chunk_refs WHERE chat_id = ? AND seq >= ?", (chat_id, count))
+        # 被截掉的消息若已并入摘要，摘要作废
+        conn.execute("DELETE FROM summaries WHERE chat_id = ? AND covered > ?", (chat_id, count))
+        conn.execute("UPDATE chats SET updated_at = ?, message_count = MIN(message_count, ?) WHERE id = ?",
+                     (_now(), count, chat_id))
+
+
+def append_message(chat_id, message):
+    """追加单条消息 (O(1))"""
+    conn = _get_conn()
+    now = _now()
+    with _lock, conn:
+        row = conn.execute("SELECT message_count FROM chats WHERE id = ?", (chat_id,)).fetchone()
+        if row is None:
+            conn.execute(
+                "INSERT INTO chats (id, title, created_at, updated_at, message_count) VALUES (?, ?, ?, ?, 0)",
+                (chat_id, _make_title([message]), now, now)
+            )
+            seq = 0
+        else:
+            seq = row[0]
+        _insert_messages(conn, chat_id, seq, [message])
+        conn.execute(
+            "UPDATE chats SET updated_at = ?, message_count = ? WHERE id = ?",
+            (now, seq + 1, chat_id)
+        )
 
 
 def load_chat(chat_id):
     """读取指定 ID 的对话记录"""
-    filepath = os.path.join(HISTORY_DIR, f"{chat_id}.json")
-    if os.path.exists(filepath):
-        with open(filepath, "r", encoding="utf-8") as f:
-            data = json.load(f)
-            return data.get("messages", [])
-    return []
-
-
-def get_history_list():
-    """获取所有历史记录列表（按时间倒序）"""
-    init_history_dir()
-    history_list = []
-
-    files = os.listdir(HISTORY_DIR)
-    for f in files:
-        if f.endswith(".json"):
-            filepath = os.path.join(HISTORY_DIR, f)
-            try:
-                with open(filepath, "r", encoding="utf-8") as file:
-                    data = json.load(file)
-                    history_list.append({
-                        "id": data.get("id"),
-                        "title": data.get("title", "未知对话"),
-                        "timestamp": data.get("timestamp", "")
-                    })
-            except:
-                continue
-
-    # 按时间戳倒序排列（最新的在最前）
-    history_list.sort(key=lambda x: x["timestamp"], reverse=True)
-    return history_list
+    conn = _get_conn()
+    with _lock:
+        rows = conn.execute(
+            "SELECT role, content, extra FROM messages WHERE chat_id = ? ORDER BY seq", (chat_id,)
+        ).fetchall()
+    messages = []
+    for role, content, extra in rows:
+        msg = {"role": role, "content": content}
+        if extra:
+            msg.update(json.loads(extra))
+        messages.append(msg)
+    return messages
+
+
+def get_history_list(limit=50, offset=0):
+    """获取历史记录列表（按时间倒序，分页）"""
+    conn = _get_conn()
+    with _lock:
+        rows = conn.execute(
+            "SELECT id, title, updated_at FROM chats ORDER BY updated_at DESC LIMIT ? OFFSET ?",
+            (limit, offset)
+        ).fetchall()
+    return [{"id": r[0], "title": r[1], "timestamp": r[2]} for r in rows]
+
+
+def count_history():
+    """对话总数"""
+    conn = _get_conn()
+    with _lock:
+        return conn.execute("SELECT COUNT(*) FROM chats").fetchone()[0]
 
 
 def delete_chat(chat_id):
     """删除指定对话"""
-    filepath = os.path.join(HISTORY_DIR, f"{chat_id}.json")
-    if os.path.exists(filepath):
-        os.remove(filepath)
\ No newline at end of file
+    conn = _get_conn()
+    with _lock, conn:
+        conn.execute("DELETE FROM messages WHERE chat_id = ?", (chat_id,))
+        conn.execute("DELETE FROM chats WHERE id = ?", (chat_id,))
+        conn.execute("DELETE FROM chunk_refs WHERE chat_id = ?", (chat_id,))
+        conn.execute("DELETE FROM summaries WHERE chat_id = ?", (chat_id,))
+        # 不再被任何消息引用的快照一并清理
+        conn.execute(
+            "DELETE FROM chunk_snapshots WHERE chunk_id NOT IN (SELECT chunk_id FROM chunk_refs)"
+        )
+
+
+def get_summary(chat_id):
+    """对话的滚动摘要 (覆盖的消息条数, 摘要)；没有时返回 (0, "")"""
+    conn = _get_conn()
+    with _lock:
+        row = conn.execute("SELECT covered, summary FROM summaries WHERE chat_id = ?", (chat_id,)).fetchone()
+    return (row[0], row[1]) if row else (0, "")
+
+
+def save_summary(chat_id, covered, summary):
+    conn = _get_conn()
+    with _lock, conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO summaries (chat_id, covered, summary) VALUES (?, ?, ?)",
+            (chat_id, covered, summary)
+        )
+
+
+def referenced_ids(chunk_ids):
+    """从给定片段 ID 中筛选出被聊天记录引用过的"""
+    conn = _get_conn()
+    found = []
+    with _lock:
+        for i in range(0, len(chunk_ids), 500):
+            batch = chunk_ids[i: i + 500]
+            marks = ",".join("?" * len(batch))
+            found += [r[0] for r in conn.execute(
+                f"SELECT DISTINCT chunk_id FROM chunk_refs WHERE chunk_id IN ({marks})", batch
+            )]
+    return found
+
+
+def snapshot_chunks(chunks):
+    """片段即将从向量库删除时保存原文快照 chunks: {id: {"source", "page", "content"}}"""
+    if not chunks:
+        return
+    conn = _get_conn()
+    with _lock, conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO chunk_snapshots (chunk_id, source, page, content) VALUES (?, ?, ?, ?)",
+            [(cid, c["source"], str(c["page"]), c["content"]) for cid, c in chunks.items()]
+        )
+
+
+def get_snapshots(chunk_ids):
+    """读取快照 {id: {"source", "page", "content"}}"""
+    conn = _get_conn()
+    found = {}
+    with _lock:
+        for i in range(0, len(chunk_ids), 500):
+            batch = chunk_ids[i: i + 500]
+            marks = ",".join("?" * len(batch))
+            for cid, source, page, content in conn.execute(
+                f"SELECT chunk_id, source, page, content FROM chunk_snapshots WHERE chunk_id IN ({marks})", batch
+            ):
+                found[cid] = {"source": source, "page": page, "content": content}
+    return found
@@ -0,0 +1,278 @@
+import queue
+import threading
+
+from modules import dedup, manifest, metrics
+from modules.database import add_to_db, delete_pages, delete_file_from_db, get_page_hashes, refresh_manifest
+from modules.processor import count_pages, file_fingerprint, iter_pages, split_page
+
+# 流式管线参数：每批向量化 / 写库的片段数，以及阶段之间队列的最大批次数
+BATCH_SIZE = 64
+QUEUE_SIZE = 4
+
+_DONE = object()
+
+
+class _StageError:
+    """阶段线程内的异常，沿队列传给下游"""
+
+    def __init__(self, message):
+        self.message = message
+
+
+def _put(q, item, stop):
+    """有界队列写入；下游已停止时放弃，避免线程永久阻塞"""
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.2)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _parse_stage(file_name, pages, old_hashes, out_q, stop, progress):
+    """阶段 1：逐页解析 + 切分，跳过指纹未变的页，按批次送往向量化阶段"""
+    batch = []
+    try:
+        for page_num, page_text in pages:
+            if stop.is_set(): return
+            with metrics.stage("ingest_parse"):
+                chunks = split_page(file_name, page_num, page_text)
+            page = str(page_num)
+            progress["seen_pages"].add(page)
+            progress["parsed_pages"] += 1
+            if chunks and old_hashes.get(page) == chunks[0]["page_hash"]:
+                continue
+            progress["parsed_chunks"] += len(chunks)
+            progress["page_chunks"][page] = len(chunks)
+            for c in chunks:
+                batch.append(c)
+                if len(batch) >= BATCH_SIZE:
+                    if not _put(out_q, batch, stop): return
+                    batch = []
+        if batch:
+            _put(out_q, batch, stop)
+    except Exception as e:
+        _put(out_q, _StageError(f"文件处理失败: {e}"), stop)
+        return
+    _put(out_q, _DONE, stop)
+
+
+def _embed_stage(embedder, in_q, out_q, stop, session=None):
+    """
+    阶段 2：按批次向量化
+    session 为去重会话 (dedup.Session) 时先做近重复判定，只向量化规范片段，
+    送往写库阶段的是 (规范片段, 向量, 签名, [(近重复片段, 规范片段 ID), ...])
+    """
+    while not stop.is_set():
+        try:
+            item = in_q.get(timeout=0.2)
+        except queue.Empty:
+            continue
+        if item is _DONE or isinstance(item, _StageError):
+            _put(out_q, item, stop)
+            return
+        signatures, duplicates = None, []
+        try:
+            if session is not None:
+                with metrics.stage("ingest_dedup"):
+                    item, signatures, duplicates = session.classify(item)
+            with metrics.stage("ingest_embed"):
+                vectors = embedder.encode([c["content"] for c in item]) if item else []
+        except Exception as e:
+            vectors, error = [], e
+        else:
+            error = None
+        if len(vectors) != len(item):
+            _put(out_q, _StageError(f"向量计算失败: {error}" if error else "向量计算失败"), stop)
+            return
+        if not _put(out_q, (item, vectors, signatures, duplicates), stop): return
+
+
+def _drop_partial_pages(file_name, progress, written, pages, collection):
+    """
+    入库中途失败时，删除只写入了一部分片段的页：页指纹随每个片段写入，
+    留着的话下次入库会因指纹一致而跳过这些页，缺失的片段再也补不回来
+    """
+    partial = [p for p in pages if written.get(p, 0) < progress["page_chunks"].get(p, 0)]
+    try:
+        delete_pages(file_name, partial, collection)
+    except Exception as e:
+        print(f"清理未写完的页失败 {file_name}: {e}")
+
+
+def is_unchanged(embedder, file_name, file_hash, collection=None):
+    """文件指纹与清单一致且向量模型相同"""
+    record = manifest.get_file(file_name, collection or manifest.DEFAULT_COLLECTION)
+    return (record is not None and record["embedding_model"] == embedder.model_name
+            and record["content_hash"] == file_hash)
+
+
+def ingest_file(embedder, file_name, file_bytes, on_progress=None, pages=None, file_hash=None, collection=None,
+                tags=None, redo_pages=None, on_checkpoint=None):
+    """
+    入库一个文件，整个过程记为一次 "ingest" 追踪 (解析 / 向量化 / 写库分阶段计时)
+    """
+    collection = collection or manifest.DEFAULT_COLLECTION
+    with metrics.start_trace("ingest", file=file_name, collection=collection) as trace:
+        stats = _ingest_file(embedder, file_name, file_bytes, on_progress, pages, file_hash, collection, tags,
+                             redo_pages, on_checkpoint)
+        trace.attrs.update(status=stats["status"], added=stats["added"])
+    return stats
+
+
+def _ingest_file(embedder, file_name, file_bytes, on_progress=None, pages=None, file_hash=None,
+                 collection=manifest.DEFAULT_COLLECTION, tags=None, redo_pages=None, on_checkpoint=None):
+    """
+    流式增量入库：解析页 -> 切分 -> 分批向量化 -> 分批写库，三个阶段通过有界队列并行，
+    峰值内存只与批次大小有关，与文档大小无关
+    1. 文件指纹与清单一致 (且向量模型相同) -> 整个文件跳过
+    2. 否则按页比对指纹，只重新向量化并替换内容变化的页，删除已不存在的页
+    近重复去重 (DEDUP_THRESHOLD > 0)：与知识库中已有片段近似重复的片段不向量化、不写入向量库，只记录回引
+    on_progress(已处理片段数, 预估总片段数) 在每批写入后回调
+    pages 为可选的 (页码, 文本) 迭代器 (如多进程解析结果)，默认在本进程内逐页解析
+    collection 为目标知识库；tags 不为空时覆盖文件标签
+    断点续传 (后台任务队列)：每批写库前先回调 on_checkpoint(本批涉及的页码)，
+    中途崩溃后把最后一次检查点的页码作为 redo_pages 传入，这些页即使指纹一致也重新入库
+    (可能只写入了一部分片段)；其余已写完的页指纹一致，直接跳过
+    返回统计 {"status", "added", "duplicates", "replaced_pages", "removed_pages", "error"}
+    """
+    stats = {"status": "unchanged", "added": 0, "duplicates": 0, "replaced_pages": 0, "removed_pages": 0,
+             "error": None}
+
+    file_hash = file_hash or file_fingerprint(file_bytes)
+    if is_unchanged(embedder, file_name, file_hash, collection):
+        if tags: manifest.set_tags(file_name, tags, collection)
+        return stats
+    record = manifest.get_file(file_name, collection)
+    same_model = record is not None and record["embedding_model"] == embedder.model_name
+
+    try:
+        total_pages = count_pages(file_name, file_bytes)
+    except Exception as e:
+        stats.update(status="error", error=f"文件处理失败: {e}")
+        return stats
+
+    # 向量模型变了，旧向量不可比，整个文件重建
+    if record is not None and not same_model:
+        delete_file_from_db(file_name, collection)
+        old_hashes = {}
+    else:
+        old_hashes = get_page_hashes(file_name, collection)
+    for page in redo_pages or ():
+        if page in old_hashes:
+            old_hashes[page] = None
+
+    threshold = dedup.configured_threshold()
+    session = dedup.Session(collection, file_name, threshold) if threshold > 0 else None
+    progress = {"seen_pages": set(), "parsed_pages": 0, "parsed_chunks": 0, "page_chunks": {}}
+    stop = threading.Event()
+    chunk_q = queue.Queue(maxsize=QUEUE_SIZE)
+    vector_q = queue.Queue(maxsize=QUEUE_SIZE)
+    workers = [
+        threading.Thread(target=metrics.bind_context(_parse_stage), daemon=True,
+                         args=(file_name, pages if pages is not None else iter_pages(file_name, file_bytes),
+                               old_hashes, chunk_q, stop, progress)),
+        threading.Thread(target=metrics.bind_context(_embed_stage), daemon=True,
+                         args=(embedder, chunk_q, vector_q, stop, session)),
+    ]
+    for w in workers: w.start()
+
+    # 阶段 3 (当前线程)：写库。某页的第一批新片段写入前先删除该页旧片段
+    # 一页的片段可能跨批次，written 记录每页已写入的片段数，失败时据此清理写了一半的页
+    replaced = set()
+    written = {}
+    try:
+        while True:
+            item = vector_q.get()
+            if item is _DONE:
+                break
+            if isinstance(item, _StageError):
+                stats.update(status="error", error=item.message)
+                _drop_partial_pages(file_name, progress, written, replaced, collection)
+                return stats
+
+            chunks, vectors, signatures, duplicates = item
+            pages = {str(c["page"]) for c in chunks} | {str(c["page"]) for c, _ in duplicates}
+            stale = pages - replaced
+            replaced |= stale
+            if on_checkpoint:
+                on_checkpoint(sorted(pages))
+            try:
+                with metrics.stage("ingest_write"):
+                    delete_pages(file_name, [p for p in stale if p in old_hashes], collection)
+                    stats["added"] += add_to_db(chunks, vectors, file_hash=file_hash,
+                                                model_name=embedder.model_name, update_manifest=False,
+                                                collection=collection, tags=tags,
+                                                signatures=signatures, duplicates=duplicates)
+            except Exception as e:
+                # 本批可能只写入了一部分 (或旧页已删、新片段未写)，与上游阶段失败一样清理写了一半的页
+                stats.update(status="error", error=f"写入向量库失败: {e}")
+                _drop_partial_pages(file_name, progress, written, replaced, collection)
+                return stats
+            for c in chunks + [c for c, _ in duplicates]:
+                written[str(c["page"])] = written.get(str(c["page"]), 0) + 1
+            if duplicates:
+                stats["duplicates"] += len(duplicates)
+                metrics.incr("dedup_chunks_total", len(duplicates))
+
+            if on_progress:
+                done = stats["added"] + stats["duplicates"]
+                parsed = max(progress["parsed_pages"], 1)
+                remaining = max(total_pages - parsed, 0)
+                estimate = progress["parsed_chunks"] + remaining * progress["parsed_chunks"] / parsed
+                on_progress(done, max(int(estimate), done))
+    finally:
+        stop.set()
+        for w in workers: w.join()
+
+    if not progress["seen_pages"]:
+        stats.update(status="error", error="未能提取到有效文本")
+        return stats
+
+    removed = [p for p in old_hashes if p not in progress["seen_pages"]]
+    delete_pages(file_name, removed, collection)
+    # 整个文件写完才更新清单指纹；中途失败时下次上传会继续补齐未完成的页
+    refresh_manifest({file_name}, file_hash=file_hash, model_name=embedder.model_name,
+                     collection=collection, tags=tags)
+
+    stats["status"] = "updated" if old_hashes else "added"
+    stats["replaced_pages"] = len([p for p in replaced if p in old_hashes])
+    stats["removed_pages"] = len(removed)
+    return stats
+
+
+def ingest_files(embedder, files, engine=None, on_progress=None, collection=None, tags=None):
+    """
+    批量入库 files: [(文件名, 字节流), ...] 到知识库 collection，tags 为这批文件的标签
+    先用指纹过滤掉未变化的文件，剩下的交给 ParseEngine 在进程池中并行解析，
+    再按原顺序逐个流式入库。on_progress(文件在 files 中的序号, 已处理片段数, 预估总片段数)
+    返回 [(文件名, 统计), ...]
+    """
+    collection = collection or manifest.DEFAULT_COLLECTION
+    results = []
+    todo = []
+    for index, (name, data) in enumerate(files):
+        file_hash = file_fingerprint(data)
+        if is_unchanged(embedder, name, file_hash, collection):
+            # 内容未变，只更新标签
+            if tags: manifest.set_tags(name, tags, collection)
+            results.append((name, {"status": "unchanged", "added": 0, "duplicates": 0, "replaced_pages": 0,
+                                   "removed_pages": 0, "error": None}))
+        else:
+            todo.append((index, name, data, file_hash))
+
+    if engine is None:
+        parsed = ((name, data, None) for _, name, data, _ in todo)
+    else:
+        parsed = engine.prefetch([(name, data) for _, name, data, _ in todo])
+
+    for (index, _, _, file_hash), (name, data, pages) in zip(todo, parsed):
+        callback = None
+        if on_progress:
+            def callback(done, estimate, index=index):
+                on_progress(index, done, estimate)
+        stats = ingest_file(embedder, name, data, on_progress=callback,
+                            pages=pages, file_hash=file_hash, collection=collection, tags=tags)
+        results.append((name, stats))
+    return results
@@ -0,0 +1,422 @@
+"""
+后台入库任务队列 (SQLite 持久化)
+- submit 把上传的文件落盘到 UPLOAD_DIR 并登记任务，立即返回任务 ID，页面 / 请求不再阻塞
+- 后台 worker 线程是向量库的唯一写入者：页面、API worker、命令行各进程都可以启动 worker，
+  但只有持有租约 (lease) 的那个会处理任务；队列空闲时释放租约，其他进程随时接手
+- 删除文件、清空知识库通过 writer_lease 取得同一个租约，不会与正在入库的 worker 同时写库
+- 每个文件流式分批写库，每批写入前记录检查点 (本批涉及的页)；进程崩溃 / 重启后，
+  已完成的文件不再处理，进行中的文件只重做检查点上的页，其余已写完的页按指纹跳过
+- 入库失败的文件保留检查点，之后的任务再次入库同一文件时重做这些页，直到该文件成功入库
+- 写库期间检索照常进行，只读到已提交的片段
+- 任务状态与吞吐量 (片段 / 秒) 供页面侧边栏、API 轮询
+"""
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from modules import manifest, metrics
+from modules.ingest import ingest_file, is_unchanged
+from modules.processor import file_fingerprint
+
+# 任务库与上传文件的落盘目录
+JOBS_PATH = "./jobs.db"
+UPLOAD_DIR = "./job_uploads"
+# 租约有效期 (秒)：持有者超过该时间没有心跳，视为已崩溃，其他进程可以接管
+# 处理任务期间由独立的心跳线程每 LEASE_TTL / 3 秒续期，单批向量化 (含重试退避) 再久也不会过期
+LEASE_TTL = 60.0
+# worker 空闲时查询新任务的间隔 (秒)
+POLL_INTERVAL = 1.0
+# 删除文件 / 清空知识库等直接写库的操作等待租约的最长时间 (秒)
+WRITE_WAIT = 120.0
+
+_conn = None
+_conn_path = None
+_lock = threading.RLock()
+# 本进程提交任务时唤醒空闲的 worker (其他进程提交的任务靠轮询发现)
+_wake = threading.Event()
+
+
+def _get_conn():
+    """进程内共享的 SQLite 连接 (路径变化时重新打开)"""
+    global _conn, _conn_path
+    with _lock:
+        if _conn is None or _conn_path != JOBS_PATH:
+            _conn = sqlite3.connect(JOBS_PATH, check_same_thread=False, timeout=30)
+            _conn_path = JOBS_PATH
+            _conn.execute("PRAGMA journal_mode=WAL")
+            _conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    collection TEXT NOT NULL,
+                    tags TEXT,
+                    status TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    started_at REAL,
+                    finished_at REAL,
+                    error TEXT
+                )
+            """)
+            # 每个文件一行；checkpoint 为最后一次写库前记录的页码 (JSON 列表)
+            _conn.execute("""
+                CREATE TABLE IF NOT EXISTS job_files (
+                    job_id TEXT NOT NULL,
+                    seq INTEGER NOT NULL,
+                    name TEXT NOT NULL,
+                    path TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    added INTEGER NOT NULL DEFAULT 0,
+                    estimate INTEGER NOT NULL DEFAULT 0,
+                    checkpoint TEXT,
+                    result TEXT,
+                    PRIMARY KEY (job_id, seq)
+                )
+            """)
+            _conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status, created_at)")
+            _conn.execute("""
+                CREATE TABLE IF NOT EXISTS lease (
+                    id INTEGER PRIMARY KEY CHECK (id = 1),
+                    owner TEXT,
+                    heartbeat REAL
+                )
+            """)
+            _conn.execute("INSERT OR IGNORE INTO lease (id, owner, heartbeat) VALUES (1, NULL, 0)")
+            _conn.commit()
+        return _conn
+
+
+def submit(files, collection=None, tags=None):
+    """登记入库任务 files: [(文件名, 字节流), ...]，文件先落盘，返回任务 ID"""
+    job_id = uuid.uuid4().hex[:12]
+    job_dir = os.path.join(UPLOAD_DIR, job_id)
+    os.makedirs(job_dir, exist_ok=True)
+    rows = []
+    for seq, (name, data) in enumerate(files):
+        path = os.path.join(job_dir, f"{seq:04d}")
+        with open(path, "wb") as f:
+            f.write(data)
+        rows.append((job_id, seq, name, path, "queued"))
+
+    tags = manifest.split_tags(tags)
+    with _lock:
+        conn = _get_conn()
+        conn.execute(
+            "INSERT INTO jobs (id, collection, tags, status, created_at) VALUES (?, ?, ?, 'queued', ?)",
+            (job_id, collection or manifest.DEFAULT_COLLECTION, ",".join(tags) or None, time.time())
+        )
+        conn.executemany("INSERT INTO job_files (job_id, seq, name, path, status) VALUES (?, ?, ?, ?, ?)", rows)
+        conn.commit()
+    metrics.incr("ingest_jobs_submitted_total")
+    _wake.set()
+    return job_id
+
+
+def _job_dict(row, files):
+    job_id, collection, tags, status, created_at, started_at, finished_at, error = row
+    added = sum(f["added"] for f in files)
+    elapsed = ((finished_at or time.time()) - started_at) if started_at else 0.0
+    return {
+        "id": job_id,
+        "collection": collection,
+        "tags": manifest.split_tags(tags),
+        "status": status,
+        "created_at": created_at,
+        "started_at": started_at,
+        "finished_at": finished_at,
+        "error": error,
+        "files": files,
+        "total_files": len(files),
+        "done_files": sum(1 for f in files if f["status"] in ("done", "error")),
+        "added": added,
+        "chunks_per_sec": added / elapsed if elapsed > 0 else 0.0,
+    }
+
+
+def _file_rows(conn, job_id):
+    rows = conn.execute(
+        "SELECT seq, name, status, added, estimate, result FROM job_files WHERE job_id = ? ORDER BY seq",
+        (job_id,)
+    ).fetchall()
+    return [
+        {"seq": seq, "name": name, "status": status, "added": added, "estimate": estimate,
+         "result": json.loads(result) if result else None}
+        for seq, name, status, added, estimate, result in rows
+    ]
+
+
+def get_job(job_id):
+    """任务状态 (含每个文件的进度)；不存在时返回 None"""
+    with _lock:
+        conn = _get_conn()
+        row = conn.execute(
+            "SELECT id, collection, tags, status, created_at, started_at, finished_at, error FROM jobs WHERE id = ?",
+            (job_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        return _job_dict(row, _file_rows(conn, job_id))
+
+
+def list_jobs(limit=20, active_only=False):
+    """最近的任务，新的在前；active_only 时只返回排队中 / 进行中的任务"""
+    where = "WHERE status IN ('queued', 'running')" if active_only else ""
+    with _lock:
+        conn = _get_conn()
+        rows = conn.execute(
+            "SELECT id, collection, tags, status, created_at, started_at, finished_at, error "
+            f"FROM jobs {where} ORDER BY created_at DESC LIMIT ?", (limit,)
+        ).fetchall()
+        return [_job_dict(row, _file_rows(conn, row[0])) for row in rows]
+
+
+def wait(job_id, on_progress=None, interval=0.2):
+    """
+    阻塞等待任务结束 (命令行 / 同步 API 使用)，返回 [(文件名, 统计), ...]
+    on_progress(文件序号, 已写入片段数, 预估总片段数) 在进度变化时回调
+    """
+    last = None
+    while True:
+        job = get_job(job_id)
+        if job is None:
+            raise ValueError(f"任务不存在: {job_id}")
+        for f in job["files"]:
+            if f["status"] == "running" and on_progress and (f["seq"], f["added"]) != last:
+                last = (f["seq"], f["added"])
+                on_progress(f["seq"], f["added"], f["estimate"])
+        if job["status"] in ("done", "error"):
+            if job["error"]:
+                raise RuntimeError(job["error"])
+            return [(f["name"], f["result"]) for f in job["files"]]
+        time.sleep(interval)
+
+
+# --- 租约：保证同一时刻只有一个 worker 写向量库 ---
+def acquire_lease(owner):
+    """租约空闲、已过期或本来就属于 owner 时取得 (并续期)，返回是否持有"""
+    now = time.time()
+    with _lock:
+        conn = _get_conn()
+        cur = conn.execute(
+            "UPDATE lease SET owner = ?, heartbeat = ? "
+            "WHERE id = 1 AND (owner IS NULL OR owner = ? OR heartbeat < ?)",
+            (owner, now, owner, now - LEASE_TTL)
+        )
+        conn.commit()
+        return cur.rowcount == 1
+
+
+def release_lease(owner):
+    with _lock:
+        conn = _get_conn()
+        conn.execute("UPDATE lease SET owner = NULL WHERE id = 1 AND owner = ?", (owner,))
+        conn.commit()
+
+
+@contextmanager
+def writer_lease(timeout=WRITE_WAIT):
+    """
+    任务队列之外的写库操作 (删除文件、清空知识库) 先取得租约，与各进程的后台 worker 互斥；
+    worker 正在处理任务时等待队列空闲，超过 timeout 秒抛出 TimeoutError
+    """
+    owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+    deadline = time.time() + timeout
+    while not acquire_lease(owner):
+        if time.time() >= deadline:
+            raise TimeoutError("后台入库任务进行中，请稍后再试")
+        time.sleep(0.1)
+    try:
+        yield
+    finally:
+        release_lease(owner)
+
+
+class LeaseLost(RuntimeError):
+    """租约被其他进程接管 (本进程心跳中断过久)，立即停止写库"""
+
+
+class JobWorker:
+    """后台入库线程：取得租约后按提交顺序处理任务，队列空闲时释放租约"""
+
+    def __init__(self, embedder, engine=None):
+        self.embedder = embedder
+        self.engine = engine
+        self.owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._stop = threading.Event()
+        self._lost = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="ingest-worker", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def is_alive(self):
+        return self._thread.is_alive()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        _wake.set()
+        self._thread.join(timeout)
+
+    def _next_job(self):
+        """最早提交的未完成任务；进行中的任务 (上一个持有者崩溃留下的) 优先续跑"""
+        with _lock:
+            return _get_conn().execute(
+                "SELECT id, collection, tags FROM jobs WHERE status IN ('queued', 'running') "
+                "ORDER BY status = 'running' DESC, created_at LIMIT 1"
+            ).fetchone()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                job = self._next_job()
+                if job is None:
+                    release_lease(self.owner)
+                elif acquire_lease(self.owner):
+                    self._process(*job)
+                    continue
+            except Exception as e:
+                print(f"入库任务处理失败: {e}")
+            _wake.wait(POLL_INTERVAL)
+            _wake.clear()
+        release_lease(self.owner)
+
+    def _heartbeat(self):
+        if self._lost.is_set() or not acquire_lease(self.owner):
+            raise LeaseLost("入库租约已被其他进程接管")
+
+    def _keep_alive(self, finished):
+        """
+        心跳线程：处理任务期间定期续租，不依赖入库各阶段的进度 (向量化一批可能因重试阻塞数分钟)
+        续租失败说明租约已被接管，记下后由写库前的 _heartbeat 中止本任务
+        """
+        while not finished.wait(LEASE_TTL / 3):
+            try:
+                if not acquire_lease(self.owner):
+                    self._lost.set()
+                    return
+            except Exception as e:
+                print(f"入库租约续期失败: {e}")
+
+    def _update_file(self, job_id, seq, **fields):
+        sets = ", ".join(f"{k} = ?" for k in fields)
+        with _lock:
+            conn = _get_conn()
+            conn.execute(f"UPDATE job_files SET {sets} WHERE job_id = ? AND seq = ?",
+                         list(fields.values()) + [job_id, seq])
+            conn.commit()
+
+    def _finish_job(self, job_id, status, error=None):
+        with _lock:
+            conn = _get_conn()
+            conn.execute("UPDATE jobs SET status = ?, finished_at = ?, error = ? WHERE id = ?",
+                         (status, time.time(), error, job_id))
+            conn.commit()
+        shutil.rmtree(os.path.join(UPLOAD_DIR, job_id), ignore_errors=True)
+        metrics.incr("ingest_jobs_finished_total", status=status)
+
+    def _failed_checkpoint(self, job_id, name, collection):
+        """同一知识库中该文件此前失败 / 中断的入库留下的检查点页码，没有时为 None"""
+        with _lock:
+            row = _get_conn().execute(
+                "SELECT f.checkpoint FROM job_files f JOIN jobs j ON j.id = f.job_id "
+                "WHERE f.name = ? AND j.collection = ? AND f.job_id != ? AND f.checkpoint IS NOT NULL "
+                "AND j.status NOT IN ('queued', 'running') ORDER BY j.created_at DESC LIMIT 1",
+                (name, collection, job_id)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _clear_checkpoints(self, name, collection):
+        """文件成功入库后，此前失败留下的检查点不再需要"""
+        with _lock:
+            conn = _get_conn()
+            conn.execute("UPDATE job_files SET checkpoint = NULL WHERE name = ? AND checkpoint IS NOT NULL "
+                         "AND job_id IN (SELECT id FROM jobs WHERE collection = ?)", (name, collection))
+            conn.commit()
+
+    def _process(self, job_id, collection, tags):
+        with _lock:
+            conn = _get_conn()
+            conn.execute("UPDATE jobs SET status = 'running', started_at = COALESCE(started_at, ?) WHERE id = ?",
+                         (time.time(), job_id))
+            conn.commit()
+            files = conn.execute(
+                "SELECT seq, name, path, checkpoint FROM job_files "
+                "WHERE job_id = ? AND status IN ('queued', 'running') ORDER BY seq", (job_id,)
+            ).fetchall()
+
+        self._lost.clear()
+        finished = threading.Event()
+        threading.Thread(target=self._keep_alive, args=(finished,), name="ingest-lease", daemon=True).start()
+        try:
+            # 先用指纹过滤掉未变化的文件 (只更新标签)，剩下的交给进程池并行解析
+            todo = []
+            for seq, name, path, checkpoint in files:
+                with open(path, "rb") as f:
+                    data = f.read()
+                file_hash = file_fingerprint(data)
+                if is_unchanged(self.embedder, name, file_hash, collection):
+                    if tags: manifest.set_tags(name, tags, collection)
+                    result = {"status": "unchanged", "added": 0, "duplicates": 0, "replaced_pages": 0,
+                              "removed_pages": 0, "error": None}
+                    self._update_file(job_id, seq, status="done", result=json.dumps(result))
+                else:
+                    redo_pages = set(json.loads(checkpoint)) if checkpoint else set()
+                    redo_pages |= set(self._failed_checkpoint(job_id, name, collection) or ())
+                    todo.append((seq, name, data, file_hash, sorted(redo_pages) or None))
+
+            if self.engine is None:
+                parsed = ((name, data, None) for _, name, data, _, _ in todo)
+            else:
+                parsed = self.engine.prefetch([(name, data) for _, name, data, _, _ in todo])
+
+            for (seq, _, _, file_hash, redo_pages), (name, data, pages) in zip(todo, parsed):
+                self._heartbeat()
+                self._update_file(job_id, seq, status="running")
+
+                def on_checkpoint(pages_in_batch, seq=seq):
+                    self._heartbeat()
+                    self._update_file(job_id, seq, checkpoint=json.dumps(pages_in_batch))
+
+                def on_progress(done, estimate, seq=seq):
+                    self._update_file(job_id, seq, added=done, estimate=estimate)
+
+                stats = ingest_file(self.embedder, name, data, on_progress=on_progress, pages=pages,
+                                    file_hash=file_hash, collection=collection, tags=tags,
+                                    redo_pages=redo_pages, on_checkpoint=on_checkpoint)
+                result = json.dumps(stats, ensure_ascii=False)
+                if stats["error"]:
+                    # 保留检查点：检查点上的页可能只写入了一部分，下次入库该文件时重做
+                    self._update_file(job_id, seq, status="error", added=stats["added"], result=result)
+                else:
+                    self._update_file(job_id, seq, status="done", added=stats["added"], checkpoint=None,
+                                      result=result)
+                    self._clear_checkpoints(name, collection)
+        except LeaseLost as e:
+            # 另一个 worker 会从检查点续跑，本任务保持 running
+            print(f"入库任务 {job_id} 中断: {e}")
+            return
+        except Exception as e:
+            self._finish_job(job_id, "error", str(e))
+            return
+        finally:
+            finished.set()
+        self._finish_job(job_id, "done")
+
+
+_worker = None
+_worker_lock = threading.Lock()
+
+
+def ensure_worker(embedder, engine=None):
+    """本进程的后台 worker (首次调用时启动)；是否真正写库由租约决定"""
+    global _worker
+    with _worker_lock:
+        if _worker is None or not _worker.is_alive() or _worker.embedder is not embedder:
+            if _worker is not None:
+                _worker.stop(timeout=0)
+            _worker = JobWorker(embedder, engine).start()
+        return _worker
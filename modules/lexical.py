@@ -0,0 +1,242 @@
+"""
+本地关键词索引 (BM25)：基于 SQLite FTS5，与向量库同步增删
+- 片段原文存在共用的 docs 表 (按 collection 列区分)，每个知识库一张 FTS 表，
+  BM25 的词频 / 文档数统计只来自本知识库，不受其他知识库增长的影响
+- 中文按字 + 相邻二字建索引，英文 / 数字按词切分 (保留型号、缩写中的 - _ . 连接符)
+- 查询时中文只用二元组 (单字几乎命中所有片段)，先要求命中全部检索词，结果不足 top_k 时再放宽为命中任一
+"""
+import re
+import sqlite3
+import threading
+
+# 关键词索引存储路径
+LEXICAL_PATH = "./lexical.db"
+# 未指定知识库时使用的默认集合
+DEFAULT_COLLECTION = "knowledge_base"
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+(?:[-_.][a-z0-9]+)*|[\u3400-\u9fff\uf900-\ufaff]+")
+_CJK_RE = re.compile(r"[\u3400-\u9fff\uf900-\ufaff]")
+
+# docs 表结构版本 (PRAGMA user_version)：2 起每个知识库一张 FTS 表
+_SCHEMA_VERSION = 2
+
+_conn = None
+_conn_path = None
+_lock = threading.RLock()
+_fts_tables = set()
+
+
+def tokenize(text):
+    """把文本切成检索词列表"""
+    tokens = []
+    for match in _TOKEN_RE.findall(text.lower()):
+        if _CJK_RE.match(match):
+            # 中文：单字 + 二元组，兼顾召回与精度
+            tokens.extend(match)
+            tokens.extend(match[i: i + 2] for i in range(len(match) - 1))
+        else:
+            tokens.append(match)
+    return tokens
+
+
+def query_tokens(text):
+    """检索词：中文连续两字以上时只取二元组，单字只在孤立出现时使用；英文 / 数字同 tokenize"""
+    tokens = []
+    for match in _TOKEN_RE.findall(text.lower()):
+        if _CJK_RE.match(match) and len(match) > 1:
+            tokens.extend(match[i: i + 2] for i in range(len(match) - 1))
+        else:
+            tokens.append(match)
+    return list(dict.fromkeys(tokens))
+
+
+def _fts(collection):
+    """知识库对应的 FTS 表名 (已加引号，可直接拼进 SQL)"""
+    return '"fts_' + collection.replace('"', '""') + '"'
+
+
+def _ensure_fts(conn, collection):
+    """按需创建知识库的 FTS 表，返回表名"""
+    table = _fts(collection)
+    if (_conn_path, table) not in _fts_tables:
+        # 分词在 Python 侧完成，FTS5 只按空格切分；tokenchars 保留型号里的连接符
+        conn.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS {table} USING fts5("
+                     "tokens, tokenize=\"unicode61 tokenchars '-_.'\")")
+        _fts_tables.add((_conn_path, table))
+    return table
+
+
+def _get_conn():
+    """进程内共享的 SQLite 连接 (路径变化时重新打开)"""
+    global _conn, _conn_path
+    with _lock:
+        if _conn is None or _conn_path != LEXICAL_PATH:
+            _conn = sqlite3.connect(LEXICAL_PATH, check_same_thread=False)
+            _conn_path = LEXICAL_PATH
+            _conn.execute("PRAGMA journal_mode=WAL")
+            columns = [r[1] for r in _conn.execute("PRAGMA table_info(docs)")]
+            # 旧版索引只有一个知识库 (id 全局唯一)：整表迁移到默认知识库，rowid 不变，FTS 表无需重建
+            if columns and "collection" not in columns:
+                _conn.execute("ALTER TABLE docs RENAME TO docs_old")
+                _conn.execute("DROP INDEX IF EXISTS idx_docs_source")
+            _conn.execute(f"""
+                CREATE TABLE IF NOT EXISTS docs (
+                    rowid INTEGER PRIMARY KEY,
+                    collection TEXT NOT NULL DEFAULT '{DEFAULT_COLLECTION}',
+                    id TEXT NOT NULL,
+                    source TEXT NOT NULL,
+                    page TEXT NOT NULL,
+                    content TEXT NOT NULL,
+                    "offset" INTEGER,
+                    UNIQUE (collection, id)
+                )
+            """)
+            if columns and "collection" not in columns:
+                offset = '"offset"' if "offset" in columns else "NULL"
+                _conn.execute(
+                    'INSERT INTO docs (rowid, id, source, page, content, "offset") '
+                    f"SELECT rowid, id, source, page, content, {offset} FROM docs_old"
+                )
+                _conn.execute("DROP TABLE docs_old")
+            _conn.execute("CREATE INDEX IF NOT EXISTS idx_docs_source ON docs(collection, source, page)")
+            if _conn.execute("PRAGMA user_version").fetchone()[0] < _SCHEMA_VERSION:
+                _migrate_fts(_conn)
+            _conn.commit()
+        return _conn
+
+
+def _migrate_fts(conn):
+    """旧版所有知识库共用一张 fts 表：按知识库拆表 (rowid 不变)，从 docs 原文重新分词"""
+    conn.execute("DROP TABLE IF EXISTS fts")
+    for (collection,) in conn.execute("SELECT DISTINCT collection FROM docs").fetchall():
+        table = _ensure_fts(conn, collection)
+        rows = conn.execute("SELECT rowid, content FROM docs WHERE collection = ?", (collection,)).fetchall()
+        conn.executemany(f"INSERT INTO {table} (rowid, tokens) VALUES (?, ?)",
+                         [(rowid, " ".join(tokenize(content))) for rowid, content in rows])
+    conn.execute(f"PRAGMA user_version = {_SCHEMA_VERSION}")
+
+
+def _delete_rowids(conn, collection, rowids):
+    table = _ensure_fts(conn, collection)
+    for i in range(0, len(rowids), 500):
+        batch = rowids[i: i + 500]
+        marks = ",".join("?" * len(batch))
+        conn.execute(f"DELETE FROM {table} WHERE rowid IN ({marks})", batch)
+        conn.execute(f"DELETE FROM docs WHERE rowid IN ({marks})", batch)
+
+
+def add(ids, chunks, collection=DEFAULT_COLLECTION):
+    """写入 / 覆盖片段 (与 add_to_db 的 upsert 语义一致)"""
+    if not ids: return
+    conn = _get_conn()
+    with _lock, conn:
+        existing = []
+        for i in range(0, len(ids), 500):
+            batch = ids[i: i + 500]
+            marks = ",".join("?" * len(batch))
+            existing += [r[0] for r in conn.execute(
+                f"SELECT rowid FROM docs WHERE collection = ? AND id IN ({marks})", [collection] + batch
+            )]
+        _delete_rowids(conn, collection, existing)
+
+        table = _ensure_fts(conn, collection)
+        for chunk_id, c in zip(ids, chunks):
+            cur = conn.execute(
+                'INSERT INTO docs (collection, id, source, page, content, "offset") VALUES (?, ?, ?, ?, ?, ?)',
+                (collection, chunk_id, c["source"], str(c.get("page", "N/A")), c["content"], c.get("offset"))
+            )
+            conn.execute(f"INSERT INTO {table} (rowid, tokens) VALUES (?, ?)",
+                         (cur.lastrowid, " ".join(tokenize(c["content"]))))
+
+
+def delete_source(source, pages=None, collection=DEFAULT_COLLECTION):
+    """删除某个文件 (或其中指定页) 的全部片段"""
+    conn = _get_conn()
+    with _lock, conn:
+        if pages is None:
+            rows = conn.execute("SELECT rowid FROM docs WHERE collection = ? AND source = ?",
+                                (collection, source)).fetchall()
+        else:
+            pages = [str(p) for p in pages]
+            if not pages: return
+            marks = ",".join("?" * len(pages))
+            rows = conn.execute(
+                f"SELECT rowid FROM docs WHERE collection = ? AND source = ? AND page IN ({marks})",
+                [collection, source] + pages
+            ).fetchall()
+        _delete_rowids(conn, collection, [r[0] for r in rows])
+
+
+def clear(collection=DEFAULT_COLLECTION):
+    conn = _get_conn()
+    with _lock, conn:
+        rows = conn.execute("SELECT rowid FROM docs WHERE collection = ?", (collection,)).fetchall()
+        _delete_rowids(conn, collection, [r[0] for r in rows])
+
+
+def count(collection=DEFAULT_COLLECTION):
+    conn = _get_conn()
+    with _lock:
+        return conn.execute("SELECT COUNT(*) FROM docs WHERE collection = ?", (collection,)).fetchone()[0]
+
+
+def search(query, top_k=50, collection=DEFAULT_COLLECTION, sources=None, ids=None):
+    """
+    BM25 检索，返回与 query_db 相同结构的结果 (score 为 BM25 分数，越大越相关)
+    sources 不为 None 时只在这些文件中检索；ids 为范围外但也要检索的片段 (范围内文件的近重复片段对应的规范片段)
+    """
+    tokens = query_tokens(query)
+    if not tokens or (sources is not None and not sources):
+        return []
+    terms = ['"' + t.replace('"', '""') + '"' for t in tokens]
+
+    conn = _get_conn()
+    with _lock:
+        table = _ensure_fts(conn, collection)
+    sql = (f'SELECT docs.id, docs.source, docs.page, docs.content, docs."offset", bm25({table}) AS rank '
+           f"FROM {table} JOIN docs ON docs.rowid = {table}.rowid WHERE {table} MATCH ?")
+    params = []
+    if sources is not None:
+        sources = list(sources)
+        clause = f"docs.source IN ({','.join('?' * len(sources))})"
+        params += sources
+        if ids:
+            ids = list(ids)
+            clause = f"({clause} OR docs.id IN ({','.join('?' * len(ids))}))"
+            params += ids
+        sql += " AND " + clause
+    sql += " ORDER BY rank LIMIT ?"
+
+    with _lock:
+        # 先要求命中全部检索词 (只需遍历最短的倒排表)；不足 top_k 时放宽为命中任一，
+        # 两次查询对同一片段的 BM25 分数相同，直接用放宽后的结果
+        rows = conn.execute(sql, [" AND ".join(terms)] + params + [top_k]).fetchall()
+        if len(rows) < top_k and len(terms) > 1:
+            rows = conn.execute(sql, [" OR ".join(terms)] + params + [top_k]).fetchall()
+    # FTS5 的 bm25() 越小越相关，这里取反
+    return [
+        {"id": r[0], "source": r[1], "page": r[2], "content": r[3], "offset": r[4], "score": -r[5],
+         "collection": collection}
+        for r in rows
+    ]
+
+
+def rebuild(store, collection=DEFAULT_COLLECTION, page_size=2000):
+    """从向量库全量重建某个知识库的关键词索引"""
+    clear(collection)
+    offset = 0
+    total = 0
+    while True:
+        data = store.get(include=["documents", "metadatas"], limit=page_size, offset=offset)
+        ids = data.get("ids") or []
+        if not ids:
+            break
+        chunks = [
+            {"content": doc, "source": meta["source"], "page": meta.get("page", "N/A"),
+             "offset": meta.get("offset")}
+            for doc, meta in zip(data["documents"], data["metadatas"])
+        ]
+        add(ids, chunks, collection=collection)
+        offset += len(ids)
+        total += len(ids)
+    return total
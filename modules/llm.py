@@ -1,15 +1,63 @@
-import streamlit as st
-from openai import OpenAI
+import time
+from functools import lru_cache
+
+from modules.config import load_settings
+from modules.metrics import observe
+
 
 def get_api_client():
     """安全获取 API Client"""
     try:
-        api_key = st.secrets.get("DEEPSEEK_API_KEY", None)
-        base_url = st.secrets.get("DEEPSEEK_BASE_URL", "https://api.deepseek.com")
+        settings = load_settings()
+        api_key = settings.get("DEEPSEEK_API_KEY")
+        base_url = settings.get("DEEPSEEK_BASE_URL")
     except Exception:
         return None, None
     return api_key, base_url
 
+
+@lru_cache(maxsize=None)
+def load_llm_client(api_key, base_url):
+    from openai import OpenAI  # 延迟导入：只在首次创建客户端时加载 SDK
+    return OpenAI(api_key=api_key, base_url=base_url)
+
+
+def build_system_prompt(local_context="", web_context="", summary=""):
+    """组装 Prompt：本地知识 + 网络信息 (+ 多轮对话时更早轮次的摘要)"""
+    prompt = ""
+    if summary: prompt += f"【之前的对话摘要】:\n{summary}\n\n"
+    if local_context: prompt += f"【本地知识】:\n{local_context}\n\n"
+    if web_context: prompt += f"【网络信息】:\n{web_context}\n\n"
+    return f"请基于以下背景回答问题。必须标注来源 [来源: xxx]。\n\n{prompt}"
+
+
+def stream_answer(client, system_prompt, query, temperature=0.3, model_name="deepseek-chat", history=None):
+    """
+    流式生成回答，逐段产出文本；同时记录首 token 延迟 (llm_ttft) 和总耗时 (llm_total)
+    history 为最近几轮对话 [{"role", "content"}, ...]，放在系统提示与本轮问题之间
+    """
+    start = time.perf_counter()
+    stream = client.chat.completions.create(
+        model=model_name,
+        messages=[
+            {"role": "system", "content": system_prompt},
+            *(history or []),
+            {"role": "user", "content": query}
+        ],
+        temperature=temperature,
+        stream=True
+    )
+    first = True
+    for chunk in stream:
+        if not chunk.choices or not chunk.choices[0].delta.content:
+            continue
+        if first:
+            observe("llm_ttft", time.perf_counter() - start)
+            first = False
+        yield chunk.choices[0].delta.content
+    observe("llm_total", time.perf_counter() - start)
+
+
 def ask_deepseek(client, context, query, model_name="deepseek-chat"):
     """
     构建 Prompt 并请求流式响应
@@ -35,4 +83,4 @@ def ask_deepseek(client, context, query, model_name="deepseek-chat"):
         )
         return stream
     except Exception as e:
-        raise e
\ No newline at end of file
+        raise e
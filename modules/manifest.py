@@ -0,0 +1,262 @@
+"""
+文件清单 (manifest)：每个文件一条记录，侧边栏文件列表直接读取这里，
+不再每次把所有片段的 metadata 从 Chroma 里扫一遍
+
+每条记录属于一个知识库 (collection)，并带有可选的文件标签，用于检索前按文件筛选范围
+
+清单在向量库写入成功之后才更新，两者不在同一个事务里：中途失败时清单可能与向量库不一致
+检查 / 修正不一致的记录：python -m modules.manifest check|repair [--collection 名称]
+修复 / 重建：python -m modules.manifest rebuild [--collection 名称]
+"""
+import argparse
+import sqlite3
+import threading
+
+# 清单存储路径
+MANIFEST_PATH = "./manifest.db"
+# 未指定知识库时使用的默认集合
+DEFAULT_COLLECTION = "knowledge_base"
+
+_COLUMNS = ("name", "content_hash", "chunk_count", "page_count", "ingested_at", "embedding_model", "tags")
+
+_conn = None
+_conn_path = None
+_lock = threading.RLock()
+
+
+def _get_conn():
+    """进程内共享的 SQLite 连接 (路径变化时重新打开)"""
+    global _conn, _conn_path
+    with _lock:
+        if _conn is None or _conn_path != MANIFEST_PATH:
+            _conn = sqlite3.connect(MANIFEST_PATH, check_same_thread=False)
+            _conn_path = MANIFEST_PATH
+            _conn.execute("PRAGMA journal_mode=WAL")
+            columns = [r[1] for r in _conn.execute("PRAGMA table_info(files)")]
+            # 旧版清单只有一个知识库 (主键为文件名)：整表迁移到默认知识库
+            if columns and "collection" not in columns:
+                _conn.execute("ALTER TABLE files RENAME TO files_old")
+            _conn.execute(f"""
+                CREATE TABLE IF NOT EXISTS files (
+                    collection TEXT NOT NULL DEFAULT '{DEFAULT_COLLECTION}',
+                    name TEXT NOT NULL,
+                    content_hash TEXT,
+                    chunk_count INTEGER NOT NULL,
+                    page_count INTEGER NOT NULL,
+                    ingested_at REAL,
+                    embedding_model TEXT,
+                    tags TEXT,
+                    PRIMARY KEY (collection, name)
+                )
+            """)
+            if columns and "collection" not in columns:
+                _conn.execute(
+                    "INSERT INTO files (name, content_hash, chunk_count, page_count, ingested_at, embedding_model) "
+                    "SELECT name, content_hash, chunk_count, page_count, ingested_at, embedding_model FROM files_old"
+                )
+                _conn.execute("DROP TABLE files_old")
+            # 每个知识库的内容版本号，写库后加一 (查询缓存据此失效)
+            _conn.execute("""
+                CREATE TABLE IF NOT EXISTS versions (
+                    collection TEXT PRIMARY KEY,
+                    version INTEGER NOT NULL
+                )
+            """)
+            _conn.commit()
+        return _conn
+
+
+def split_tags(tags):
+    """标签统一为去重后的列表；接受列表或逗号分隔的字符串"""
+    if not tags:
+        return []
+    if isinstance(tags, str):
+        tags = tags.replace("，", ",").split(",")
+    return list(dict.fromkeys(t.strip() for t in tags if t and t.strip()))
+
+
+def _row_to_record(row):
+    rec = dict(zip(_COLUMNS, row))
+    rec["tags"] = split_tags(rec["tags"])
+    return rec
+
+
+def summarize_metadatas(metadatas):
+    """把某个文件全部片段的 metadata 汇总成一条清单记录"""
+    pages = {m.get("page") for m in metadatas if m.get("page") not in (None, "N/A")}
+    # 取最近一次入库片段上的文件指纹 / 模型
+    metadatas = sorted(metadatas, key=lambda m: m.get("ingested_at") or 0)
+    hashes = [m.get("file_hash") for m in metadatas if m.get("file_hash")]
+    times = [m.get("ingested_at") for m in metadatas if m.get("ingested_at") is not None]
+    models = [m.get("model") for m in metadatas if m.get("model")]
+    tags = [m.get("tags") for m in metadatas if m.get("tags")]
+    return {
+        "content_hash": hashes[-1] if hashes else None,
+        "chunk_count": len(metadatas),
+        "page_count": len(pages),
+        "ingested_at": max(times) if times else None,
+        "embedding_model": models[-1] if models else None,
+        "tags": split_tags(tags[-1]) if tags else [],
+    }
+
+
+def upsert_files(records, collection=DEFAULT_COLLECTION):
+    """
+    在同一个事务里写入多条记录 {name: record}；chunk_count 为 0 的记录直接删除
+    record 不带 tags (或为 None) 时保留已有标签
+    """
+    conn = _get_conn()
+    with _lock, conn:
+        for name, rec in records.items():
+            if rec["chunk_count"] == 0:
+                conn.execute("DELETE FROM files WHERE collection = ? AND name = ?", (collection, name))
+                continue
+            tags = rec.get("tags")
+            conn.execute(
+                "INSERT INTO files "
+                "(collection, name, content_hash, chunk_count, page_count, ingested_at, embedding_model, tags) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (collection, name) DO UPDATE SET "
+                "content_hash = excluded.content_hash, chunk_count = excluded.chunk_count, "
+                "page_count = excluded.page_count, ingested_at = excluded.ingested_at, "
+                "embedding_model = excluded.embedding_model, tags = COALESCE(excluded.tags, files.tags)",
+                (collection, name, rec["content_hash"], rec["chunk_count"], rec["page_count"],
+                 rec["ingested_at"], rec["embedding_model"], ",".join(tags) if tags else None)
+            )
+
+
+def set_tags(name, tags, collection=DEFAULT_COLLECTION):
+    """覆盖某个文件的标签"""
+    conn = _get_conn()
+    with _lock, conn:
+        conn.execute("UPDATE files SET tags = ? WHERE collection = ? AND name = ?",
+                     (",".join(split_tags(tags)) or None, collection, name))
+
+
+def remove_file(name, collection=DEFAULT_COLLECTION):
+    conn = _get_conn()
+    with _lock, conn:
+        conn.execute("DELETE FROM files WHERE collection = ? AND name = ?", (collection, name))
+
+
+def clear(collection=DEFAULT_COLLECTION):
+    conn = _get_conn()
+    with _lock, conn:
+        conn.execute("DELETE FROM files WHERE collection = ?", (collection,))
+
+
+def get_file(name, collection=DEFAULT_COLLECTION):
+    """获取单个文件的清单记录，不存在返回 None"""
+    conn = _get_conn()
+    with _lock:
+        row = conn.execute(
+            f"SELECT {', '.join(_COLUMNS)} FROM files WHERE collection = ? AND name = ?", (collection, name)
+        ).fetchone()
+    return _row_to_record(row) if row else None
+
+
+def list_files(collection=DEFAULT_COLLECTION):
+    """按文件名排序返回某个知识库的全部清单记录"""
+    conn = _get_conn()
+    with _lock:
+        rows = conn.execute(
+            f"SELECT {', '.join(_COLUMNS)} FROM files WHERE collection = ? ORDER BY name", (collection,)
+        ).fetchall()
+    return [_row_to_record(row) for row in rows]
+
+
+def find_files(collection=DEFAULT_COLLECTION, names=None, tags=None, since=None, until=None):
+    """
+    按条件筛选文件名：names 限定文件、tags 命中任一标签、[since, until] 为入库时间 (Unix 秒)
+    各条件为空时不限制
+    """
+    tags = set(split_tags(tags))
+    names = set(names) if names else None
+    found = []
+    for rec in list_files(collection):
+        if names is not None and rec["name"] not in names: continue
+        if tags and not tags & set(rec["tags"]): continue
+        if since is not None and (rec["ingested_at"] or 0) < since: continue
+        if until is not None and (rec["ingested_at"] or 0) > until: continue
+        found.append(rec["name"])
+    return found
+
+
+def bump_version(collection=DEFAULT_COLLECTION):
+    """知识库内容变化后调用；清空知识库时也只加一不归零，避免旧缓存被重新命中"""
+    conn = _get_conn()
+    with _lock, conn:
+        conn.execute(
+            "INSERT INTO versions (collection, version) VALUES (?, 1) "
+            "ON CONFLICT (collection) DO UPDATE SET version = version + 1", (collection,)
+        )
+
+
+def collection_version(collection=DEFAULT_COLLECTION):
+    conn = _get_conn()
+    with _lock:
+        row = conn.execute("SELECT version FROM versions WHERE collection = ?", (collection,)).fetchone()
+    return row[0] if row else 0
+
+
+def list_collections():
+    """清单中出现过的知识库 (默认知识库总在其中)"""
+    conn = _get_conn()
+    with _lock:
+        rows = conn.execute("SELECT DISTINCT collection FROM files").fetchall()
+    return sorted({r[0] for r in rows} | {DEFAULT_COLLECTION})
+
+
+def group_metadatas(store, page_size=5000, extra=()):
+    """
+    分页读取向量库全部片段的 metadata (避免一次性载入)，按文件分组 {文件名: [metadata, ...]}
+    extra 为不在向量库中的片段 metadata (去重后只保存了回引的近重复片段)
+    """
+    grouped = {}
+    for m in extra:
+        grouped.setdefault(m["source"], []).append(m)
+    offset = 0
+    while True:
+        data = store.get(include=["metadatas"], limit=page_size, offset=offset)
+        metadatas = data.get("metadatas") or []
+        if not metadatas:
+            break
+        for m in metadatas:
+            grouped.setdefault(m["source"], []).append(m)
+        offset += len(metadatas)
+    return grouped
+
+
+def rebuild(store, collection=DEFAULT_COLLECTION, page_size=5000, extra=()):
+    """从向量库全量重建某个知识库的清单；extra 见 group_metadatas"""
+    grouped = group_metadatas(store, page_size, extra)
+    clear(collection)
+    upsert_files({name: summarize_metadatas(ms) for name, ms in grouped.items()}, collection=collection)
+    return len(grouped)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="文件清单维护工具")
+    parser.add_argument("command", choices=["rebuild", "check", "repair", "list"])
+    parser.add_argument("--collection", default=DEFAULT_COLLECTION, help="知识库名称")
+    args = parser.parse_args()
+
+    if args.command == "rebuild":
+        from modules.database import rebuild_manifest
+        count = rebuild_manifest(args.collection)
+        print(f"清单已重建: {count} 个文件")
+    elif args.command in ("check", "repair"):
+        from modules.database import check_manifest
+        stale = check_manifest(args.collection, repair=args.command == "repair")
+        for name in stale:
+            print(name)
+        action = "已修正" if args.command == "repair" else "不一致"
+        print(f"清单与向量库{action}: {len(stale)} 个文件")
+    else:
+        for rec in list_files(args.collection):
+            print(f"{rec['name']}\t{rec['chunk_count']} 片段\t{rec['page_count']} 页\t"
+                  f"{rec['embedding_model']}\t{','.join(rec['tags'])}")
+
+
+if __name__ == "__main__":
+    main()
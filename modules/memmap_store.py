@@ -0,0 +1,524 @@
+"""
+NumPy 内存映射向量库：在 float16 矩阵上做精确 (暴力) 余弦检索，替代 Chroma 的 HNSW
+- 向量归一化后写入只追加的段文件 (seg_000001.vec)，检索时 memmap 分块计算点积，结果可复现
+- 存储精度 float16 (占用为 float32 的一半) 或 int8 (按行缩放量化，占用约为 1/4，分块解码更快)
+- 片段原文与 metadata 存在 SQLite (chunks 表只保存存活的行)，删除 / 覆盖只做标记，旧行成为墓碑
+- 墓碑占比过高时在后台线程压缩：把存活行复制到新段，再原子切换
+- 多进程共用同一目录 (API 多 worker、后台入库任务的租约可能被其他进程接管)：每次写入提交时递增 meta 中的版本号，
+  检索 / 读取 / 写入前发现版本号变了就从磁盘重新加载段状态，避免按过期的行数追加或看不到其他进程写入的片段
+"""
+import glob
+import json
+import os
+import re
+import sqlite3
+import threading
+
+import numpy as np
+
+from modules.vector_store import VectorStore
+
+MEMMAP_PATH = "./vector_store"
+
+# 单个段文件最多追加的行数，写满后新开一段
+SEGMENT_ROWS = 65536
+# 检索时每次解码为 float32 计算的行数：块小一些能留在 CPU 缓存里，解码 + 点积更快
+BLOCK_ROWS = 1024
+# 墓碑占比超过 COMPACT_RATIO 且数量不少于 COMPACT_MIN_ROWS 时触发后台压缩
+COMPACT_RATIO = 0.3
+COMPACT_MIN_ROWS = 1024
+
+_OPS = {"$eq": "=", "$ne": "!=", "$gt": ">", "$gte": ">=", "$lt": "<", "$lte": "<="}
+_KEY_RE = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+
+def where_to_sql(where):
+    """把 Chroma 风格的 where 条件翻译为 SQL 片段与参数"""
+    if not where:
+        return "1=1", []
+    clauses, params = [], []
+    for key, cond in where.items():
+        if key in ("$and", "$or"):
+            parts = [where_to_sql(w) for w in cond]
+            joiner = " AND " if key == "$and" else " OR "
+            clauses.append("(" + joiner.join(p[0] for p in parts) + ")")
+            for p in parts:
+                params.extend(p[1])
+            continue
+        if key in ("source", "page"):
+            column = key
+        elif _KEY_RE.match(key):
+            column = f"json_extract(metadata, '$.{key}')"
+        else:
+            raise ValueError(f"不支持的过滤字段: {key}")
+        if not isinstance(cond, dict):
+            cond = {"$eq": cond}
+        for op, value in cond.items():
+            if op in ("$in", "$nin"):
+                values = list(value)
+                if not values:
+                    clauses.append("0=1" if op == "$in" else "1=1")
+                    continue
+                marks = ",".join("?" * len(values))
+                clauses.append(f"{column} {'IN' if op == '$in' else 'NOT IN'} ({marks})")
+                params.extend(values)
+            elif op in _OPS:
+                clauses.append(f"{column} {_OPS[op]} ?")
+                params.append(value)
+            else:
+                raise ValueError(f"不支持的过滤操作: {op}")
+    return " AND ".join(clauses) or "1=1", params
+
+
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if vectors.ndim == 1:
+        vectors = vectors[None, :]
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def _encode(vectors, dtype):
+    """按存储精度编码，返回 (编码后的矩阵, 每行缩放系数 或 None)"""
+    if dtype == np.int8:
+        scales = np.abs(vectors).max(axis=1) / 127
+        scales[scales == 0] = 1.0
+        return np.round(vectors / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+    return vectors.astype(dtype), None
+
+
+def _append_file(path, data):
+    with open(path, "ab") as f:
+        f.write(data.tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _truncate_rows(path, row_bytes):
+    """截掉写入中途崩溃留下的半行，返回完整行数"""
+    size = os.path.getsize(path) if os.path.exists(path) else 0
+    if size % row_bytes:
+        with open(path, "r+b") as f:
+            f.truncate(size - size % row_bytes)
+    return size // row_bytes
+
+
+class _Segment:
+    """
+    一个只追加的段文件；ids[row] 为该行的片段 ID，alive[row] 为 False 表示墓碑
+    int8 精度时旁边还有一个 .scale 文件保存每行的缩放系数
+    """
+
+    def __init__(self, seg_id, path, dim, dtype):
+        self.seg_id = seg_id
+        self.path = path
+        self.scale_path = path[:-4] + ".scale" if dtype == np.int8 else None
+        self.dim = dim
+        self.dtype = dtype
+        self.rows = _truncate_rows(path, dim * dtype.itemsize)
+        if self.scale_path:
+            # 向量先于缩放系数写入，两者行数不一致时以较少的为准
+            self.rows = min(self.rows, _truncate_rows(self.scale_path, 4))
+        self.ids = np.full(self.rows, None, dtype=object)
+        self.alive = np.zeros(self.rows, dtype=bool)
+        self.vectors = None
+        self.scales = None
+        self._remap()
+
+    def _remap(self):
+        if not self.rows:
+            return
+        self.vectors = np.memmap(self.path, dtype=self.dtype, mode="r", shape=(self.rows, self.dim))
+        if self.scale_path:
+            self.scales = np.memmap(self.scale_path, dtype=np.float32, mode="r", shape=(self.rows,))
+
+    def decode(self, start, stop):
+        """把 [start, stop) 行解码为 float32"""
+        block = np.asarray(self.vectors[start: stop], dtype=np.float32)
+        if self.scales is not None:
+            block *= self.scales[start: stop, None]
+        return block
+
+    def remove_files(self):
+        for path in (self.path, self.scale_path):
+            if path and os.path.exists(path):
+                os.remove(path)
+
+    def append(self, ids, vectors):
+        """追加行并落盘，返回起始行号；数组整体替换，正在进行的检索仍持有旧视图"""
+        start = self.rows
+        encoded, scales = _encode(vectors, self.dtype)
+        _append_file(self.path, encoded)
+        if self.scale_path:
+            _append_file(self.scale_path, scales)
+        self.rows += len(ids)
+        self.ids = np.concatenate([self.ids, np.array(ids, dtype=object)])
+        self.alive = np.concatenate([self.alive, np.ones(len(ids), dtype=bool)])
+        self._remap()
+        return start
+
+    @property
+    def dead(self):
+        return self.rows - int(self.alive.sum())
+
+
+class MemmapStore(VectorStore):
+    def __init__(self, path=MEMMAP_PATH, dtype="float16", auto_compact=True):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.configured_dtype = np.dtype(dtype)
+        if self.configured_dtype not in (np.float16, np.float32, np.int8):
+            raise ValueError(f"不支持的存储精度: {dtype}")
+        self.auto_compact = auto_compact
+        self._lock = threading.RLock()
+        self._compact_lock = threading.Lock()
+        self._generation = 0
+        self._conn = sqlite3.connect(os.path.join(path, "chunks.db"), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS chunks (
+                id TEXT PRIMARY KEY,
+                segment INTEGER NOT NULL,
+                row INTEGER NOT NULL,
+                source TEXT,
+                page TEXT,
+                document TEXT,
+                metadata TEXT
+            );
+            CREATE INDEX IF NOT EXISTS idx_chunks_source ON chunks(source, page);
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+        """)
+        self._conn.commit()
+        # 压缩中途崩溃留下的临时文件
+        for path in glob.glob(os.path.join(self.path, "seg_*.tmp")):
+            os.remove(path)
+        self._load()
+
+    # --- 加载与段管理 ---
+    def _load(self):
+        meta = dict(self._conn.execute("SELECT key, value FROM meta").fetchall())
+        self._version = meta.get("version")
+        self.dim = int(meta["dim"]) if "dim" in meta else None
+        self.dtype = self.configured_dtype
+        if meta.get("dtype") and np.dtype(meta["dtype"]) != self.dtype:
+            # 已有数据按写入时的精度读取，清空后才会使用新精度
+            print(f"向量库已使用 {meta['dtype']} 存储，忽略配置的 {self.dtype}")
+            self.dtype = np.dtype(meta["dtype"])
+        self._segments = {}
+        self._active = None
+        self._next_id = 1
+        if self.dim is None:
+            return
+        for path in sorted(glob.glob(os.path.join(self.path, "seg_*.vec"))):
+            seg_id = int(os.path.basename(path)[4:10])
+            self._segments[seg_id] = _Segment(seg_id, path, self.dim, self.dtype)
+            self._next_id = max(self._next_id, seg_id + 1)
+        for cid, seg_id, row_num in self._conn.execute("SELECT id, segment, row FROM chunks"):
+            seg = self._segments.get(seg_id)
+            if seg is not None and row_num < seg.rows:
+                seg.ids[row_num] = cid
+                seg.alive[row_num] = True
+        if self._segments:
+            last = self._segments[max(self._segments)]
+            if last.rows < SEGMENT_ROWS:
+                self._active = last.seg_id
+
+    def _refresh(self):
+        """其他进程提交过写入 (版本号变化) 时重新加载段状态；调用方需持有锁"""
+        row = self._conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        if (row[0] if row else None) != self._version:
+            # 进行中的压缩以旧状态为准，作废
+            self._generation += 1
+            self._load()
+
+    def _commit(self):
+        """提交本进程的写入并递增版本号 (调用方需持有锁)"""
+        self._conn.execute("INSERT INTO meta (key, value) VALUES ('version', '1') "
+                           "ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1")
+        self._version = self._conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()[0]
+        self._conn.commit()
+
+    def _segment_path(self, seg_id):
+        return os.path.join(self.path, f"seg_{seg_id:06d}.vec")
+
+    def _new_segment(self):
+        seg_id = self._next_id
+        self._next_id += 1
+        seg = _Segment(seg_id, self._segment_path(seg_id), self.dim, self.dtype)
+        self._segments[seg_id] = seg
+        return seg
+
+    def _tombstone(self, rows):
+        """rows: [(segment, row), ...]"""
+        for seg_id, row_num in rows:
+            seg = self._segments.get(seg_id)
+            if seg is not None and row_num < seg.rows:
+                seg.alive[row_num] = False
+                seg.ids[row_num] = None
+
+    def _select(self, columns, ids=None, where=None, limit=None, offset=0):
+        sql, params = where_to_sql(where)
+        if ids is not None:
+            rows = []
+            ids = list(ids)
+            for i in range(0, len(ids), 500):
+                batch = ids[i: i + 500]
+                rows += self._conn.execute(
+                    f"SELECT {columns} FROM chunks WHERE id IN ({','.join('?' * len(batch))}) AND {sql}",
+                    batch + params
+                ).fetchall()
+            return rows
+        sql = f"SELECT {columns} FROM chunks WHERE {sql} ORDER BY rowid"
+        if limit is not None:
+            sql += " LIMIT ? OFFSET ?"
+            params = params + [int(limit), int(offset or 0)]
+        return self._conn.execute(sql, params).fetchall()
+
+    # --- VectorStore 接口 ---
+    def count(self):
+        with self._lock:
+            self._refresh()
+            return self._conn.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+
+    def upsert(self, ids, embeddings, metadatas, documents):
+        if not ids:
+            return
+        vectors = _normalize(embeddings)
+        with self._lock:
+            self._refresh()
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+                self._conn.executemany("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                                       [("dim", str(self.dim)), ("dtype", self.dtype.name)])
+            elif vectors.shape[1] != self.dim:
+                raise ValueError(f"向量维度 {vectors.shape[1]} 与库中的 {self.dim} 不一致，更换向量模型后请先清空知识库")
+
+            # 覆盖写入：旧位置变成墓碑
+            old = self._select("segment, row", ids=ids)
+            self._tombstone(old)
+
+            # 先把向量追加落盘，再提交 SQLite；中途崩溃只会多出无人引用的墓碑行
+            records = []
+            done = 0
+            while done < len(ids):
+                seg = self._segments.get(self._active) if self._active is not None else None
+                if seg is None or seg.rows >= SEGMENT_ROWS:
+                    seg = self._new_segment()
+                    self._active = seg.seg_id
+                take = min(len(ids) - done, SEGMENT_ROWS - seg.rows)
+                start = seg.append(ids[done: done + take], vectors[done: done + take])
+                for k in range(take):
+                    j = done + k
+                    meta = metadatas[j] or {}
+                    records.append((ids[j], seg.seg_id, start + k, meta.get("source"),
+                                    None if meta.get("page") is None else str(meta.get("page")),
+                                    documents[j], json.dumps(meta, ensure_ascii=False)))
+                done += take
+
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO chunks (id, segment, row, source, page, document, metadata) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)", records
+            )
+            self._commit()
+            if old:
+                self._maybe_compact()
+
+    def query(self, query_embeddings, n_results=10, where=None, ids=None):
+        queries = _normalize(query_embeddings)
+        with self._lock:
+            self._refresh()
+            if self.dim is None:
+                return [[] for _ in range(len(queries))]
+            # 段对象的数组在追加 / 压缩时整体替换，这里拿到的是一致的快照
+            segments = [(seg, seg.rows, seg.alive, seg.ids) for seg in self._segments.values() if seg.rows]
+            allowed = None
+            if where or ids is not None:
+                allowed = {}
+                for seg_id, row_num in self._select("segment, row", ids=ids, where=where):
+                    allowed.setdefault(seg_id, []).append(row_num)
+
+        cand_scores, cand_ids = [], []
+        for seg, rows_total, alive, ids in segments:
+            mask = alive[:rows_total]
+            if allowed is not None:
+                rows = allowed.get(seg.seg_id)
+                if not rows:
+                    continue
+                mask = np.zeros(len(alive), dtype=bool)
+                mask[[r for r in rows if r < len(alive)]] = True
+                mask &= alive
+            for start in range(0, len(alive), BLOCK_ROWS):
+                block_mask = mask[start: start + BLOCK_ROWS]
+                if not block_mask.any():
+                    continue
+                scores = seg.decode(start, start + len(block_mask)) @ queries.T
+                scores[~block_mask] = -np.inf
+                k = min(n_results, len(block_mask))
+                top = np.argpartition(-scores, k - 1, axis=0)[:k]
+                cand_scores.append(np.take_along_axis(scores, top, axis=0))
+                cand_ids.append(ids[start + top])
+
+        if not cand_scores:
+            return [[] for _ in range(len(queries))]
+        all_scores = np.concatenate(cand_scores, axis=0)
+        all_ids = np.concatenate(cand_ids, axis=0)
+
+        picked = []
+        for q in range(len(queries)):
+            order = np.argsort(-all_scores[:, q], kind="stable")[:n_results]
+            picked.append([(all_ids[i, q], float(all_scores[i, q])) for i in order
+                           if np.isfinite(all_scores[i, q]) and all_ids[i, q] is not None])
+
+        wanted = {cid for hits in picked for cid, _ in hits}
+        with self._lock:
+            rows = self._select("id, document, metadata", ids=wanted)
+        found = {cid: (doc, json.loads(meta)) for cid, doc, meta in rows}
+        # 检索期间被删除的片段直接丢弃
+        return [
+            [{"id": cid, "document": found[cid][0], "metadata": found[cid][1], "score": score}
+             for cid, score in hits if cid in found]
+            for hits in picked
+        ]
+
+    def get(self, ids=None, where=None, include=("documents", "metadatas"), limit=None, offset=0):
+        with self._lock:
+            self._refresh()
+            rows = self._select("id, document, metadata, segment, row", ids=ids, where=where, limit=limit,
+                                offset=offset)
+            embeddings = None
+            if "embeddings" in include:
+                # 读出的是归一化后的向量 (余弦检索只需要方向)
+                embeddings = np.empty((len(rows), self.dim or 0), dtype=np.float32)
+                for i, (_, _, _, seg_id, row_num) in enumerate(rows):
+                    embeddings[i] = self._segments[seg_id].decode(row_num, row_num + 1)[0]
+        return {
+            "ids": [r[0] for r in rows],
+            "documents": [r[1] for r in rows] if "documents" in include else None,
+            "metadatas": [json.loads(r[2]) for r in rows] if "metadatas" in include else None,
+            "embeddings": embeddings,
+        }
+
+    def delete(self, ids=None, where=None):
+        with self._lock:
+            self._refresh()
+            rows = self._select("id, segment, row", ids=ids, where=where)
+            if not rows:
+                return
+            self._tombstone([(seg_id, row_num) for _, seg_id, row_num in rows])
+            deleted = [r[0] for r in rows]
+            for i in range(0, len(deleted), 500):
+                batch = deleted[i: i + 500]
+                self._conn.execute(f"DELETE FROM chunks WHERE id IN ({','.join('?' * len(batch))})", batch)
+            self._commit()
+            self._maybe_compact()
+
+    def reset(self):
+        with self._lock:
+            self._generation += 1
+            self._conn.execute("DELETE FROM chunks")
+            # 版本号保留并递增，其他进程据此发现库已清空
+            self._conn.execute("DELETE FROM meta WHERE key != 'version'")
+            self._commit()
+            for path in glob.glob(os.path.join(self.path, "seg_*")):
+                os.remove(path)
+            self._load()
+
+    # --- 压缩 ---
+    def warm_up(self):
+        """按检索的分块方式把各段读一遍，段文件进入页缓存"""
+        with self._lock:
+            self._refresh()
+            segments = list(self._segments.values())
+        for seg in segments:
+            for start in range(0, seg.rows, BLOCK_ROWS):
+                seg.decode(start, start + BLOCK_ROWS)
+
+    def stats(self):
+        with self._lock:
+            rows = sum(seg.rows for seg in self._segments.values())
+            dead = sum(seg.dead for seg in self._segments.values())
+        return {"segments": len(self._segments), "rows": rows, "tombstones": dead,
+                "dtype": self.dtype.name, "bytes": rows * (self.dim or 0) * self.dtype.itemsize}
+
+    def _maybe_compact(self):
+        """墓碑过多时启动后台压缩 (调用方需持有锁)"""
+        if not self.auto_compact or self._compact_lock.locked():
+            return
+        rows = sum(seg.rows for seg in self._segments.values())
+        dead = sum(seg.dead for seg in self._segments.values())
+        if dead >= COMPACT_MIN_ROWS and dead > rows * COMPACT_RATIO:
+            threading.Thread(target=self.compact, daemon=True).start()
+
+    def compact(self, ratio=COMPACT_RATIO):
+        """
+        把墓碑占比超过 ratio 的段合并重写为一个新段，返回回收的行数
+        复制存活行时不持有主锁，检索和写入照常进行；同一时间只有一个压缩任务
+        """
+        with self._compact_lock:
+            with self._lock:
+                self._refresh()
+                if self.dim is None:
+                    return 0
+                victims = [seg for seg in self._segments.values() if seg.rows and seg.dead > seg.rows * ratio]
+                if not victims:
+                    return 0
+                generation = self._generation
+                # 封存正在追加的段，之后的写入去新段，被压缩的段只会再发生删除
+                if self._active in {seg.seg_id for seg in victims}:
+                    self._active = None
+                snapshot = [(seg, np.flatnonzero(seg.alive)) for seg in victims]
+                new_id = self._next_id
+                self._next_id += 1
+
+            final_path = self._segment_path(new_id)
+            new_seg_files = [(final_path + ".tmp", final_path)]
+            if self.dtype == np.int8:
+                scale_path = final_path[:-4] + ".scale"
+                new_seg_files.append((scale_path + ".tmp", scale_path))
+            for tmp_path, _ in new_seg_files:
+                open(tmp_path, "wb").close()
+            for seg, live in snapshot:
+                for i in range(0, len(live), BLOCK_ROWS):
+                    rows = live[i: i + BLOCK_ROWS]
+                    _append_file(new_seg_files[0][0], np.asarray(seg.vectors[rows]))
+                    if seg.scales is not None:
+                        _append_file(new_seg_files[1][0], np.asarray(seg.scales[rows]))
+
+            with self._lock:
+                self._refresh()
+                if generation != self._generation:
+                    for tmp_path, _ in new_seg_files:
+                        os.remove(tmp_path)
+                    return 0
+                # 复制期间又被删除 / 覆盖的行，在新段里同样是墓碑
+                new_ids = np.concatenate([seg.ids[live] for seg, live in snapshot])
+                new_alive = np.concatenate([seg.alive[live] for seg, live in snapshot])
+                reclaimed = sum(seg.rows for seg, _ in snapshot) - len(new_ids)
+
+                if len(new_ids):
+                    # 先放好新段文件，再提交 SQLite 中的位置；提交之前崩溃只会留下无人引用的段
+                    for tmp_path, path in reversed(new_seg_files):
+                        os.replace(tmp_path, path)
+                    self._conn.executemany(
+                        "UPDATE chunks SET segment = ?, row = ? WHERE id = ?",
+                        [(new_id, int(r), new_ids[r]) for r in np.flatnonzero(new_alive)]
+                    )
+                    self._commit()
+                    seg = _Segment(new_id, final_path, self.dim, self.dtype)
+                    seg.ids, seg.alive = new_ids, new_alive
+                    self._segments[new_id] = seg
+                else:
+                    for tmp_path, _ in new_seg_files:
+                        os.remove(tmp_path)
+                    # 旧段文件即将删除，其他进程需要重新加载
+                    self._commit()
+
+                # 正在进行的检索仍持有旧段的 memmap，文件删除后映射依然有效 (POSIX)
+                for old, _ in snapshot:
+                    del self._segments[old.seg_id]
+                    try:
+                        old.remove_files()
+                    except OSError as e:
+                        print(f"删除旧段失败 {old.path}: {e}")
+                return reclaimed
@@ -0,0 +1,122 @@
+"""
+多轮对话记忆：追问时带上必要的历史，同时让 Prompt 长度有上限
+- 最近 turns 轮 (一问一答为一轮) 原文保留
+- 更早的轮次压缩成滚动摘要：每次只把新移出窗口的消息并入已有摘要 (增量计算)，
+  摘要缓存在历史库 (history.summaries)，不会每轮都从头总结
+- 摘要 + 原文轮次的总 token 数不超过 token_budget，放不下时最早的原文轮次也并入摘要
+- 追问改写：结合记忆把“那它的缺点呢?”这类追问改写成独立的检索查询，
+  向量化 / 关键词检索只用改写后的问题，历史文本不参与检索
+"""
+from modules import history, metrics
+from modules.packer import estimate_tokens
+
+# 默认保留的原文轮数与记忆的 token 预算 (摘要 + 原文轮次)
+MEMORY_TURNS = 3
+MEMORY_TOKENS = 1500
+# 摘要长度上限；改写后问题的长度上限
+SUMMARY_TOKENS = 300
+REWRITE_TOKENS = 100
+# 送去总结的单条消息最多保留的 token 数 (长回答只取开头)
+SUMMARY_INPUT_TOKENS = 1000
+
+SUMMARY_PROMPT = (
+    "你是对话摘要助手。把【已有摘要】和【新的对话】合并成一份简洁的中文摘要，"
+    "保留用户关心的主题、涉及的文件 / 概念、已经得出的结论和尚未解决的问题。"
+    f"只输出摘要本身，不超过 {SUMMARY_TOKENS} 字。"
+)
+
+REWRITE_PROMPT = (
+    "根据对话历史，把用户的最新问题改写成一个不依赖上下文、可以单独用于知识库检索的问题："
+    "补全其中的代词和省略的主语 / 对象。问题本身已经完整时原样输出。只输出改写后的问题。"
+)
+
+
+def clip_tokens(text, max_tokens):
+    """按估算的 token 数截断文本"""
+    tokens = estimate_tokens(text)
+    if tokens <= max_tokens:
+        return text
+    return text[: max(int(len(text) * max_tokens / tokens), 1)] + "…"
+
+
+def _render(messages):
+    names = {"user": "用户", "assistant": "助手"}
+    return "\n".join(f"{names.get(m['role'], m['role'])}: {m['content']}" for m in messages)
+
+
+def _complete(client, system, user, max_tokens, model_name):
+    response = client.chat.completions.create(
+        model=model_name,
+        messages=[{"role": "system", "content": system}, {"role": "user", "content": user}],
+        temperature=0,
+        max_tokens=max_tokens,
+        stream=False
+    )
+    return (response.choices[0].message.content or "").strip()
+
+
+def summarize(client, summary, messages, model_name="deepseek-chat"):
+    """把新移出窗口的消息并入已有摘要，返回新摘要"""
+    new_turns = [dict(m, content=clip_tokens(m["content"], SUMMARY_INPUT_TOKENS)) for m in messages]
+    with metrics.stage("memory_summary"):
+        return _complete(
+            client, SUMMARY_PROMPT,
+            f"【已有摘要】\n{summary or '无'}\n\n【新的对话】\n{_render(new_turns)}",
+            max_tokens=SUMMARY_TOKENS * 2, model_name=model_name
+        )
+
+
+def build_memory(client, chat_id, messages, turns=MEMORY_TURNS, token_budget=MEMORY_TOKENS,
+                 model_name="deepseek-chat"):
+    """
+    messages 为本轮提问之前的对话，返回 {"summary": 滚动摘要, "messages": [{"role", "content"}, ...]}
+    只有 user / assistant 消息计入记忆；摘要失败时保留旧摘要，本次移出窗口的消息直接丢弃
+    """
+    messages = [{"role": m["role"], "content": m["content"]} for m in messages
+                if m.get("role") in ("user", "assistant")]
+    covered, summary = history.get_summary(chat_id) if chat_id else (0, "")
+    if covered > len(messages):
+        covered, summary = 0, ""
+
+    # 原文窗口：最近 turns 轮，超出预算时从最早的一轮开始移出 (保持以用户消息开头)
+    start = max(len(messages) - 2 * turns, 0)
+    budget = max(token_budget - SUMMARY_TOKENS, 0)
+    while start < len(messages) and (
+            messages[start]["role"] != "user"
+            or sum(estimate_tokens(m["content"]) for m in messages[start:]) > budget):
+        start += 1
+    recent = messages[start:]
+    if not recent and messages:
+        # 最后一轮本身就超出预算：只保留最后一条，截断到预算内
+        recent = [dict(messages[-1], content=clip_tokens(messages[-1]["content"], budget))]
+        start = len(messages) - 1
+
+    if start > covered:
+        try:
+            summary = summarize(client, summary, messages[covered:start], model_name=model_name)
+            if chat_id:
+                history.save_summary(chat_id, start, summary)
+        except Exception as e:
+            print(f"对话摘要失败: {e}")
+    return {"summary": summary, "messages": recent}
+
+
+def rewrite_query(client, query, memory, model_name="deepseek-chat"):
+    """把追问改写成独立的检索查询；没有历史或改写失败时返回原问题"""
+    if not memory or not (memory["summary"] or memory["messages"]):
+        return query
+    context = ""
+    if memory["summary"]:
+        context += f"【对话摘要】\n{memory['summary']}\n\n"
+    recent = [dict(m, content=clip_tokens(m["content"], SUMMARY_INPUT_TOKENS)) for m in memory["messages"]]
+    if recent:
+        context += f"【最近对话】\n{_render(recent)}\n\n"
+    try:
+        with metrics.stage("query_rewrite"):
+            rewritten = _complete(client, REWRITE_PROMPT, f"{context}【最新问题】\n{query}",
+                                  max_tokens=REWRITE_TOKENS, model_name=model_name)
+    except Exception as e:
+        print(f"追问改写失败: {e}")
+        return query
+    rewritten = rewritten.strip().strip("\"“”'")
+    return rewritten or query
@@ -0,0 +1,201 @@
+"""
+耗时追踪与指标：
+- start_trace(kind) 为一次查询 / 入库生成 request_id，期间所有 stage(...) 的耗时都记到这次追踪里
+- 追踪结束时追加写入本地 JSONL 日志
+- 计数器与阶段耗时直方图可导出为 Prometheus 文本格式 (可选的 /metrics HTTP 端点)
+"""
+import contextvars
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 追踪日志路径
+METRICS_LOG = "./metrics/traces.jsonl"
+
+# 阶段耗时直方图的桶 (秒)
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_current = contextvars.ContextVar("rag_trace", default=None)
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+_last_traces = {}
+
+
+class Trace:
+    def __init__(self, kind, **attrs):
+        self.request_id = uuid.uuid4().hex[:12]
+        self.kind = kind
+        self.attrs = attrs
+        self.started_at = time.time()
+        self.stages = []
+        self.total_ms = None
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds):
+        """同名阶段 (如逐页解析、逐批向量化) 累加耗时并计数"""
+        with self._lock:
+            for entry in self.stages:
+                if entry["stage"] == name:
+                    entry["ms"] = round(entry["ms"] + seconds * 1000, 2)
+                    entry["count"] += 1
+                    return
+            self.stages.append({"stage": name, "ms": round(seconds * 1000, 2), "count": 1})
+
+    def to_dict(self):
+        return {
+            "request_id": self.request_id,
+            "kind": self.kind,
+            "started_at": self.started_at,
+            "total_ms": self.total_ms,
+            "stages": [dict(entry) for entry in self.stages],
+            **self.attrs,
+        }
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def incr(name, value=1, **labels):
+    """计数器 +value"""
+    with _lock:
+        key = (name, _label_key(labels))
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name, seconds):
+    """记录一个阶段耗时：写入当前追踪 + 全局直方图"""
+    trace = _current.get()
+    if trace is not None:
+        trace.add(name, seconds)
+    with _lock:
+        hist = _histograms.get(name)
+        if hist is None:
+            hist = _histograms[name] = {"buckets": [0] * len(BUCKETS), "sum": 0.0, "count": 0}
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                hist["buckets"][i] += 1
+        hist["sum"] += seconds
+        hist["count"] += 1
+
+
+@contextmanager
+def stage(name):
+    """计时一个阶段"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start)
+
+
+@contextmanager
+def start_trace(kind, **attrs):
+    """开始一次追踪 (查询 / 入库)，结束时写入 JSONL 日志"""
+    trace = Trace(kind, **attrs)
+    token = _current.set(trace)
+    start = time.perf_counter()
+    try:
+        yield trace
+    finally:
+        trace.total_ms = round((time.perf_counter() - start) * 1000, 2)
+        _current.reset(token)
+        incr("rag_requests_total", kind=kind)
+        with _lock:
+            _last_traces[kind] = trace.to_dict()
+        _write_log(trace.to_dict())
+
+
+def current_trace():
+    return _current.get()
+
+
+def bind_context(fn):
+    """让线程池 / 后台线程中的阶段也记到当前追踪里"""
+    ctx = contextvars.copy_context()
+    return lambda *args, **kwargs: ctx.run(fn, *args, **kwargs)
+
+
+def iterate_in_context(iterator):
+    """
+    在同一个 Context 中逐项推进迭代器：即使每次 next() 在不同线程执行 (如 HTTP 流式响应)，
+    迭代器内部的 start_trace / stage 也能正常配对
+    """
+    ctx = contextvars.copy_context()
+    while True:
+        try:
+            item = ctx.run(next, iterator)
+        except StopIteration:
+            return
+        yield item
+
+
+def last_trace(kind="query"):
+    with _lock:
+        return _last_traces.get(kind)
+
+
+def _write_log(record):
+    try:
+        os.makedirs(os.path.dirname(METRICS_LOG) or ".", exist_ok=True)
+        with _lock, open(METRICS_LOG, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    except Exception as e:
+        print(f"写入追踪日志失败: {e}")
+
+
+def render_prometheus():
+    """导出为 Prometheus 文本格式"""
+    lines = []
+    with _lock:
+        counters = dict(_counters)
+        histograms = {k: {"buckets": list(v["buckets"]), "sum": v["sum"], "count": v["count"]}
+                      for k, v in _histograms.items()}
+
+    seen = set()
+    for (name, labels), value in sorted(counters.items()):
+        if name not in seen:
+            lines.append(f"# TYPE {name} counter")
+            seen.add(name)
+        label_text = ",".join(f'{k}="{v}"' for k, v in labels)
+        lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+
+    if histograms:
+        lines.append("# TYPE rag_stage_seconds histogram")
+    for name, hist in sorted(histograms.items()):
+        for bound, count in zip(BUCKETS, hist["buckets"]):
+            lines.append(f'rag_stage_seconds_bucket{{stage="{name}",le="{bound}"}} {count}')
+        lines.append(f'rag_stage_seconds_bucket{{stage="{name}",le="+Inf"}} {hist["count"]}')
+        lines.append(f'rag_stage_seconds_sum{{stage="{name}"}} {hist["sum"]:.6f}')
+        lines.append(f'rag_stage_seconds_count{{stage="{name}"}} {hist["count"]}')
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.rstrip("/") != "/metrics":
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = render_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_metrics_server(port, host="0.0.0.0"):
+    """在后台线程启动 /metrics 端点"""
+    server = ThreadingHTTPServer((host, int(port)), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,112 @@
+"""
+上下文打包：重排之后、拼 Prompt 之前
+1. 同一文件同一页中相邻 / 重叠的片段合并成一段 (去掉切分时的重叠文字)
+2. 丢弃与已选内容高度相似的近重复片段
+3. 按分数从高到低装入 token 预算
+"""
+import re
+
+_CJK_RE = re.compile(r"[\u3400-\u9fff\uf900-\ufaff\u3000-\u303f\uff00-\uffef]")
+
+# 近重复判定阈值 (字符 5-gram 的 Jaccard 相似度)
+DUP_THRESHOLD = 0.85
+
+
+def estimate_tokens(text):
+    """粗略估算 token 数：中文约 1 字 1 token，其余约 4 字符 1 token"""
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def _shingles(text, n=5):
+    text = " ".join(text.split())
+    if len(text) <= n:
+        return {text}
+    return {text[i: i + n] for i in range(len(text) - n + 1)}
+
+
+def _jaccard(a, b):
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def merge_adjacent(items):
+    """合并同一 (文件, 页) 内位置相邻或重叠的片段；没有偏移信息的片段原样保留"""
+    groups = {}
+    loose = []
+    for item in items:
+        if item.get("offset") is None:
+            loose.append(dict(item, ids=[item["id"]] if item.get("id") else []))
+        else:
+            groups.setdefault((item["source"], item["page"]), []).append(item)
+
+    merged = []
+    for group in groups.values():
+        group.sort(key=lambda x: int(x["offset"]))
+        current = None
+        for item in group:
+            offset = int(item["offset"])
+            if current is not None and offset <= current["end"]:
+                # 重叠部分只保留一份
+                overlap = current["end"] - offset
+                tail = item["content"][overlap:]
+                current["content"] += tail
+                current["end"] = max(current["end"], offset + len(item["content"]))
+                current["score"] = max(current["score"], item["score"])
+                if "rrf_score" in item:
+                    current["rrf_score"] = max(current.get("rrf_score", 0.0), item["rrf_score"])
+                current["ids"].append(item["id"])
+                if item.get("also"):
+                    # 近重复片段的其他出处取并集
+                    current["also"] = current.get("also", []) + [
+                        r for r in item["also"] if r not in current.get("also", [])]
+                continue
+            if current is not None:
+                merged.append(current)
+            current = dict(item, ids=[item["id"]], end=offset + len(item["content"]))
+        if current is not None:
+            merged.append(current)
+
+    for item in merged:
+        item.pop("end", None)
+    return merged + loose
+
+
+def rank_score(item):
+    """排序依据：未经重排的召回结果用融合排名分 (rrf_score)，重排后用重排分数"""
+    return item.get("rrf_score", item["score"])
+
+
+def pack_context(items, token_budget=3000, dup_threshold=DUP_THRESHOLD):
+    """
+    合并 -> 去近重复 -> 按分数装入 token 预算
+    返回打包后的片段列表 (按分数降序)，每项带 ids 表示由哪些原始片段组成
+    """
+    if not items:
+        return []
+
+    candidates = sorted(merge_adjacent(items), key=rank_score, reverse=True)
+
+    packed = []
+    kept_shingles = []
+    used = 0
+    for item in candidates:
+        shingles = _shingles(item["content"])
+        if any(_jaccard(shingles, s) >= dup_threshold for s in kept_shingles):
+            continue
+
+        cost = estimate_tokens(item["content"]) + 20  # 20: 来源标注行
+        if used + cost > token_budget:
+            if packed:
+                continue  # 放不下就看后面更短的片段
+            # 第一段就超预算：截断后放入，保证至少有一段上下文
+            item = dict(item)
+            while item["content"] and estimate_tokens(item["content"]) + 20 > token_budget:
+                item["content"] = item["content"][: int(len(item["content"]) * 0.8)]
+            cost = estimate_tokens(item["content"]) + 20
+
+        packed.append(item)
+        kept_shingles.append(shingles)
+        used += cost
+    return packed
@@ -0,0 +1,120 @@
+import multiprocessing
+import os
+import tempfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+from modules.processor import iter_pages
+
+
+def _parse_whole(file_name, file_bytes):
+    """子进程任务：解析整个 (小) 文件"""
+    return list(iter_pages(file_name, file_bytes))
+
+
+def _parse_pdf_range(path, start, stop):
+    """子进程任务：解析大 PDF 的 [start, stop) 页 (从临时文件读取，避免在进程间复制整个文件)"""
+    import fitz  # PyMuPDF
+
+    pages = []
+    with fitz.open(path) as doc:
+        for page_index in range(start, min(stop, doc.page_count)):
+            page_text = doc[page_index].get_text()
+            if page_text.strip():
+                pages.append((page_index + 1, page_text))
+    return pages
+
+
+def _lazy_result(future):
+    """延迟取结果：解析异常在消费页迭代器时抛出，而不是在提交时"""
+    yield from future.result()
+
+
+def _pdf_page_count(file_bytes):
+    import fitz  # PyMuPDF
+    with fitz.open(stream=file_bytes, filetype="pdf") as doc:
+        return doc.page_count
+
+
+class ParseEngine:
+    """
+    多进程文档解析：
+    - 小文件：整份文件作为一个任务，多个文件并行解析
+    - 大 PDF：按页区间拆成多个任务并行解析
+    结果始终按文件顺序、页码顺序返回
+    """
+
+    def __init__(self, workers=None, large_pdf_pages=64, pages_per_task=16):
+        self.workers = max(1, int(workers or os.cpu_count() or 1))
+        self.large_pdf_pages = large_pdf_pages
+        self.pages_per_task = pages_per_task
+        # spawn：Streamlit / Chroma 进程里有很多线程，fork 容易死锁
+        self.pool = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn")
+        )
+
+    def _is_large_pdf(self, file_name, file_bytes):
+        if not file_name.lower().endswith('.pdf'):
+            return False
+        try:
+            return _pdf_page_count(file_bytes) > self.large_pdf_pages
+        except Exception:
+            return False
+
+    def iter_pages(self, file_name, file_bytes):
+        """按页码顺序逐页生成 (页码, 文本)，大 PDF 的页区间在进程池中并行解析"""
+        if not self._is_large_pdf(file_name, file_bytes):
+            yield from self.pool.submit(_parse_whole, file_name, file_bytes).result()
+            return
+
+        page_count = _pdf_page_count(file_bytes)
+        fd, path = tempfile.mkstemp(suffix=".pdf")
+        try:
+            with os.fdopen(fd, "wb") as tmp:
+                tmp.write(file_bytes)
+
+            # 滑动窗口：在途任务数有上限，保证内存有界且按顺序输出
+            ranges = deque(range(0, page_count, self.pages_per_task))
+            inflight = deque()
+            while ranges or inflight:
+                while ranges and len(inflight) < self.workers * 2:
+                    start = ranges.popleft()
+                    inflight.append(self.pool.submit(_parse_pdf_range, path, start, start + self.pages_per_task))
+                yield from inflight.popleft().result()
+        finally:
+            os.remove(path)
+
+    def prefetch(self, files):
+        """
+        files: [(文件名, 字节流), ...]
+        小文件提前提交整份解析任务，按原顺序生成 (文件名, 字节流, 页迭代器)
+        """
+        window = self.workers * 2
+        pending = deque()
+        queue = deque(files)
+
+        def submit_next():
+            name, data = queue.popleft()
+            if self._is_large_pdf(name, data):
+                pending.append((name, data, None))
+            else:
+                pending.append((name, data, self.pool.submit(_parse_whole, name, data)))
+
+        while queue or pending:
+            while queue and len(pending) < window:
+                submit_next()
+            name, data, future = pending.popleft()
+            if future is None:
+                yield name, data, self.iter_pages(name, data)
+            else:
+                yield name, data, _lazy_result(future)
+
+    def shutdown(self):
+        self.pool.shutdown(cancel_futures=True)
+
+
+@lru_cache(maxsize=None)
+def load_parse_engine(workers=None):
+    return ParseEngine(workers=workers)
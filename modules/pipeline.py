@@ -0,0 +1,95 @@
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from modules import metrics
+from modules.retriever import format_context, make_refs, search_chunks
+from modules.web_search import load_tavily_client, search_web
+
+# 检索阶段共享线程池；超时的阶段不会阻塞调用方 (结果被丢弃)
+_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="retrieval")
+
+# 默认超时 (秒)
+LOCAL_TIMEOUT = 20
+WEB_TIMEOUT = 10
+TOTAL_DEADLINE = 25
+
+
+def run_stages(stages, total_deadline=TOTAL_DEADLINE, on_stage=None):
+    """
+    并发执行互不依赖的阶段
+    stages: {名称: (函数, 单阶段超时秒数)}
+    on_stage(名称, 状态, 耗时) 在调用线程中回调，状态为 "ok" / "error" / "timeout"
+    返回 {名称: {"status", "result", "error", "elapsed"}}
+    """
+    start = time.monotonic()
+    futures = {}
+    deadlines = {}
+    for name, (fn, timeout) in stages.items():
+        futures[_executor.submit(metrics.bind_context(fn))] = name
+        deadlines[name] = start + min(timeout, total_deadline)
+
+    outcomes = {}
+    pending = set(futures)
+    while pending:
+        now = time.monotonic()
+        next_deadline = min(deadlines[futures[f]] for f in pending)
+        done, pending = wait(pending, timeout=max(next_deadline - now, 0), return_when=FIRST_COMPLETED)
+
+        for f in done:
+            name = futures[f]
+            elapsed = time.monotonic() - start
+            try:
+                outcomes[name] = {"status": "ok", "result": f.result(), "error": None, "elapsed": elapsed}
+            except Exception as e:
+                outcomes[name] = {"status": "error", "result": None, "error": e, "elapsed": elapsed}
+            if on_stage: on_stage(name, outcomes[name]["status"], elapsed)
+
+        # 超过各自截止时间的阶段直接放弃，降级为空结果
+        now = time.monotonic()
+        for f in list(pending):
+            name = futures[f]
+            if now >= deadlines[name]:
+                pending.discard(f)
+                f.cancel()
+                outcomes[name] = {"status": "timeout", "result": None, "error": None,
+                                  "elapsed": now - start}
+                metrics.incr("rag_stage_timeouts_total", stage=name)
+                if on_stage: on_stage(name, "timeout", now - start)
+    return outcomes
+
+
+def retrieve_context(query, embedder=None, reranker=None, top_k_recall=50, top_k_rerank=5,
+                     token_budget=None, tavily_key=None, local_timeout=LOCAL_TIMEOUT,
+                     web_timeout=WEB_TIMEOUT, total_deadline=TOTAL_DEADLINE, on_stage=None,
+                     collection=None, sources=None):
+    """
+    检索编排：本地检索 (向量化 -> 召回 -> 重排) 与联网搜索并发执行
+    embedder 为 None 时跳过本地检索，tavily_key 为空时跳过联网搜索
+    collection / sources 限定本地检索的知识库与文件范围 (见 search_chunks)
+    返回 {"local": 本地上下文, "local_refs": 片段引用, "web": 网络上下文, "stages": run_stages 的结果}
+    """
+    stages = {}
+    if embedder is not None:
+        stages["local"] = (
+            lambda: search_chunks(embedder, query, reranker, top_k_recall=top_k_recall,
+                                  top_k_rerank=top_k_rerank, token_budget=token_budget,
+                                  collection=collection, sources=sources),
+            local_timeout
+        )
+    if tavily_key:
+        # 客户端在当前线程创建 (首次调用时导入 tavily)：第三方库的首次导入不与本地检索线程并发进行
+        load_tavily_client(tavily_key, None)
+
+        def web_stage():
+            with metrics.stage("web_search"):
+                return search_web(query, tavily_key)
+        stages["web"] = (web_stage, web_timeout)
+
+    outcomes = run_stages(stages, total_deadline=total_deadline, on_stage=on_stage)
+    chunks = (outcomes.get("local") or {}).get("result") or []
+    return {
+        "local": format_context(chunks),
+        "local_refs": make_refs(chunks),
+        "web": (outcomes.get("web") or {}).get("result") or "",
+        "stages": outcomes,
+    }
@@ -1,89 +1,128 @@
-import streamlit as st
+import hashlib
 from io import BytesIO
 
+# 切分参数：PDF 按页切分，Word / TXT 整篇切分
+PDF_CHUNK_SIZE, PDF_OVERLAP = 600, 50
+TEXT_CHUNK_SIZE, TEXT_OVERLAP = 600, 60
 
-@st.cache_data(show_spinner=False)
-def process_file(_model, file_name, file_bytes):
+
+def file_fingerprint(file_bytes):
+    """文件内容指纹 (sha256)"""
+    return hashlib.sha256(file_bytes).hexdigest()
+
+
+def text_fingerprint(text):
+    """页面 / 片段文本指纹"""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def chunk_id(source, page, offset, content_hash):
+    """由 (文件, 页码, 偏移, 内容哈希) 派生的确定性片段 ID，重复入库会覆盖而不是追加"""
+    raw = f"{source}|{page}|{offset}|{content_hash}".encode("utf-8")
+    return hashlib.sha1(raw).hexdigest()
+
+
+def iter_pages(file_name, file_bytes):
     """
-    输入：模型、文件名、文件字节流
-    输出：chunks (带页码元数据), vectors, error_message
+    逐页生成 (页码, 文本)，不把整个文档的文本一次性载入内存
+    Word / TXT 没有固定页码，整篇作为一页 "N/A"
     """
     # 延迟导入，防止启动卡顿
     import fitz  # PyMuPDF
     import docx
 
+    # --- 1. 处理 PDF (支持精确页码) ---
+    if file_name.lower().endswith('.pdf'):
+        # 使用 PyMuPDF 打开
+        with fitz.open(stream=file_bytes, filetype="pdf") as doc:
+            for page_index, page in enumerate(doc):
+                # 获取当前页的文本
+                page_text = page.get_text()
+
+                if not page_text.strip():
+                    continue  # 跳过空白页
+
+                yield page_index + 1, page_text  # 人类习惯从第1页开始
+
+    # --- 2. 处理 Word (Word流式排版，无固定页码) ---
+    elif file_name.lower().endswith('.docx'):
+        doc = docx.Document(BytesIO(file_bytes))
+        # Word 只能把所有段落拼起来
+        text = "\n".join([p.text for p in doc.paragraphs])
+        if text.strip():
+            yield "N/A", text
+
+    # --- 3. 处理 TXT ---
+    elif file_name.lower().endswith('.txt'):
+        text = file_bytes.decode("utf-8")
+        if text.strip():
+            yield "N/A", text
+
+
+def count_pages(file_name, file_bytes):
+    """文件页数 (用于进度估算)，非 PDF 视为 1 页"""
+    if file_name.lower().endswith('.pdf'):
+        import fitz  # PyMuPDF
+        with fitz.open(stream=file_bytes, filetype="pdf") as doc:
+            return doc.page_count
+    return 1
+
+
+def extract_pages(file_name, file_bytes):
+    """按页提取文本，返回 [(页码, 文本), ...]"""
+    return list(iter_pages(file_name, file_bytes))
+
+
+def split_page(file_name, page_num, page_text):
+    """
+    页内切分：一页字数太多时切成多段，但它们都属于同一个页码
+    每个片段记录偏移、页面指纹和确定性 ID
+    """
+    if page_num == "N/A":
+        chunk_size, overlap = TEXT_CHUNK_SIZE, TEXT_OVERLAP
+    else:
+        chunk_size, overlap = PDF_CHUNK_SIZE, PDF_OVERLAP
+
+    page_hash = text_fingerprint(page_text)
+    chunks = []
+    start = 0
+    while start < len(page_text):
+        end = start + chunk_size
+        chunk_content = page_text[start:end]
+
+        chunks.append({
+            "id": chunk_id(file_name, page_num, start, text_fingerprint(chunk_content)),
+            "content": chunk_content,
+            "source": file_name,
+            "page": page_num,
+            "offset": start,
+            "page_hash": page_hash,
+        })
+
+        # 如果一页还没切完，继续切下一段；如果切完了，就break
+        if end >= len(page_text):
+            break
+
+        start += (chunk_size - overlap)
+    return chunks
+
+
+def extract_chunks(file_name, file_bytes):
+    """提取并切分整个文件，返回带页码 / 指纹元数据的 chunks"""
     chunks = []
+    for page_num, page_text in iter_pages(file_name, file_bytes):
+        chunks.extend(split_page(file_name, page_num, page_text))
+    return chunks
 
-    try:
-        # --- 1. 处理 PDF (支持精确页码) ---
-        if file_name.lower().endswith('.pdf'):
-            # 使用 PyMuPDF 打开
-            with fitz.open(stream=file_bytes, filetype="pdf") as doc:
-                for page_index, page in enumerate(doc):
-                    # 获取当前页的文本
-                    page_text = page.get_text()
-
-                    if not page_text.strip():
-                        continue  # 跳过空白页
-
-                    # --- 页内切分逻辑 ---
-                    # 如果这一页字数太多（超过600），我们也需要把它切开
-                    # 但它们都属于同一个页码
-                    page_num = page_index + 1  # 人类习惯从第1页开始
-
-                    chunk_size = 600
-                    overlap = 50
-                    start = 0
-
-                    while start < len(page_text):
-                        end = start + chunk_size
-                        chunk_content = page_text[start:end]
-
-                        # 存入 chunk，额外记录 'page' 字段
-                        chunks.append({
-                            "content": chunk_content,
-                            "source": file_name,
-                            "page": page_num  # <--- 核心修改：记录页码
-                        })
-
-                        # 如果一页还没切完，继续切下一段；如果切完了，就break
-                        if end >= len(page_text):
-                            break
-
-                        start += (chunk_size - overlap)
-
-        # --- 2. 处理 Word (Word流式排版，无固定页码) ---
-        elif file_name.lower().endswith('.docx'):
-            doc = docx.Document(BytesIO(file_bytes))
-            # Word 只能把所有段落拼起来
-            text = "\n".join([p.text for p in doc.paragraphs])
-
-            # 标准切分
-            chunk_size = 600
-            overlap = 60
-            start = 0
-            while start < len(text):
-                chunks.append({
-                    "content": text[start:start + chunk_size],
-                    "source": file_name,
-                    "page": "N/A"  # Word 暂时无法提取页码
-                })
-                start += (chunk_size - overlap)
-
-        # --- 3. 处理 TXT ---
-        elif file_name.lower().endswith('.txt'):
-            text = file_bytes.decode("utf-8")
-            chunk_size = 600
-            overlap = 60
-            start = 0
-            while start < len(text):
-                chunks.append({
-                    "content": text[start:start + chunk_size],
-                    "source": file_name,
-                    "page": "N/A"
-                })
-                start += (chunk_size - overlap)
 
+def process_file(_model, file_name, file_bytes):
+    """
+    输入：模型、文件名、文件字节流
+    输出：chunks (带页码元数据), vectors, error_message
+    注意：一次性返回整个文件的结果，大文件入库请使用 modules.ingest 的流式管线
+    """
+    try:
+        chunks = extract_chunks(file_name, file_bytes)
     except Exception as e:
         return None, None, f"文件处理失败: {e}"
 
@@ -97,4 +136,4 @@ def process_file(_model, file_name, file_bytes):
         vectors = _model.encode(texts_to_embed)
         return chunks, vectors, None
     except Exception as e:
-        return None, None, f"向量计算失败: {e}"
\ No newline at end of file
+        return None, None, f"向量计算失败: {e}"
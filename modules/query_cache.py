@@ -0,0 +1,93 @@
+"""
+查询结果的多级内存缓存 (进程内，LRU 限制条目数)
+- vectors:     查询向量，键为 (向量模型, 归一化查询)；未命中时再走磁盘向量缓存 / API
+- candidates:  双路召回 + RRF 融合后的候选片段
+- reranked:    重排结果 (只存片段 ID 与分数)
+- web:         联网搜索结果，带 TTL (网页内容会变)
+
+候选与重排的缓存键包含知识库的版本号 (见 manifest.collection_version)：
+add_to_db / delete_pages / delete_file_from_db / reset_db 写库后版本号加一，旧条目不再命中，
+随后被 LRU 淘汰。版本号存放在 SQLite 中，其他进程 (命令行入库、API worker) 的写入同样生效
+"""
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+from modules import metrics
+
+# 各级缓存的条目上限与联网结果的有效期 (秒)
+VECTOR_ENTRIES = 2048
+CANDIDATE_ENTRIES = 256
+RERANK_ENTRIES = 1024
+WEB_ENTRIES = 256
+WEB_TTL = 600
+
+
+class LRUCache:
+    """线程安全的 LRU 缓存；ttl 不为空时条目过期后视为未命中。读写都复制值，调用方可以随意修改"""
+
+    def __init__(self, name, max_entries, ttl=None):
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and self.ttl is not None and time.monotonic() - entry[1] > self.ttl:
+                del self._data[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+            else:
+                self._data.move_to_end(key)
+                self.hits += 1
+        metrics.incr("query_cache_hits_total" if entry is not None else "query_cache_misses_total",
+                     level=self.name)
+        return None if entry is None else copy.deepcopy(entry[0])
+
+    def put(self, key, value):
+        value = copy.deepcopy(value)
+        with self._lock:
+            self._data[key] = (value, time.monotonic())
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {"size": len(self._data), "hits": self.hits, "misses": self.misses,
+                    "hit_rate": self.hits / total if total else 0.0}
+
+
+vectors = LRUCache("vectors", VECTOR_ENTRIES)
+candidates = LRUCache("candidates", CANDIDATE_ENTRIES)
+reranked = LRUCache("reranked", RERANK_ENTRIES)
+web = LRUCache("web", WEB_ENTRIES, ttl=WEB_TTL)
+
+LEVELS = (vectors, candidates, reranked, web)
+
+
+def normalize_query(query):
+    """合并多余空白；大小写与标点保持原样 (会影响向量与重排结果)"""
+    return " ".join(query.split())
+
+
+def stats():
+    """各级缓存的条目数与命中率 {级别: {"size", "hits", "misses", "hit_rate"}}"""
+    return {cache.name: cache.stats() for cache in LEVELS}
+
+
+def clear():
+    for cache in LEVELS:
+        cache.clear()
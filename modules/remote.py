@@ -0,0 +1,224 @@
+"""
+外部服务调用的公共层：Rerank / Tavily / Embedding 共用
+- 连接池：每个服务一个常驻 requests.Session (keep-alive，复用 TCP / TLS 连接)
+- 重试：网络错误、超时、429 / 5xx 时指数退避重试 (优先遵循 Retry-After)
+- 对冲请求 (hedging)：首个请求超过 hedge_after 秒仍未返回时再发一个，取先返回的结果
+- 熔断：连续失败达到阈值后在冷却期内直接跳过该服务 (抛 CircuitOpenError)，
+  调用方立即走降级逻辑，不必每次都等到超时；冷却期过后放行一次试探请求
+"""
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import lru_cache
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from modules import metrics
+
+# 每个服务的连接池大小 (并发请求数超过时排队等待空闲连接)
+POOL_SIZE = 16
+# 熔断参数：连续失败次数阈值、冷却秒数
+FAILURE_THRESHOLD = 5
+COOLDOWN = 30.0
+# 需要重试的 HTTP 状态码
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+RETRYABLE_ERRORS = (requests.ConnectionError, requests.Timeout)
+
+# 对冲请求使用的线程池
+_hedge_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="hedge")
+
+
+class CircuitOpenError(RuntimeError):
+    """服务处于熔断状态，本次调用未发出"""
+
+
+class CircuitBreaker:
+    """
+    三态熔断器：closed (正常) -> open (熔断，冷却期内拒绝调用) -> half-open (放行一次试探)
+    试探成功恢复 closed，失败重新进入 open
+    """
+
+    def __init__(self, name, failure_threshold=FAILURE_THRESHOLD, cooldown=COOLDOWN):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self.opened_at is None:
+                return "closed"
+            if time.monotonic() - self.opened_at >= self.cooldown:
+                return "half-open"
+            return "open"
+
+    def allow(self):
+        """是否放行本次调用；半开状态下只放行一个试探请求"""
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at < self.cooldown or self._probing:
+                return False
+            self._probing = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._probing or self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    metrics.incr("circuit_breaker_opened_total", service=self.name)
+                self.opened_at = time.monotonic()
+            self._probing = False
+
+    def check(self):
+        """不放行时抛出 CircuitOpenError"""
+        if not self.allow():
+            metrics.incr("circuit_breaker_rejected_total", service=self.name)
+            raise CircuitOpenError(f"{self.name} 服务熔断中，{self.cooldown:.0f}s 冷却期内跳过调用")
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(name):
+    """进程内每个服务一个熔断器"""
+    with _breakers_lock:
+        if name not in _breakers:
+            _breakers[name] = CircuitBreaker(name)
+        return _breakers[name]
+
+
+def breaker_states():
+    """已调用过的服务的熔断状态 {服务名: closed / open / half-open}"""
+    with _breakers_lock:
+        breakers = dict(_breakers)
+    return {name: b.state for name, b in sorted(breakers.items())}
+
+
+def new_session(pool_size=POOL_SIZE):
+    """带连接池的 Session；重试由本模块控制，适配器本身不重试"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=0)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+@lru_cache(maxsize=None)
+def get_session(name):
+    """进程内每个服务一个常驻 Session"""
+    return new_session()
+
+
+def warm_openai_client(client, timeout=10):
+    """
+    预热 OpenAI 兼容客户端 (Embedding / DeepSeek)：列一次模型，建立 TCP / TLS 连接留在 SDK 的连接池里
+    服务端不支持该接口时返回错误状态码，连接同样已建立，不算失败
+    """
+    import openai
+    try:
+        client.with_options(max_retries=0, timeout=timeout).models.list()
+    except openai.APIStatusError:
+        pass
+
+
+def retry_delay(error, attempt, base_delay):
+    """优先遵循服务端的 Retry-After，否则指数退避 + 随机抖动"""
+    response = getattr(error, "response", error)
+    headers = getattr(response, "headers", None)
+    if headers is not None:
+        try:
+            return max(float(headers.get("retry-after")), 0.0)
+        except (TypeError, ValueError):
+            pass
+    return base_delay * (2 ** attempt) + random.uniform(0, base_delay)
+
+
+def call(name, fn, retries=2, base_delay=0.5, retry_on=RETRYABLE_ERRORS):
+    """
+    在熔断器保护下调用 fn()，retry_on 中的异常按退避重试
+    重试耗尽或遇到不可重试的异常时计一次失败并抛出；只有成功返回才计为成功；熔断中直接抛 CircuitOpenError
+    """
+    breaker = get_breaker(name)
+    breaker.check()
+    attempt = 0
+    while True:
+        try:
+            result = fn()
+        except retry_on as e:
+            if attempt >= retries:
+                breaker.record_failure()
+                raise
+            metrics.incr("remote_retries_total", service=name)
+            time.sleep(retry_delay(e, attempt, base_delay))
+            attempt += 1
+            continue
+        except Exception:
+            # 非瞬时错误 (参数错误、鉴权失败等) 不重试，但同样是一次失败调用
+            breaker.record_failure()
+            raise
+        breaker.record_success()
+        return result
+
+
+def _hedged(send, hedge_after, name):
+    """先发一个请求，hedge_after 秒内未返回再发第二个，返回先成功的那个"""
+    first = _hedge_executor.submit(send)
+    done, _ = wait([first], timeout=hedge_after)
+    if done:
+        return first.result()
+    metrics.incr("remote_hedges_total", service=name)
+    pending = {first, _hedge_executor.submit(send)}
+    error = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            try:
+                return future.result()
+            except Exception as e:
+                error = e
+    raise error
+
+
+class _RetryableStatus(Exception):
+    def __init__(self, response):
+        super().__init__(f"HTTP {response.status_code}")
+        self.response = response
+
+
+def request(name, method, url, timeout=10, retries=2, base_delay=0.5, hedge_after=None, **kwargs):
+    """
+    通过服务 name 的常驻 Session 发送请求，返回 Response
+    429 / 5xx 与网络错误会重试；重试耗尽时 429 / 5xx 原样返回最后的响应，网络错误抛出异常
+    hedge_after 不为空时启用对冲请求 (只用于幂等请求)
+    """
+    session = get_session(name)
+
+    def send():
+        response = session.request(method, url, timeout=timeout, **kwargs)
+        if response.status_code in RETRYABLE_STATUS:
+            raise _RetryableStatus(response)
+        return response
+
+    def attempt():
+        return _hedged(send, hedge_after, name) if hedge_after else send()
+
+    try:
+        return call(name, attempt, retries=retries, base_delay=base_delay,
+                    retry_on=RETRYABLE_ERRORS + (_RetryableStatus,))
+    except _RetryableStatus as e:
+        return e.response
@@ -1,21 +1,42 @@
-import requests
-import json
-import streamlit as st
+from functools import lru_cache
+
+from modules import metrics, query_cache, remote
+
+# 单次请求超时 (秒) 与重试次数；检索阶段整体还受 pipeline.LOCAL_TIMEOUT 约束
+RERANK_TIMEOUT = 10
+RERANK_RETRIES = 1
+
+
+def _with_score(candidate, score):
+    """重排后的片段：score 换成重排分数，召回阶段的融合排名分不再参与排序"""
+    item = dict(candidate, score=score)
+    item.pop("rrf_score", None)
+    return item
 
 
 class APIReranker:
-    def __init__(self, api_key, base_url, model_name):
+    def __init__(self, api_key, base_url, model_name, hedge_after=None):
         self.api_key = api_key
         self.base_url = base_url
         self.model_name = model_name
+        # 对冲请求：首个请求超过该秒数未返回时再发一个 (None 为关闭)
+        self.hedge_after = hedge_after
 
-    def rerank(self, query, candidates, top_k=5):
+    def rerank(self, query, candidates, top_k=5, cache_key=None):
         """
         调用 SiliconFlow (BGE-Reranker) API 进行重排序
+        cache_key 不为空时 (同一候选集的唯一标识) 先查重排缓存；只缓存成功的结果，降级结果不缓存
         """
         if not candidates:
             return []
 
+        if cache_key is not None:
+            cache_key = (cache_key, self.model_name, top_k)
+            cached = query_cache.reranked.get(cache_key)
+            by_id = {c.get("id"): c for c in candidates}
+            if cached is not None and all(cid in by_id for cid, _ in cached):
+                return [_with_score(by_id[cid], score) for cid, score in cached]
+
         # 1. 准备纯文本列表
         documents = [item['content'] for item in candidates]
 
@@ -35,12 +56,16 @@ class APIReranker:
         }
 
         try:
-            response = requests.post(self.base_url, headers=headers, json=payload, timeout=10)
+            # 常驻连接池 + 退避重试 + 熔断；服务熔断中时直接降级，不再等待超时
+            response = remote.request("rerank", "POST", self.base_url, headers=headers, json=payload,
+                                      timeout=RERANK_TIMEOUT, retries=RERANK_RETRIES,
+                                      hedge_after=self.hedge_after)
 
             # 检查状态码
             if response.status_code != 200:
                 error_msg = response.text
-                st.warning(f"⚠️ Rerank 服务响应异常 ({response.status_code}): {error_msg} -> 已降级为普通检索")
+                print(f"⚠️ Rerank 服务响应异常 ({response.status_code}): {error_msg} -> 已降级为普通检索")
+                metrics.incr("reranker_fallbacks_total", reason=str(response.status_code))
                 return candidates[:top_k]  # 降级处理
 
             data = response.json()
@@ -52,24 +77,30 @@ class APIReranker:
                 idx = item['index']
                 score = item['relevance_score']
 
-                # 拿回原始数据
-                original_doc = candidates[idx]
-
-                # 更新分数为 Rerank 的分数
-                original_doc['score'] = score
-                reranked_candidates.append(original_doc)
+                # 拿回原始数据 (复制一份，不改动缓存中的候选)，分数换成 Rerank 的分数
+                reranked_candidates.append(_with_score(candidates[idx], score))
 
             # 按分数降序排序
             reranked_candidates.sort(key=lambda x: x['score'], reverse=True)
 
+            if cache_key is not None:
+                query_cache.reranked.put(cache_key, [(c.get("id"), c["score"]) for c in reranked_candidates])
             return reranked_candidates
 
+        except remote.CircuitOpenError:
+            metrics.incr("reranker_fallbacks_total", reason="circuit_open")
+            return candidates[:top_k]
         except Exception as e:
-            st.warning(f"⚠️ Rerank 调用失败: {e} -> 已降级为普通检索")
+            print(f"⚠️ Rerank 调用失败: {e} -> 已降级为普通检索")
+            metrics.incr("reranker_fallbacks_total", reason=type(e).__name__)
             return candidates[:top_k]
 
+    def warm_up(self):
+        """预热：建立到 Rerank 服务的连接并留在常驻连接池中 (不计入熔断，任何响应都说明连接已建立)"""
+        remote.get_session("rerank").head(self.base_url, timeout=RERANK_TIMEOUT)
+
 
-@st.cache_resource
-def load_reranker(api_key, base_url, model_name):
+@lru_cache(maxsize=None)
+def load_reranker(api_key, base_url, model_name, hedge_after=None):
     if not api_key: return None
-    return APIReranker(api_key, base_url, model_name)
\ No newline at end of file
+    return APIReranker(api_key, base_url, model_name, hedge_after=hedge_after)
\ No newline at end of file
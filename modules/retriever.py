@@ -1,35 +1,177 @@
-from modules.database import query_db
+from concurrent.futures import ThreadPoolExecutor
 
+from modules import metrics, query_cache
+from modules.database import COLLECTION_NAME, collection_version, get_chunks_by_ids, query_db, search_lexical
+from modules.history import get_snapshots
+from modules.packer import pack_context
 
-def search_vectors(embedder, query, reranker=None, top_k_recall=50, top_k_rerank=5):
+# RRF 融合常数 (经验值 60)
+RRF_K = 60
+
+
+def rrf_fuse(result_lists, top_k, k=RRF_K):
+    """
+    倒数排名融合 (Reciprocal Rank Fusion)：rrf_score = Σ 1 / (k + rank)
+    多路结果按片段 ID 合并，不依赖各路分数的量纲；rrf_score 只用于排序，
+    score 保留片段在靠前一路 (向量检索优先) 中的原始分数，供展示
+    """
+    fused = {}
+    for results in result_lists:
+        for rank, item in enumerate(results):
+            entry = fused.get(item["id"])
+            if entry is None:
+                entry = dict(item, rrf_score=0.0)
+                fused[item["id"]] = entry
+            entry["rrf_score"] += 1.0 / (k + rank + 1)
+    ranked = sorted(fused.values(), key=lambda x: x["rrf_score"], reverse=True)
+    return ranked[:top_k]
+
+
+def embed_query(embedder, query):
+    """查询向量：先查内存缓存，未命中再走 encode (磁盘向量缓存 / API)"""
+    key = (embedder.model_name, query_cache.normalize_query(query))
+    q_vec = query_cache.vectors.get(key)
+    if q_vec is None:
+        with metrics.stage("query_embed"):
+            q_vec = embedder.encode([query])[0]
+        query_cache.vectors.put(key, q_vec)
+    return q_vec
+
+
+def _dense_search(embedder, query, top_k, collection=None, sources=None):
+    q_vec = embed_query(embedder, query)
+    with metrics.stage("query_db"):
+        return query_db(q_vec, top_k=top_k, collection=collection, sources=sources)
+
+
+def _lexical_search(query, top_k, collection=None, sources=None):
+    with metrics.stage("lexical"):
+        return search_lexical(query, top_k, collection=collection, sources=sources)
+
+
+def search_chunks(embedder, query, reranker=None, top_k_recall=50, top_k_rerank=5, token_budget=None,
+                  collection=None, sources=None):
     """
-    支持动态参数的智能检索
+    支持动态参数的智能检索，返回最终片段列表
+    向量检索与 BM25 关键词检索并行执行，再用 RRF 融合
+    token_budget 不为空时，重排结果再经过上下文打包 (合并相邻片段、去重、限制 token 数)
+    collection 为检索的知识库；sources 不为 None 时两路召回都只在这些文件中进行
+    召回候选与重排结果按 (知识库版本, 查询, 参数, 范围) 缓存，知识库有写入时自动失效
     """
-    # 1. 向量化
-    q_vec = embedder.encode([query])[0]
+    if sources is not None and not sources:
+        return []
 
-    # 2. 粗排 (Recall) - 使用动态参数 top_k_recall
+    # 1. 粗排 (Recall) - 使用动态参数 top_k_recall
     # 如果没有 Rerank，直接用 rerank 的数量作为最终数量，避免过多
     initial_k = top_k_recall if reranker else top_k_rerank
-    candidates = query_db(q_vec, top_k=initial_k)
 
-    if not candidates:
-        return ""
+    collection = collection or COLLECTION_NAME
+    cache_key = (collection, collection_version(collection), query_cache.normalize_query(query),
+                 tuple(sorted(sources)) if sources is not None else None, top_k_recall, initial_k)
+    candidates = query_cache.candidates.get(cache_key)
+    if candidates is None:
+        candidates = _recall(embedder, query, top_k_recall, initial_k, collection, sources)
+        query_cache.candidates.put(cache_key, candidates)
+    return rerank_and_pack(query, candidates, reranker, top_k_rerank, token_budget, cache_key=cache_key)
 
-    final_results = candidates
+
+def _recall(embedder, query, top_k_recall, initial_k, collection, sources):
+    """2. 两路召回并行：向量 (含 query 向量化) + 关键词，再用 RRF 融合"""
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        dense_future = pool.submit(metrics.bind_context(_dense_search), embedder, query, top_k_recall,
+                                   collection, sources)
+        lexical_future = pool.submit(metrics.bind_context(_lexical_search), query, top_k_recall,
+                                     collection, sources)
+        dense = dense_future.result()
+        try:
+            sparse = lexical_future.result()
+        except Exception as e:
+            # 关键词索引异常不影响向量检索
+            print(f"关键词检索失败: {e}")
+            sparse = []
+
+    return rrf_fuse([dense, sparse], top_k=initial_k)
+
+
+def rerank_and_pack(query, candidates, reranker=None, top_k_rerank=5, token_budget=None, cache_key=None):
+    """
+    召回之后的公共步骤：精排 + 上下文打包 (单条检索与批量检索共用)
+    cache_key 为候选集的缓存键，传入时重排结果走重排缓存
+    """
+    if not candidates:
+        return []
 
     # 3. 精排 (Rerank) - 使用动态参数 top_k_rerank
+    final_results = candidates
     if reranker:
-        final_results = reranker.rerank(query, candidates, top_k=top_k_rerank)
+        with metrics.stage("rerank"):
+            final_results = reranker.rerank(query, candidates, top_k=top_k_rerank, cache_key=cache_key)
+
+    # 4. 上下文打包
+    if token_budget:
+        with metrics.stage("pack_context"):
+            final_results = pack_context(final_results, token_budget=token_budget)
+    return final_results
+
+
+def _page_info(page):
+    return f"第 {page} 页" if page != "N/A" else "文本"
+
+
+def format_chunk(item):
+    header = f"[本地: {item['source']} | {_page_info(item['page'])} | 相关度: {item['score']:.4f}]"
+    if item.get("also"):
+        # 近重复去重后只保存了一份的内容，列出其他出处
+        header += "\n[另见: " + "; ".join(f"{r['source']} {_page_info(r['page'])}" for r in item["also"]) + "]"
+    return f"{header}\n{item['content']}"
+
+
+def format_context(items):
+    """把片段列表格式化为 Prompt 中的本地知识文本"""
+    return "\n\n".join(format_chunk(item) for item in items)
+
+
+def make_refs(items):
+    """聊天记录中只保存片段引用，不保存原文；合并过的片段展开为各原始片段的引用"""
+    refs = []
+    for item in items:
+        for chunk_id in item.get("ids") or [item.get("id")]:
+            if chunk_id:
+                ref = {"id": chunk_id, "source": item["source"], "page": item["page"], "score": item["score"]}
+                # 默认知识库之外的片段记下所属知识库，展开引用时到对应集合读取
+                if item.get("collection") and item["collection"] != COLLECTION_NAME:
+                    ref["collection"] = item["collection"]
+                if item.get("also"):
+                    ref["also"] = item["also"]
+                refs.append(ref)
+    return refs
+
+
+def resolve_refs(refs):
+    """
+    按引用取回原文：优先从向量库读取，片段已被删除时使用删除前留下的快照
+    返回可直接展示的文本
+    """
+    by_collection = {}
+    for r in refs:
+        by_collection.setdefault(r.get("collection") or COLLECTION_NAME, []).append(r["id"])
+    found = {}
+    for collection, ids in by_collection.items():
+        found.update(get_chunks_by_ids(ids, collection))
+    missing = [r["id"] for r in refs if r["id"] not in found]
+    if missing:
+        found.update(get_snapshots(missing))
 
-    # 4. 格式化输出
-    valid_results = []
-    for item in final_results:
-        page_info = f"第 {item['page']} 页" if item['page'] != "N/A" else "文本"
-        piece = f"[本地: {item['source']} | {page_info} | 相关度: {item['score']:.4f}]\n{item['content']}"
-        valid_results.append(piece)
+    pieces = []
+    for ref in refs:
+        chunk = found.get(ref["id"])
+        content = chunk["content"] if chunk else "(原文已删除)"
+        pieces.append(format_chunk({**ref, "content": content}))
+    return "\n\n".join(pieces)
 
-    if not valid_results:
-        return ""
 
-    return "\n\n".join(valid_results)
\ No newline at end of file
+def search_vectors(embedder, query, reranker=None, top_k_recall=50, top_k_rerank=5, token_budget=None,
+                   collection=None, sources=None):
+    """检索并格式化为 Prompt 文本"""
+    return format_context(search_chunks(embedder, query, reranker, top_k_recall, top_k_rerank, token_budget,
+                                        collection=collection, sources=sources))
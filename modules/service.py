@@ -0,0 +1,282 @@
+"""
+无界面的核心服务层：入库 / 检索 / 生成 / 历史
+Streamlit 页面、HTTP API (api.py) 和命令行 (cli.py) 都只调用这里，不直接拼装各模块
+"""
+import datetime
+import time
+
+from modules import answer_cache, batch, dedup, history, jobs, manifest, query_cache, remote, startup
+from modules.config import load_settings
+from modules.database import (check_collection, delete_file_from_db, get_all_files, get_file_records, get_store,
+                              list_collections, reset_db, resolve_scope)
+from modules.embedder import load_embedder, load_embedding_cache
+from modules.llm import build_system_prompt, load_llm_client, stream_answer
+from modules.memory import build_memory, rewrite_query
+from modules.parser_pool import load_parse_engine
+from modules.pipeline import retrieve_context
+from modules.reranker import load_reranker
+from modules.retriever import embed_query
+
+
+def day_range(date_from=None, date_to=None):
+    """
+    日期 (date 对象或 YYYY-MM-DD 字符串) -> 入库时间范围 (since, until) Unix 秒
+    date_to 包含当天；为空的一端不限制
+    """
+    def to_date(value):
+        if not value:
+            return None
+        return value if isinstance(value, datetime.date) else datetime.date.fromisoformat(str(value))
+
+    start, end = to_date(date_from), to_date(date_to)
+    since = datetime.datetime.combine(start, datetime.time.min).timestamp() if start else None
+    until = datetime.datetime.combine(end, datetime.time.max).timestamp() if end else None
+    return since, until
+
+
+class RAGService:
+    def __init__(self, settings=None):
+        self.settings = settings or load_settings()
+
+    def get(self, key, default=None):
+        value = self.settings.get(key)
+        return default if value is None else value
+
+    # --- 外部服务 (进程内共享) ---
+    @property
+    def embedder(self):
+        if not self.get("EMBEDDING_API_KEY"):
+            return None
+        return load_embedder(self.get("EMBEDDING_API_KEY"), self.get("EMBEDDING_BASE_URL"),
+                             self.get("EMBEDDING_MODEL"))
+
+    @property
+    def reranker(self):
+        # 可选的对冲请求：Rerank 超过 RERANK_HEDGE_MS 毫秒未返回时再发一个
+        hedge_ms = self.get("RERANK_HEDGE_MS")
+        return load_reranker(self.get("RERANK_API_KEY"), self.get("RERANK_BASE_URL"), self.get("RERANK_MODEL"),
+                             hedge_after=float(hedge_ms) / 1000 if hedge_ms else None)
+
+    @property
+    def llm(self):
+        if not self.get("DEEPSEEK_API_KEY"):
+            return None
+        return load_llm_client(self.get("DEEPSEEK_API_KEY"), self.get("DEEPSEEK_BASE_URL"))
+
+    @property
+    def answer_cache_threshold(self):
+        """语义答案缓存的相似度阈值；未配置 ANSWER_CACHE_THRESHOLD 时为 None (默认不启用)"""
+        value = self.get("ANSWER_CACHE_THRESHOLD")
+        return None if value is None else float(value)
+
+    def status(self):
+        """各外部服务是否已配置、熔断状态，向量缓存 / 查询缓存 / 答案缓存统计，以及启动剖面 (毫秒)"""
+        return {
+            "llm": bool(self.get("DEEPSEEK_API_KEY")),
+            "rag": bool(self.get("EMBEDDING_API_KEY")),
+            "web": bool(self.get("TAVILY_API_KEY")),
+            "embedding_cache": load_embedding_cache().stats(),
+            "circuits": remote.breaker_states(),
+            "query_cache": query_cache.stats(),
+            "answer_cache": answer_cache.stats(),
+            "startup": startup.profile(),
+        }
+
+    def warm_up(self, collection=None, background=True):
+        """预热向量库索引、HTTP 连接池与各客户端句柄 (见 startup.py)；background=False 时阻塞到完成"""
+        if background:
+            return startup.start_warm_up(self, collection)
+        return startup.warm_up(self, collection)
+
+    # --- 知识库 (collection 为空时使用默认知识库) ---
+    def submit_ingest(self, files, collection=None, tags=None):
+        """
+        提交后台入库任务 files: [(文件名, 字节流), ...]，tags 为这批文件的标签，立即返回任务 ID
+        写库统一由持有租约的后台 worker 完成 (向量库只有一个写入者)
+        """
+        embedder = self.embedder
+        if embedder is None:
+            raise ValueError("未配置 EMBEDDING_API_KEY")
+        collection = check_collection(collection)
+        jobs.ensure_worker(embedder, load_parse_engine(self.get("PARSE_WORKERS")))
+        return jobs.submit(files, collection=collection, tags=tags)
+
+    def resume_jobs(self):
+        """
+        启动时调用：存在未完成的任务 (上次进程崩溃 / 重启前留下的) 时启动本进程的后台 worker，
+        不必等到下一次提交任务才续跑；返回是否启动
+        """
+        embedder = self.embedder
+        if embedder is None or not jobs.list_jobs(limit=1, active_only=True):
+            return False
+        jobs.ensure_worker(embedder, load_parse_engine(self.get("PARSE_WORKERS")))
+        return True
+
+    def ingest(self, files, on_progress=None, collection=None, tags=None):
+        """同步入库：提交任务并等待完成，返回 [(文件名, 统计), ...]；on_progress(文件序号, 已写入片段数, 预估总片段数)"""
+        job_id = self.submit_ingest(files, collection=collection, tags=tags)
+        return jobs.wait(job_id, on_progress=on_progress)
+
+    def job(self, job_id):
+        return jobs.get_job(job_id)
+
+    def list_jobs(self, limit=20, active_only=False):
+        return jobs.list_jobs(limit=limit, active_only=active_only)
+
+    def list_collections(self):
+        return list_collections()
+
+    def has_documents(self, collection=None):
+        return get_store(collection).count() > 0
+
+    def list_files(self, collection=None):
+        return get_all_files(collection)
+
+    def file_records(self, collection=None):
+        """文件清单记录 (含标签、入库时间)，用于检索范围筛选"""
+        return get_file_records(collection)
+
+    def list_tags(self, collection=None):
+        return sorted({t for rec in get_file_records(collection) for t in rec["tags"]})
+
+    def scope_files(self, collection=None, files=None, tags=None, since=None, until=None):
+        """检索范围内的文件名；没有任何筛选条件时为全部文件"""
+        scope = resolve_scope(collection, files=files, tags=tags, since=since, until=until)
+        return self.list_files(collection) if scope is None else scope
+
+    def set_tags(self, filename, tags, collection=None):
+        manifest.set_tags(filename, tags, check_collection(collection))
+
+    def dedup_report(self, collection=None):
+        """
+        近重复去重的节省统计 (见 dedup.report)，另加 vector_bytes_saved (按 float32 向量计) 与当前阈值
+        """
+        collection = check_collection(collection)
+        report = dedup.report(collection)
+        sample = get_store(collection).get(limit=1, include=["embeddings"]).get("embeddings")
+        dim = len(sample[0]) if sample is not None and len(sample) else 0
+        report["vector_bytes_saved"] = report["duplicate_chunks"] * dim * 4
+        report["threshold"] = dedup.configured_threshold()
+        return report
+
+    # 删除 / 清空与后台入库 worker 共用租约，向量库同一时刻只有一个写入者
+    def delete_file(self, filename, collection=None):
+        with jobs.writer_lease():
+            delete_file_from_db(filename, collection)
+
+    def reset(self, collection=None):
+        with jobs.writer_lease():
+            reset_db(collection)
+
+    # --- 检索与生成 ---
+    def retrieve(self, query, top_k_recall=30, top_k_rerank=5, token_budget=3000, use_web=False,
+                 on_stage=None, collection=None, files=None, tags=None, since=None, until=None):
+        """
+        本地检索 + 联网搜索，返回 {"local", "local_refs", "web", "stages"}
+        检索范围：collection 选择知识库，files / tags / [since, until] (入库时间，Unix 秒) 在检索前筛选文件
+        """
+        collection = check_collection(collection)
+        start = time.perf_counter()
+        embedder = reranker = None
+        if self.embedder is not None and self.has_documents(collection):
+            embedder, reranker = self.embedder, self.reranker
+        retrieved = retrieve_context(
+            query, embedder, reranker,
+            top_k_recall=top_k_recall,
+            top_k_rerank=top_k_rerank,
+            token_budget=token_budget,
+            tavily_key=self.get("TAVILY_API_KEY") if use_web else None,
+            on_stage=on_stage,
+            collection=collection,
+            sources=resolve_scope(collection, files=files, tags=tags, since=since, until=until)
+        )
+        # 启动剖面：进程内第一个查询的检索耗时 (含未预热时的索引加载 / 建连开销)
+        startup.record("first_query", time.perf_counter() - start)
+        return retrieved
+
+    def batch_retrieve(self, queries_path, out_path, top_k_recall=30, top_k_rerank=5, token_budget=3000,
+                       batch_size=batch.BATCH_SIZE, rerank_concurrency=batch.RERANK_CONCURRENCY,
+                       on_progress=None, collection=None, files=None, tags=None, since=None, until=None):
+        """批量检索查询文件，结果写入 JSONL，可断点续跑；检索范围参数同 retrieve"""
+        embedder = self.embedder
+        if embedder is None:
+            raise ValueError("未配置 EMBEDDING_API_KEY")
+        collection = check_collection(collection)
+        return batch.run_batch(
+            embedder, batch.read_queries(queries_path), out_path, reranker=self.reranker,
+            top_k_recall=top_k_recall, top_k_rerank=top_k_rerank, token_budget=token_budget,
+            batch_size=batch_size, rerank_concurrency=rerank_concurrency, on_progress=on_progress,
+            collection=collection,
+            sources=resolve_scope(collection, files=files, tags=tags, since=since, until=until)
+        )
+
+    def prepare_query(self, query, messages=(), chat_id=None):
+        """
+        多轮对话：压缩本轮之前的对话 messages (最近几轮原文 + 滚动摘要)，并把追问改写成独立的检索查询
+        返回 (检索查询, 记忆)；没有历史或未配置大模型时原样返回问题，记忆为 None
+        """
+        if not messages or self.llm is None:
+            return query, None
+        memory = build_memory(self.llm, chat_id, messages, turns=int(self.get("MEMORY_TURNS")),
+                              token_budget=int(self.get("MEMORY_TOKENS")))
+        return rewrite_query(self.llm, query, memory), memory
+
+    def stream_answer(self, query, retrieved, temperature=0.3, memory=None):
+        """基于检索结果 (和 prepare_query 返回的对话记忆) 流式生成回答，逐段产出文本"""
+        if self.llm is None:
+            raise ValueError("未配置 DEEPSEEK_API_KEY")
+        memory = memory or {"summary": "", "messages": []}
+        system_prompt = build_system_prompt(retrieved["local"], retrieved["web"], memory["summary"])
+        return stream_answer(self.llm, system_prompt, query, temperature=temperature, history=memory["messages"])
+
+    def cached_answer(self, query, retrieved, temperature=0.3, threshold=None):
+        """
+        语义答案缓存：检索上下文与 temperature 相同、问题相似度 ≥ threshold 时返回之前的回答
+        返回 {"id", "answer", "refs", "query", "similarity"}，未命中时返回 None
+        """
+        embedder = self.embedder
+        if embedder is None:
+            return None
+        threshold = threshold or self.answer_cache_threshold or answer_cache.DEFAULT_THRESHOLD
+        try:
+            return answer_cache.load_answer_cache().lookup(
+                answer_cache.context_fingerprint(retrieved["local"], retrieved["web"]), temperature,
+                embed_query(embedder, query), threshold
+            )
+        except Exception as e:
+            # 缓存异常不影响正常生成
+            print(f"答案缓存查询失败: {e}")
+            return None
+
+    def cache_answer(self, query, retrieved, temperature, answer, collection=None):
+        """写入答案缓存，记录引用的文件 (文件删除或重新入库时失效)"""
+        embedder = self.embedder
+        if embedder is None or not answer:
+            return
+        collection = check_collection(collection)
+        try:
+            answer_cache.load_answer_cache().put(
+                answer_cache.context_fingerprint(retrieved["local"], retrieved["web"]), temperature, query,
+                embed_query(embedder, query), answer, retrieved["local_refs"],
+                answer_cache.cited_sources(retrieved["local_refs"], collection)
+            )
+        except Exception as e:
+            print(f"答案缓存写入失败: {e}")
+
+    def discard_cached_answer(self, answer_id):
+        """用户拒绝了缓存回答 (重新生成)：删除该条，之后相似的问题不再回放它"""
+        try:
+            answer_cache.load_answer_cache().discard(answer_id)
+        except Exception as e:
+            print(f"答案缓存删除失败: {e}")
+
+    # --- 历史记录 ---
+    def record_answer(self, chat_id, messages, answer, refs):
+        """messages 以本轮用户提问结尾；追加回答 (只保存片段引用) 并持久化，返回新的消息列表"""
+        messages = list(messages) + [{"role": "assistant", "content": answer, "refs": refs}]
+        history.save_chat(chat_id, messages)
+        return messages
+
+    def truncate_chat(self, chat_id, count):
+        """对话只保留前 count 条消息 (持久化)"""
+        history.truncate_chat(chat_id, count)
@@ -0,0 +1,81 @@
+"""
+冷启动：让页面 / API 启动后的第一个查询不再承担一次性的初始化开销
+- 重依赖 (chromadb / openai / tavily) 由各模块延迟到首次使用时导入，启动时只加载轻量模块
+- warm_up 在后台线程中预热：向量库索引、关键词索引、Embedding / Rerank / 大模型客户端及其 HTTP 连接池
+- 启动剖面：入口导入耗时、各预热步骤耗时、首个查询耗时 (每个进程只记第一次)，
+  页面调试面板展示，benchmarks/startup_profile.py 在 CI 中对照预算检查
+"""
+import threading
+import time
+
+from modules import lexical, metrics, remote
+from modules.database import check_collection, get_store
+
+_profile = {}
+_lock = threading.Lock()
+_warm_thread = None
+
+
+def record(name, seconds):
+    """记录一项启动耗时 (秒)；同一进程内同名项只记第一次，返回是否记录"""
+    with _lock:
+        if name in _profile:
+            return False
+        _profile[name] = seconds
+    metrics.observe(f"startup_{name}", seconds)
+    return True
+
+
+def profile():
+    """启动剖面 {项目: 毫秒}"""
+    with _lock:
+        return {name: round(seconds * 1000, 1) for name, seconds in _profile.items()}
+
+
+def _warm_steps(service, collection):
+    """(步骤名, 函数) 列表；未配置的外部服务不预热"""
+    steps = [
+        ("vector_index", lambda: get_store(collection).warm_up()),
+        ("lexical_index", lambda: lexical.count(collection)),
+    ]
+    if service.get("EMBEDDING_API_KEY"):
+        steps.append(("embedder", lambda: remote.warm_openai_client(service.embedder.client)))
+    if service.get("RERANK_API_KEY"):
+        steps.append(("reranker", lambda: service.reranker.warm_up()))
+    if service.get("DEEPSEEK_API_KEY"):
+        steps.append(("llm", lambda: remote.warm_openai_client(service.llm)))
+    if service.get("TAVILY_API_KEY"):
+        steps.append(("web", lambda: _warm_tavily(service.get("TAVILY_API_KEY"))))
+    return steps
+
+
+def _warm_tavily(api_key):
+    from modules.web_search import warm_tavily_client
+    warm_tavily_client(api_key, None)
+
+
+def warm_up(service, collection=None):
+    """依次执行各预热步骤 (单步失败只打印，不影响其他步骤)，返回启动剖面"""
+    collection = check_collection(collection)
+    start = time.perf_counter()
+    for name, step in _warm_steps(service, collection):
+        step_start = time.perf_counter()
+        try:
+            step()
+        except Exception as e:
+            print(f"预热 {name} 失败: {e}")
+            continue
+        record(f"warm_{name}", time.perf_counter() - step_start)
+    record("warm_total", time.perf_counter() - start)
+    return profile()
+
+
+def start_warm_up(service, collection=None):
+    """在后台线程中预热 (每个进程只启动一次)，返回线程"""
+    global _warm_thread
+    with _lock:
+        if _warm_thread is None:
+            _warm_thread = threading.Thread(target=warm_up, args=(service, collection),
+                                            name="warm-up", daemon=True)
+            _warm_thread.start()
+        return _warm_thread
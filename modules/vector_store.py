@@ -0,0 +1,112 @@
+"""
+向量库后端接口：database.py 只通过这里的方法访问向量库，具体实现可替换
+- ChromaStore:  Chroma 持久化集合 (HNSW 近似检索，默认)
+- MemmapStore:  NumPy 内存映射 float16 矩阵上的精确检索 (见 memmap_store.py)
+
+where 过滤条件沿用 Chroma 的写法：{"source": x}、{"page": {"$in": [...]}}、{"$and": [...]} 等
+"""
+import numpy as np
+
+
+class VectorStore:
+    """后端需实现的方法 (参数 / 返回值格式与 Chroma 集合保持一致，便于互换)"""
+
+    def count(self):
+        """片段总数"""
+        raise NotImplementedError
+
+    def upsert(self, ids, embeddings, metadatas, documents):
+        """按 ID 覆盖写入；embeddings 为 (n, dim) 的 NumPy 数组"""
+        raise NotImplementedError
+
+    def query(self, query_embeddings, n_results=10, where=None, ids=None):
+        """
+        余弦相似度检索，query_embeddings 为 (q, dim) 的 NumPy 数组；ids 不为 None 时只在这些片段中检索
+        返回与查询顺序一致的列表，每项为 [{"id", "document", "metadata", "score"}, ...] (score 越大越相似)
+        """
+        raise NotImplementedError
+
+    def get(self, ids=None, where=None, include=("documents", "metadatas"), limit=None, offset=0):
+        """
+        按 ID / 条件读取，返回 {"ids": [...], "documents": [...], "metadatas": [...]}
+        include 含 "embeddings" 时另返回 "embeddings": (n, dim) 数组
+        """
+        raise NotImplementedError
+
+    def delete(self, ids=None, where=None):
+        raise NotImplementedError
+
+    def reset(self):
+        """清空全部数据"""
+        raise NotImplementedError
+
+    def warm_up(self):
+        """预热：把索引 / 向量提前加载到内存，首次检索不再承担加载开销 (可选实现)"""
+
+
+class ChromaStore(VectorStore):
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+        self._collection = None
+
+    @property
+    def collection(self):
+        if self._collection is None:
+            self._collection = self.client.get_or_create_collection(
+                name=self.name,
+                metadata={"hnsw:space": "cosine"}
+            )
+        return self._collection
+
+    def count(self):
+        return self.collection.count()
+
+    def upsert(self, ids, embeddings, metadatas, documents):
+        # 直接传 NumPy 数组，避免逐元素转换为 Python list
+        self.collection.upsert(
+            ids=ids,
+            embeddings=np.asarray(embeddings, dtype=np.float32),
+            metadatas=metadatas,
+            documents=documents
+        )
+
+    def query(self, query_embeddings, n_results=10, where=None, ids=None):
+        results = self.collection.query(
+            query_embeddings=np.asarray(query_embeddings, dtype=np.float32),
+            n_results=n_results,
+            where=where or None,
+            ids=list(ids) if ids is not None else None,
+            include=["documents", "metadatas", "distances"]
+        )
+        if not results["documents"]:
+            return [[] for _ in range(len(query_embeddings))]
+        return [
+            [
+                {"id": cid, "document": doc, "metadata": meta, "score": 1 - distance}
+                for cid, doc, meta, distance in zip(ids, docs, metas, distances)
+            ]
+            for ids, docs, metas, distances in zip(results["ids"], results["documents"],
+                                                   results["metadatas"], results["distances"])
+        ]
+
+    def get(self, ids=None, where=None, include=("documents", "metadatas"), limit=None, offset=0):
+        return self.collection.get(ids=ids, where=where or None, include=list(include),
+                                   limit=limit, offset=offset or None)
+
+    def delete(self, ids=None, where=None):
+        self.collection.delete(ids=ids, where=where or None)
+
+    def reset(self):
+        # 逐批删除全部片段而不是删除集合：集合 ID 不变，其他进程 (API worker 等) 持有的集合句柄仍然有效
+        batch = self.client.get_max_batch_size()
+        while True:
+            ids = self.collection.get(limit=batch, include=[])["ids"]
+            if not ids: break
+            self.collection.delete(ids=ids)
+
+    def warm_up(self):
+        # Chroma 在首次检索时才把 HNSW 索引读入内存：取库里的一条向量检索一次
+        sample = self.collection.get(limit=1, include=["embeddings"])
+        if len(sample["embeddings"]):
+            self.collection.query(query_embeddings=np.asarray(sample["embeddings"][:1]), n_results=1)
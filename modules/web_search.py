@@ -1,20 +1,62 @@
-from tavily import TavilyClient
-import streamlit as st
+from functools import lru_cache
 
+import requests
 
-def search_web(query, api_key):
+from modules import query_cache, remote
+
+# 单次搜索超时 (秒)，需小于 pipeline.WEB_TIMEOUT；网络错误 / 超时 / 5xx 重试次数
+SEARCH_TIMEOUT = 8
+SEARCH_RETRIES = 1
+
+
+@lru_cache(maxsize=None)
+def load_tavily_client(api_key, base_url=None):
+    """进程内共享的 Tavily 客户端 (常驻 Session，复用连接)"""
+    from tavily import TavilyClient  # 延迟导入：未开启联网搜索时不加载
+    return TavilyClient(api_key=api_key, api_base_url=base_url, session=remote.new_session())
+
+
+def warm_tavily_client(api_key, base_url=None, timeout=5):
+    """
+    预热 Tavily 客户端：参数与 search_web 的调用一致 (同一个缓存的客户端)，
+    对 API 根地址发一次 HEAD，TCP / TLS 连接留在客户端的连接池里；不消耗搜索额度，响应状态码不论
+    """
+    client = load_tavily_client(api_key, base_url)
+    client.session.head(client.base_url, timeout=timeout)
+
+
+@lru_cache(maxsize=None)
+def retryable_errors():
+    """可重试的错误：网络错误、超时、HTTP 错误，以及 Tavily 自己的超时 / 限流 (429) 异常 (tavily 延迟导入)"""
+    from tavily.errors import TimeoutError as TavilyTimeoutError, UsageLimitExceededError
+    return (requests.ConnectionError, requests.Timeout, requests.HTTPError, TimeoutError,
+            TavilyTimeoutError, UsageLimitExceededError)
+
+
+def search_web(query, api_key, base_url=None):
     """
     使用 Tavily 搜索实时网络信息
+    base_url 可指向 Tavily 兼容服务 (如离线基准测试中的本地替身)
+    非空结果缓存 query_cache.WEB_TTL 秒
     """
     if not api_key:
         return ""
 
+    cache_key = (base_url, query_cache.normalize_query(query))
+    cached = query_cache.web.get(cache_key)
+    if cached is not None:
+        return cached
+
     try:
-        # 初始化客户端
-        tavily = TavilyClient(api_key=api_key)
+        tavily = load_tavily_client(api_key, base_url)
 
-        # 执行搜索 (max_results=3 控制返回数量)
-        response = tavily.search(query=query, search_depth="basic", max_results=3)
+        # 执行搜索 (max_results=3 控制返回数量)；连续失败时熔断，冷却期内直接跳过联网搜索
+        response = remote.call(
+            "tavily",
+            lambda: tavily.search(query=query, search_depth="basic", max_results=3, timeout=SEARCH_TIMEOUT),
+            retries=SEARCH_RETRIES,
+            retry_on=retryable_errors()
+        )
 
         context_pieces = []
         for result in response.get('results', []):
@@ -29,8 +71,10 @@ def search_web(query, api_key):
         if not context_pieces:
             return ""
 
-        return "\n\n".join(context_pieces)
+        context = "\n\n".join(context_pieces)
+        query_cache.web.put(cache_key, context)
+        return context
 
     except Exception as e:
         print(f"联网搜索失败: {e}")  # 打印到后台方便调试
-        return ""  # 失败返回空，不影响主流程
\ No newline at end of file
+        return ""  # 失败返回空，不影响主流程